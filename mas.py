@@ -24,14 +24,318 @@ from ctypes import *
 from threading import Timer
 from datetime import datetime, timedelta
 import getopt, sys, time, threading, re, logging, sunstate, bottle, json, os
-import signal, shutil
+import signal, shutil, collections, itertools, select, struct
+import hashlib, marshal, array, bisect, gzip, io, mimetypes, posixpath
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import numpy
+except ImportError:
+    numpy = None # Optional, the EventTable uses the array module instead
+try:
+    import brotli
+except ImportError:
+    brotli = None # Optional, static files are only compressed with gzip
 
 __version__ = "1.2.4-SNAPSHOT"
 
+###############################################################################
+# EVENT HUB
+###############################################################################
+class EventHub:
+    ''' Publish/subscribe hub for state changes (device commands, fired 
+        events, configuration changes). Every subscriber has a bounded 
+        queue, messages to a subscriber that don't keep up are dropped. '''
+    QUEUE_SIZE = 100
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = []
+
+    def subscribe(self, max_subscribers = None):
+        ''' Return a queue receiving (kind, data) tuples, or None if there
+            already are max_subscribers subscribers '''
+        subscriber = queue.Queue(self.QUEUE_SIZE)
+        with self.lock:
+            if((max_subscribers != None) and 
+               (len(self.subscribers) >= max_subscribers)):
+                return None
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            if(subscriber in self.subscribers):
+                self.subscribers.remove(subscriber)
+
+    def publish(self, kind, data):
+        ''' kind -- Type of message, e.g. 'device'
+            data -- Dictionary which can be converted to JSON '''
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait((kind, data))
+            except queue.Full:
+                pass
+
+###############################################################################
+# HISTORY
+###############################################################################
+HistoryRecord = collections.namedtuple("HistoryRecord", 
+    "time source devices command level group duration_ms result")
+
+class History:
+    ''' The latest commands executed by the timer thread and the WebAPI as
+        records in a ring buffer allocated at start, i.e. the memory used
+        doesn't grow with uptime. The oldest record is replaced when the
+        buffer is full. '''
+    DEFAULT_SIZE = 1000
+    SOURCES = ["timer", "web"]
+    SUCCESS = "success"
+    COALESCED = "coalesced" # Replaced by a later command, not an error
+
+    def __init__(self, size = DEFAULT_SIZE):
+        self.lock = threading.Lock()
+        self.records = [None] * size
+        self.count = 0 # Number of records added since start
+
+    def add(self, source, devices, command, level, group, duration, result):
+        ''' source   -- 'timer' or 'web'
+            devices  -- Device IDs of the command
+            group    -- Group ID if the command was sent to a group or None
+            duration -- Seconds until the command was sent to all devices
+            result   -- SUCCESS, COALESCED or the error messages '''
+        with self.lock:
+            self.records[self.count % len(self.records)] = HistoryRecord(
+                time.time(), source, list(devices), command, level, group,
+                round(duration * 1000, 3), result)
+            self.count += 1
+
+    def query(self, since = None, source = None, device = None, 
+              group = None, command = None, failed = None, limit = None):
+        ''' Return the records matching all given filters, newest first.
+               since  -- Only records at or after this time.time()
+               failed -- True for failed records only, False for successful
+                         records only '''
+        with self.lock:
+            records = list(self.records)
+            count = self.count
+        result = []
+        for index in range(count - 1, max(count - len(records), 0) - 1, -1):
+            record = records[index % len(records)]
+            if(((since != None) and (record.time < since)) or
+               ((limit != None) and (len(result) >= limit))):
+                break
+            if(((source != None) and (record.source != source)) or
+               ((device != None) and (device not in record.devices)) or
+               ((group != None) and (record.group != group)) or
+               ((command != None) and (record.command != command)) or
+               ((failed != None) and 
+                (failed == (record.result in [self.SUCCESS, 
+                                              self.COALESCED])))):
+                continue
+            result.append(record)
+        return result
+
+class HistoryCommand:
+    ''' A command (e.g. of a fired event or a group action) to one or more
+        devices. Every device is reported done when the command is sent to
+        it, or failed, and the History record of the command is added when
+        all devices are done, i.e. the duration is until the last device
+        is sent. '''
+    def __init__(self, history, source, devices, command, level = None,
+                 group = None):
+        self.history = history
+        self.source = source
+        self.devices = list(devices)
+        self.command = command
+        self.level = level
+        self.group = group # Group ID or None
+        self.start = time.time()
+        self.lock = threading.Lock()
+        self.remaining = len(self.devices) # Devices not done
+        self.errors = []
+        self.coalesced = False # Replaced by a later command to a device
+
+    def done(self, device, error = None):
+        ''' The command is sent to device, or failed if error is given '''
+        with self.lock:
+            if(self.remaining == 0):
+                return
+            self.remaining -= 1
+            if(error != None):
+                self.errors.append("device " + str(device) + ": " + error)
+            if(self.remaining > 0):
+                return
+        self._add()
+
+    def replaced(self, device):
+        ''' The command to device is replaced by a later command '''
+        with self.lock:
+            self.coalesced = True
+        self.done(device)
+
+    def fail(self, error):
+        ''' The command failed for all devices not done '''
+        with self.lock:
+            if(self.remaining == 0):
+                return
+            self.remaining = 0
+            self.errors.append(error)
+        self._add()
+
+    def _add(self):
+        result = History.SUCCESS
+        if(len(self.errors) > 0):
+            result = "; ".join(self.errors)
+        elif(self.coalesced):
+            result = History.COALESCED
+        self.history.add(self.source, self.devices, self.command, self.level,
+                         self.group, time.time() - self.start, result)
+
 ###############################################################################
 # TELLDUS TELLSTICK LIBRARY
 ###############################################################################
+class TransmitQueue:
+    ''' Serializes the commands to the radio transmitter, which can only 
+        send one command at a time, in one thread. A queued on, off or dim
+        command to a device is replaced by a newer on, off or dim command 
+        to the same device, e.g. only the last level is sent when a dim 
+        slider is dragged. The order of the commands to a device is kept. '''
+    COALESCED_COMMANDS = ["on", "off", "dim"]
+
+    def __init__(self, send):
+        ''' send -- Function(device, command, value) transmitting a command,
+                    returns None or an error message '''
+        self.send = send
+        self.condition = threading.Condition()
+        # [device, command, value, time, HistoryCommand or None]
+        self.pending = collections.deque()
+        self.latest = {} # Device ID -> pending entry which can be replaced
+        self.running = True
+        self.sending = False
+        self.sent_count = 0
+        self.coalesced_count = 0
+        self.latency_total = 0.0 # Seconds from queued to sent
+        self.latency_max = 0.0
+        self.thread = threading.Thread(target = self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, device, command, value = None, history_command = None):
+        ''' history_command -- HistoryCommand told when the device is sent
+                               or None '''
+        replaced = None
+        with self.condition:
+            entry = self.latest.get(device)
+            if((entry != None) and (command in self.COALESCED_COMMANDS)):
+                replaced = entry[4]
+                entry[1] = command
+                entry[2] = value
+                entry[4] = history_command
+                self.coalesced_count += 1
+            else:
+                entry = [device, command, value, time.time(), history_command]
+                self.pending.append(entry)
+                if(command in self.COALESCED_COMMANDS):
+                    self.latest[device] = entry
+                else:
+                    # Commands queued after this one must not replace earlier
+                    self.latest.pop(device, None)
+                self.condition.notify_all()
+        if(replaced != None):
+            replaced.replaced(device)
+
+    def depth(self):
+        ''' Number of commands waiting to be sent '''
+        return len(self.pending)
+
+    def metrics(self):
+        with self.condition:
+            latency_avg = 0.0
+            if(self.sent_count > 0):
+                latency_avg = self.latency_total / self.sent_count
+            return {
+                'depth'          : len(self.pending),
+                'sent'           : self.sent_count,
+                'coalesced'      : self.coalesced_count,
+                'latency_avg_ms' : int(latency_avg * 1000),
+                'latency_max_ms' : int(self.latency_max * 1000)
+            }
+
+    def flush(self):
+        ''' Wait until all queued commands are sent '''
+        with self.condition:
+            while((len(self.pending) > 0) or self.sending):
+                self.condition.wait()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while(self.running and (len(self.pending) == 0)):
+                    self.condition.wait()
+                if(len(self.pending) == 0):
+                    return
+                entry = self.pending.popleft()
+                if(self.latest.get(entry[0]) is entry):
+                    del self.latest[entry[0]]
+                self.sending = True
+            device, command, value, queued, history_command = entry
+            try:
+                error = self.send(device, command, value)
+            except Exception as e:
+                error = str(e)
+            if(error != None):
+                logging.error("Failed to send " + command + " to device " + 
+                              str(device) + ": " + error)
+            if(history_command != None):
+                history_command.done(device, error)
+            latency = time.time() - queued
+            with self.condition:
+                self.sending = False
+                self.sent_count += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+                self.condition.notify_all()
+
+DeviceState = collections.namedtuple("DeviceState", 
+    ["id", "name", "supports_on_off", "supports_dim", "supports_learn", 
+     "last_cmd_was_on", "last_dim_level", "protocol", "model", "parameters"])
+
+class DeviceSnapshot:
+    ''' The state of all devices read in one pass. The generation is only
+        increased when the state differs from the previous snapshot. '''
+    def __init__(self, generation, changes, devices):
+        self.generation = generation
+        self.changes = changes # TelldusLibrary.changes when read
+        self.time = time.time()
+        self.devices = devices # List of DeviceState
+        self.index = dict((device.id, device) for device in devices)
+
 class TelldusLibrary:
+    ''' Interface to the telldus-core library. The metadata of the devices
+        (supported methods, name, protocol, model and parameters) is cached
+        to avoid ctypes calls on every command. The metadata of a device is
+        read when it is first needed and invalidated when the device is 
+        changed through this class. The device IDs are kept in 
+        an index which is updated when devices are created or deleted. 
+        To catch changes made outside MAS (tdtool, tellstick.conf) the 
+        device IDs and metadata are read again when the snapshot expires, 
+        and an unknown device ID is looked up in telldus-core. 
+
+        The commands (on, off, dim and learn) are sent by a TransmitQueue,
+        i.e. the methods return before the command is transmitted. '''
+    SNAPSHOT_MAX_AGE = 10 # Seconds, then devices are read again
+    TELLSTICK_SUCCESS = 0
     DIM_LEVEL_MIN = 0
     DIM_LEVEL_MAX = 255
     TURNON  = 1
@@ -43,7 +347,24 @@ class TelldusLibrary:
     ALL_METHODS = TURNON | TURNOFF | BELL | TOGGLE | DIM | LEARN
     PARAMETERS = ["devices", "house", "unit", "code", "system", "units", "fade"]
 
-    def __init__(self):
+    def __init__(self, library = None, hub = None):
+        ''' library -- telldus-core library, loaded if not given
+            hub     -- EventHub where sent commands are published or None '''
+        self.hub = hub
+        self.devices_lock = threading.Lock()
+        self.devices = {} # Cached metadata, device ID -> dictionary
+        self.device_ids = [] # Device IDs in telldus-core order
+        self.device_id_set = set()
+        self.change_counter = itertools.count(1)
+        self.changes = 0 # Increased on every command and device change
+        self.snapshot_lock = threading.Lock()
+        self.last_snapshot = None
+        self.transmitter = TransmitQueue(self._transmit)
+        if(library != None):
+            self.library = library
+            self.refresh_devices()
+            return
+
         library_name = "TelldusCore"
         if sys.platform == "linux2":
             library_name = "telldus-core"
@@ -70,134 +391,276 @@ class TelldusLibrary:
         self.library.tdSetDeviceParameter.argtypes = [ c_int, c_char_p, c_char_p]
         self.library.tdGetErrorString.restype = c_char_p
         self.library.tdLastSentValue.restype = c_char_p
+        self.refresh_devices()
 
-    def get_device_IDs(self):
-        devices = []
+    def refresh_devices(self):
+        ''' Read the device IDs from telldus-core and drop the cached 
+            metadata, which is read again when needed '''
+        with self.devices_lock:
+            self.devices = {}
+            self._update_device_IDs()
+
+    def _update_device_IDs(self):
+        device_ids = []
         number_devices = self.library.tdGetNumberOfDevices()
         for i in range(number_devices):
-            devices.append(int(self.library.tdGetDeviceId(i)))
-        return devices
+            device_ids.append(int(self.library.tdGetDeviceId(i)))
+        self.device_ids = device_ids
+        self.device_id_set = set(device_ids)
+
+    def _read_device(self, device_id):
+        parameters = {}
+        for parameter in self.PARAMETERS:
+            value = self.library.tdGetDeviceParameter(
+                        device_id, parameter.encode('utf-8'), b"")
+            if(isinstance(value, bytes)):
+                value = value.decode('utf-8', 'replace')
+            parameters[parameter] = value
+        return {
+            'methods'    : self.library.tdMethods(device_id, self.ALL_METHODS),
+            'name'       : self.library.tdGetName(device_id),
+            'protocol'   : self.library.tdGetProtocol(device_id),
+            'model'      : self.library.tdGetModel(device_id),
+            'parameters' : parameters
+        }
+
+    def _device(self, device_id):
+        ''' Return the cached metadata of the device '''
+        with self.devices_lock:
+            device = self.devices.get(device_id)
+            if(device == None):
+                device = self._read_device(device_id)
+                self.devices[device_id] = device
+            return device
+
+    def _invalidate(self, device_id):
+        with self.devices_lock:
+            self.devices.pop(device_id, None)
+        self._changed()
+
+    def _changed(self):
+        self.changes = next(self.change_counter)
+
+    def _publish(self, device_id, command, dim_level = None):
+        if(self.hub != None):
+            data = {'id' : device_id, 'command' : command}
+            if(dim_level != None):
+                data['dim_level'] = dim_level
+            self.hub.publish('device', data)
+
+    def _device_state(self, device_id):
+        device = self._device(device_id)
+        methods = device['methods']
+        supports_dim = bool(methods & self.DIM)
+        last_dim_level = 0
+        if(supports_dim):
+            last_dim_level = self.last_dim_level(device_id)
+        return DeviceState(device_id, device['name'],
+            bool((methods & self.TURNON) and (methods & self.TURNOFF)),
+            supports_dim, bool(methods & self.LEARN), 
+            self.last_cmd_was_on(device_id), last_dim_level, 
+            device['protocol'], device['model'], device['parameters'])
+
+    def snapshot(self):
+        ''' Return a DeviceSnapshot with the state of all devices. The 
+            snapshot is reused until a command is sent, a device is changed
+            or SNAPSHOT_MAX_AGE has passed. '''
+        with self.snapshot_lock:
+            changes = self.changes
+            last = self.last_snapshot
+            if(last != None):
+                if(time.time() - last.time >= self.SNAPSHOT_MAX_AGE):
+                    self.refresh_devices() # Catches changes made outside MAS
+                elif(last.changes == changes):
+                    return last
+            devices = [self._device_state(device_id) 
+                       for device_id in self.get_device_IDs()]
+            generation = 1
+            if(last != None):
+                generation = last.generation
+                if(last.devices != devices):
+                    generation += 1
+            self.last_snapshot = DeviceSnapshot(generation, changes, devices)
+            return self.last_snapshot
+
+    def get_device_IDs(self):
+        return list(self.device_ids)
+
+    def has_device(self, device_id):
+        if(device_id not in self.device_id_set):
+            # The device may have been created outside MAS
+            with self.devices_lock:
+                self._update_device_IDs()
+        return device_id in self.device_id_set
     
     def new_device(self):
         device_id = self.library.tdAddDevice();
         if(device_id < 0):
             error_msg = self.library.tdGetErrorString(device_id)
             raise Exception("Could create new device.\n\n" + error_msg)
+        with self.devices_lock:
+            self.devices.pop(device_id, None)
+            self._update_device_IDs()
+        self._changed()
         return device_id
         
     def supports_on_off(self, device_id):
-        if((self.library.tdMethods(device_id,self.TURNON)  & self.TURNON) and
-           (self.library.tdMethods(device_id,self.TURNOFF) & self.TURNOFF)):
+        methods = self._device(device_id)['methods']
+        if((methods & self.TURNON) and (methods & self.TURNOFF)):
             return True
         else:
             return False
 
     def supports_dim(self, device_id):
-        if(self.library.tdMethods(device_id,self.DIM) & self.DIM):
+        if(self._device(device_id)['methods'] & self.DIM):
             return True
         else:
             return False
         
     def supports_learn(self, device_id):
-        if(self.library.tdMethods(device_id,self.LEARN) & self.LEARN):
+        if(self._device(device_id)['methods'] & self.LEARN):
             return True
         else:
             return False
             
     def get_name(self, device_id):
-        name = self.library.tdGetName(device_id)
-        return name
-
+        return self._device(device_id)['name']
         
     def set_name(self, device_id, name):
         logging.debug("Change name of device " + str(device_id) + " to : " + name)
         encoded_name = name.encode('utf-8')
-        if(self.library.tdSetName(device_id, encoded_name) == 0):
+        result = self.library.tdSetName(device_id, encoded_name)
+        self._invalidate(device_id)
+        if(result == 0):
              raise Exception("Could not change device name '" + name.strip() + 
                              "'. Secure that tellstick.conf is writeable.")
 
     def delete_device(self, device_id):
         logging.debug("Deleting device " + str(device_id))
-        if(self.library.tdRemoveDevice(device_id) == 0):
+        result = self.library.tdRemoveDevice(device_id)
+        with self.devices_lock:
+            self.devices.pop(device_id, None)
+            self._update_device_IDs()
+        self._changed()
+        if(result == 0):
              raise Exception("Could not delete device with id '" + str(device_id) + 
                              "'. Secure that tellstick.conf is writeable.")
 
     def get_protocol(self, device_id):
-        return self.library.tdGetProtocol(device_id)
+        return self._device(device_id)['protocol']
        
     def set_protocol(self, device_id, protocol):
-        if(self.library.tdSetProtocol(device_id, protocol) == 0):
+        result = self.library.tdSetProtocol(device_id, 
+                                            protocol.encode('utf-8'))
+        self._invalidate(device_id)
+        if(result == 0):
              raise Exception("Could set device protocol for '" + str(device_id) + 
                              "'. Secure that tellstick.conf is writeable.")
 
     def get_model(self, device_id):
-        return self.library.tdGetModel(device_id)
+        return self._device(device_id)['model']
 
     def set_model(self, device_id, model):
-        if(self.library.tdSetModel(device_id, model) == 0):
+        result = self.library.tdSetModel(device_id, model.encode('utf-8'))
+        self._invalidate(device_id)
+        if(result == 0):
              raise Exception("Could set device model for '" + str(device_id) + 
                              "'. Secure that tellstick.conf is writeable.")
         
     def get_parameters(self, device_id):
-        result = {}
-        for parameter in self.PARAMETERS:
-            result[parameter] = self.library.tdGetDeviceParameter(device_id, parameter, "")
-        return result
+        return dict(self._device(device_id)['parameters'])
         
     def set_parameters(self, device_id, parameters):
-        for parameter, value in parameters.items():
-            if(parameter not in self.PARAMETERS):
-                raise Exception("Unknown parameter '" + parameter + "'")
-            if(self.library.tdSetDeviceParameter(device_id, parameter, value) == 0):
-                if (value != ""):
-                    raise Exception("Could set device parameter '" + parameter + 
-                                    "' to '" + value +"' for device '" + 
-                                    str(device_id) + "'.")        
+        try:
+            for parameter, value in parameters.items():
+                if(parameter not in self.PARAMETERS):
+                    raise Exception("Unknown parameter '" + parameter + "'")
+                if(self.library.tdSetDeviceParameter(device_id, 
+                       parameter.encode('utf-8'), value.encode('utf-8')) == 0):
+                    if (value != ""):
+                        raise Exception("Could set device parameter '" + parameter + 
+                                        "' to '" + value +"' for device '" + 
+                                        str(device_id) + "'.")        
+        finally:
+            self._invalidate(device_id)
                              
-    def turn_on(self,devices):
+    def turn_on(self, devices, history_command = None):
         ''' Turn on one or more devices. Will try on all IDs. 
-               devices -- List of device IDs to turn on       '''
+               devices         -- List of device IDs to turn on
+               history_command -- HistoryCommand told about every device
+                                  or None '''
         for device in devices:     
             if(self.supports_on_off(device)):
-                logging.debug("Turning ON device " + str(device))
-                self.library.tdTurnOn(device)
+                self.transmitter.put(device, "on", None, history_command)
             else:
-                logging.warning(str(device) + " cannot be turned on")
+                self._not_sent(device, "cannot be turned on", history_command)
     
-    def turn_off(self,devices):
+    def turn_off(self, devices, history_command = None):
         ''' Turn off one or more devices. Will try on all IDs. 
-               devices -- List of device IDs to turn off       '''
+               devices -- List of device IDs to turn off, see turn_on '''
         for device in devices:
             if(self.supports_on_off(device)):
-                logging.debug("Turning OFF device " + str(device))
-                self.library.tdTurnOff(device)
+                self.transmitter.put(device, "off", None, history_command)
             else:
-                logging.warning(str(device) + " cannot be turned off")     
+                self._not_sent(device, "cannot be turned off", 
+                               history_command)
                 
-    def dim(self,devices,dim_level):
+    def dim(self, devices, dim_level, history_command = None):
         ''' Dim one or more devices. Will try on all IDs. 
-               devices   -- List of device IDs to dim        
+               devices   -- List of device IDs to dim, see turn_on
                dim_level -- Integer between 0-255          '''
-        if((dim_level < self.DIM_LEVEL_MIN) or 
-           (dim_level > self.DIM_LEVEL_MAX)):
-            logging.warning("Dim level: '" + str(dim_level) + "' not valid")
-        else:
-            for device in devices:
-                if(self.supports_dim(device)):
-                    logging.debug("Dimming device " + str(device) + " to level " + str(dim_level))
-                    self.library.tdDim(device,dim_level)
-                else:
-                    logging.warning(str(device) + " cannot be dimmed")
-    
-    def learn(self,devices):
+        for device in devices:
+            if((dim_level < self.DIM_LEVEL_MIN) or 
+               (dim_level > self.DIM_LEVEL_MAX)):
+                self._not_sent(device, "dim level '" + str(dim_level) + 
+                               "' not valid", history_command)
+            elif(self.supports_dim(device)):
+                self.transmitter.put(device, "dim", dim_level, 
+                                     history_command)
+            else:
+                self._not_sent(device, "cannot be dimmed", history_command)
+
+    def learn(self, devices, history_command = None):
         ''' Learn one or more devices. Will try on all IDs. 
-               devices -- List of device IDs to learn       '''
+               devices -- List of device IDs to learn, see turn_on '''
         for device in devices:
             if(self.supports_learn(device)):
-                logging.debug("Send LEARN to device " + str(device))
-                self.library.tdLearn(device)
+                self.transmitter.put(device, "learn", None, history_command)
             else:
-                logging.warning(str(device) + " cannot be learned")    
+                self._not_sent(device, "cannot be learned", history_command)
+
+    def _not_sent(self, device, message, history_command):
+        logging.warning(str(device) + " " + message)
+        if(history_command != None):
+            history_command.done(device, message)
+
+    def _transmit(self, device, command, dim_level):
+        ''' Send a command to telldus-core, called by the transmit queue.
+            Returns None or the error message of telldus-core. '''
+        if(command == "on"):
+            logging.debug("Turning ON device " + str(device))
+            result = self.library.tdTurnOn(device)
+        elif(command == "off"):
+            logging.debug("Turning OFF device " + str(device))
+            result = self.library.tdTurnOff(device)
+        elif(command == "dim"):
+            logging.debug("Dimming device " + str(device) + " to level " + str(dim_level))
+            result = self.library.tdDim(device,dim_level)
+        elif(command == "learn"):
+            logging.debug("Send LEARN to device " + str(device))
+            result = self.library.tdLearn(device)
+        self._changed()
+        if(result != self.TELLSTICK_SUCCESS):
+            error = self.library.tdGetErrorString(result)
+            if(isinstance(error, bytes)):
+                error = error.decode('utf-8', 'replace')
+            return error
+        self._publish(device, command, dim_level)
+        return None
+
+    def stop(self):
+        ''' Send the queued commands and stop the transmit queue '''
+        self.transmitter.stop()
   
     def last_cmd_was_on(self, device_id):
         ''' True if last command sent to the device was on.
@@ -220,189 +683,462 @@ class TelldusLibrary:
 ###############################################################################
 # LOAD CONFIGURATION FILE HANDLING
 ###############################################################################
-def parse_LAT_LONG(line):
-    words = line.split()
-    if(len(words) != 3):
-        raise Exception("LAT_LONG must have 2 arguments\n   " + 
-                        " | ".join(words))
-    
-    lat = float(words[1])
-    long = float(words[2])
-    
-    return [lat, long]
+LatLongRecord = collections.namedtuple("LatLongRecord", "lat long")
+GroupRecord = collections.namedtuple("GroupRecord", "id name devices")
+EventRecord = collections.namedtuple("EventRecord",
+    "hour minute weekday_mask restriction function group target dim_level")
 
-def parse_EVENT_offset(s):
-    result = 0
-    offset = s.split('+')
-    if(len(offset)>1):
-        result = int(round(float(offset[1])*60,0))
-    else:
-        offset = s.split('-')
-        if(len(offset)>1):
-            result = int(round(float(offset[1])*-60,0))
-    if((result <= -(24*60)) or (result >= (24*60))):
-        raise Exception("Offset must be > -24 and < 24\n   " + s)
-    return result
-    
-def parse_EVENT(line, control_library, groups, lat_long_is_set = True):
-    hour   = 0
-    minute = 0
-    weekday =  None
-    restriction = 0
-    function = None
-    
-    words = line.split()
-    if((len(words) < 3) or (len(words) > 5)):
-        raise Exception("EVENT must have 3 - 5 arguments\n   " + 
-                        " | ".join(words))
-        
-    # Parse <time>
-    if(words[1].startswith("Sunrise")):
-        if(not lat_long_is_set):
-            raise Exception("Sunrise requires LAT_LONG to be set\n   " + line)
-        hour = TimeEvent.TIME_SUNRISE
-        minute = parse_EVENT_offset(words[1])
-    elif(words[1].startswith("Sunset")):
-        if(not lat_long_is_set):
-            raise Exception("Sunset requires LAT_LONG to be set\n   " + line)
-        hour = TimeEvent.TIME_SUNSET
-        minute = parse_EVENT_offset(words[1])
-    else:
-        time = words[1].split(":")
-        if(len(time) != 2):
-            raise Exception("time should be HH:MM\n   " + line)
-        hour = int(time[0])
-        if((hour < 0) or (hour > 24)):
-                raise Exception("hour must be 0 to 24\n   " + line)
-        minute = int(time[1])
-        if((minute < 0) or (minute > 60)):
-                raise Exception("minute must be 0 to 60\n   " + line)
-    
-    # Parse <dayofweek> 
-    word_index = 2
-    if((len(words)>3) and (words[2] != "Sunup") and (words[2] != "Sundown")):
-        weekday = [False, False, False, False, False, False, False]
-        weekday_text = ["Mon","Tue","Wen","Thu","Fri","Sat","Sun"]
-        days = words[2].split("/")
-        for day in days:
-            try:
-                weekday[weekday_text.index(day)]=True
-            except:
-                raise Exception("'" + day + "' is not a valid day\n   " + 
-                line)
-        word_index = 3
-        
-    # Parse <restriction>
-    if(len(words) == (word_index + 2)):
-        if(words[word_index]=="Sunup"):
-            if(not lat_long_is_set):
-                raise Exception("Sunup requires LAT_LONG to be set\n   " + line)
+class ConfigSyntaxError(Exception):
+    ''' Error in a configuration line. The message shows the line with a
+        marker at the column of the error. '''
+    def __init__(self, message, line, column):
+        line = line.rstrip()
+        marker = "".join(c if c == "\t" else " " for c in line[:column])
+        self.message = message
+        self.column = column + 1
+        self.detail = message + "\n   " + line + "\n   " + marker + "^"
+        Exception.__init__(self, "column " + str(self.column) + ": " +
+                           self.detail)
+
+class ConfigParser:
+    ''' Parser of the configuration file grammar described in
+        html/CONFIG_SYNTAX.md. Every line is split in tokens by one regular
+        expression and parsed in one pass over the tokens to a LatLongRecord,
+        GroupRecord or EventRecord. The token columns are only calculated
+        when an error is reported.
+
+        Well-formed EVENT lines, i.e. almost all lines of large 
+        configurations, are matched by one regular expression instead and 
+        only parsed token by token if not matching (to find the error). '''
+    TOKEN_RE = re.compile(r'"[^"]*"?|[(),]|[^\s(),"]+')
+    DAY = r'(?:Mon|Tue|Wen|Thu|Fri|Sat|Sun)'
+    EVENT_RE = re.compile(r'\s*EVENT\s+(?:(\d+):(\d+)|(Sunrise|Sunset)' +
+                          r'(?:([+-])(\d+\.?\d*|\.\d+))?)' + 
+                          r'(?:\s+(' + DAY + '(?:/' + DAY + r')*))?' + 
+                          r'(?:\s+(Sunup|Sundown))?\s+(on|off|dim)\s*\(' + 
+                          r'\s*(G?)(\d+)\s*(?:,\s*(\d+)\s*)?\)\s*$')
+    TIME_RE = re.compile(r'(\d+):(\d+)$')
+    SUN_RE = re.compile(r'(Sunrise|Sunset)(?:([+-])(\d+\.?\d*|\.\d+))?$')
+    TARGET_RE = re.compile(r'(G?)(\d+)$')
+    WEEKDAYS = {"Mon" : 0, "Tue" : 1, "Wen" : 2, "Thu" : 3, "Fri" : 4,
+                "Sat" : 5, "Sun" : 6}
+    RESTRICTIONS = ["Sunup", "Sundown"]
+    FUNCTIONS = ["on", "off", "dim"]
+
+    def __init__(self, groups = None, lat_long_is_set = False):
+        ''' groups -- Groups referred by events and checked for duplicates
+                      when defined, or None if not checked '''
+        self.groups = groups
+        self.lat_long_is_set = lat_long_is_set
+        self.weekdays = {} # Day list text -> weekday mask
+
+    def parse_line(self, line):
+        ''' Return the record of line or None for empty and comment lines.
+            Raises ConfigSyntaxError. '''
+        match = self.EVENT_RE.match(line)
+        if(match != None):
+            record = self._event_match(match)
+            if(record != None):
+                return record
+        stripped = line.lstrip()
+        if((stripped == "") or stripped.startswith("#")):
+            return None
+        tokens = self.TOKEN_RE.findall(line)
+        keyword = tokens[0]
+        if(keyword == "EVENT"):
+            return self._event(line, tokens)
+        elif(keyword == "GROUP"):
+            return self._group(line, tokens)
+        elif(keyword == "LAT_LONG"):
+            return self._lat_long(line, tokens)
+        self._error("unknown command '" + keyword + "'", line, 0)
+
+    def _event_match(self, match):
+        ''' Return the record of a line matching EVENT_RE or None if the 
+            values are not valid '''
+        (hour, minute, sun, sign, offset, days, restriction, function, 
+         group, target, dim_level) = match.groups()
+        if(hour != None):
+            hour = int(hour)
+            minute = int(minute)
+            if((hour > 24) or (minute > 60)):
+                return None
+        elif(not self.lat_long_is_set):
+            return None
+        else:
+            hour = TimeEvent.TIME_SUNRISE
+            if(sun == "Sunset"):
+                hour = TimeEvent.TIME_SUNSET
+            minute = 0
+            if(sign != None):
+                minute = int(round(float(offset) * 60, 0))
+                if(minute >= 24 * 60):
+                    return None
+                if(sign == "-"):
+                    minute = -minute
+        weekday_mask = TimeEvent.ALL_DAYS
+        if(days != None):
+            weekday_mask = self.weekdays.get(days)
+            if(weekday_mask == None):
+                weekday_mask = 0
+                for day in days.split("/"):
+                    weekday_mask |= 1 << self.WEEKDAYS[day]
+                self.weekdays[days] = weekday_mask
+        if(restriction == None):
+            restriction = TimeEvent.RESTRICTION_NONE
+        elif(not self.lat_long_is_set):
+            return None
+        elif(restriction == "Sunup"):
             restriction = TimeEvent.RESTRICTION_SUNUP
-        elif(words[word_index]=="Sundown"):
-            if(not lat_long_is_set):
-                raise Exception("Sundown requires LAT_LONG to be set\n   " + line)
-            restriction = TimeEvent.RESTRICTION_SUNDOWN 
         else:
-            raise Exception("invalid restriction. Valid values are "+ 
-            "'Sunup' or 'Sundown'\n   "    + line)
-        word_index = word_index + 1
-                    
-    # Parse <function>
-    function_name_parameter = words[word_index].split("(")
-    function_name = function_name_parameter[0]
-    function_parameters = function_name_parameter[1].strip(")").split(",")
-    if(function_parameters[0].startswith('G')):
-        # Parse <groupid>
-        groupid = int(function_parameters[0][1:])
-        group = groups.get(groupid)
-        if(group == None):
-            raise Exception("group '"+groupid+"' does not exist.\n   " 
-            + line)    
-        devices = group
-    else:
-        devices = int(function_parameters[0])
-    parameter2 = -1
-    if(len(function_parameters) == 2):
-        parameter2 = int(function_parameters[1]) 
-        
-    if(function_name == "on"):
-        function = FunctionOn(devices, control_library)
-    elif(function_name == "off"):
-        function = FunctionOff(devices, control_library)
-    elif(function_name == "dim"):
-        function = FunctionDim(devices, parameter2, control_library)
+            restriction = TimeEvent.RESTRICTION_SUNDOWN
+        group = (group == "G")
+        target = int(target)
+        if(group and (self.groups != None) and 
+           (self.groups.get(target) == None)):
+            return None
+        if(function == "dim"):
+            if(dim_level == None):
+                return None
+            dim_level = int(dim_level)
+            if((dim_level < TelldusLibrary.DIM_LEVEL_MIN) or 
+               (dim_level > TelldusLibrary.DIM_LEVEL_MAX)):
+                return None
+        elif(dim_level != None):
+            return None
+        else:
+            dim_level = -1
+        return EventRecord(hour, minute, weekday_mask, restriction, function,
+                           group, target, dim_level)
+
+    def _error(self, message, line, index, offset = 0):
+        ''' Raise ConfigSyntaxError at offset in token index (or at the end
+            of the line if there is no such token) '''
+        columns = [match.start() for match in self.TOKEN_RE.finditer(line)]
+        if(index < len(columns)):
+            column = columns[index] + offset
+        else:
+            column = len(line.rstrip())
+        raise ConfigSyntaxError(message, line, column)
+
+    def _expect(self, line, tokens, index, what):
+        if(index >= len(tokens)):
+            self._error(what + " missing", line, index)
+        return tokens[index]
+
+    def _number(self, line, tokens, index, what, minimum, maximum):
+        token = self._expect(line, tokens, index, what)
+        if(not token.isdigit()):
+            self._error(what + " must be a number", line, index)
+        value = int(token)
+        if((value < minimum) or (value > maximum)):
+            self._error(what + " must be " + str(minimum) + " to " +
+                        str(maximum), line, index)
+        return value
+
+    def _lat_long(self, line, tokens):
+        values = []
+        for index, what in [(1, "latitude"), (2, "longitude")]:
+            token = self._expect(line, tokens, index, what)
+            try:
+                values.append(float(token))
+            except ValueError:
+                self._error(what + " must be a decimal number", line, index)
+        if(len(tokens) > 3):
+            self._error("LAT_LONG must have 2 arguments", line, 3)
+        self.lat_long_is_set = True
+        return LatLongRecord(values[0], values[1])
+
+    def _group_id(self, line, tokens, index):
+        match = self.TARGET_RE.match(self._expect(line, tokens, index,
+                                                  "group id"))
+        if(match == None):
+            self._error("group id must be a number with optional prefix G",
+                        line, index)
+        return int(match.group(2))
+
+    def _group(self, line, tokens):
+        id = self._group_id(line, tokens, 1)
+        if((self.groups != None) and (self.groups.get(id) != None)):
+            self._error("group '" + str(id) + "' defined twice", line, 1)
+        name = self._expect(line, tokens, 2, "group name")
+        if((len(name) < 2) or (name[0] != '"') or (name[-1] != '"')):
+            self._error('group name missing. Must be within ""', line, 2)
+        if(len(tokens) < 4):
+            self._error("at least one device id must be given", line, 3)
+        devices = []
+        for index in range(3, len(tokens)):
+            devices.append(self._number(line, tokens, index, "device id",
+                                        0, sys.maxsize))
+        return GroupRecord(id, name[1:-1], devices)
+
+    def _time(self, line, tokens):
+        token = self._expect(line, tokens, 1, "time")
+        match = self.TIME_RE.match(token)
+        if(match != None):
+            hour = int(match.group(1))
+            if(hour > 24):
+                self._error("hour must be 0 to 24", line, 1)
+            minute = int(match.group(2))
+            if(minute > 60):
+                self._error("minute must be 0 to 60", line, 1, match.start(2))
+            return (hour, minute)
+        match = self.SUN_RE.match(token)
+        if(match == None):
+            self._error("time should be HH:MM, Sunrise or Sunset with " +
+                        "optional offset", line, 1)
+        if(not self.lat_long_is_set):
+            self._error(match.group(1) + " requires LAT_LONG to be set",
+                        line, 1)
+        hour = TimeEvent.TIME_SUNRISE
+        if(match.group(1) == "Sunset"):
+            hour = TimeEvent.TIME_SUNSET
+        minute = 0
+        if(match.group(2) != None):
+            minute = int(round(float(match.group(3)) * 60, 0))
+            if(minute >= 24 * 60):
+                self._error("offset must be > -24 and < 24", line, 1,
+                            match.start(2))
+            if(match.group(2) == "-"):
+                minute = -minute
+        return (hour, minute)
+
+    def _weekday(self, line, tokens, index):
+        weekday_mask = 0
+        offset = 0
+        for day in tokens[index].split("/"):
+            day_index = self.WEEKDAYS.get(day)
+            if(day_index == None):
+                self._error("'" + day + "' is not a valid day", line, index,
+                            offset)
+            weekday_mask |= 1 << day_index
+            offset += len(day) + 1
+        return weekday_mask
+
+    def _event(self, line, tokens):
+        hour, minute = self._time(line, tokens)
+        count = len(tokens)
+        index = 2
+        # A function name is followed by '('
+        weekday_mask = TimeEvent.ALL_DAYS
+        if((index + 1 < count) and (tokens[index + 1] != "(") and
+           (tokens[index] not in self.RESTRICTIONS)):
+            weekday_mask = self._weekday(line, tokens, index)
+            index += 1
+        restriction = TimeEvent.RESTRICTION_NONE
+        if((index + 1 < count) and (tokens[index + 1] != "(")):
+            if(tokens[index] == "Sunup"):
+                restriction = TimeEvent.RESTRICTION_SUNUP
+            elif(tokens[index] == "Sundown"):
+                restriction = TimeEvent.RESTRICTION_SUNDOWN
+            else:
+                self._error("invalid restriction. Valid values are " +
+                            "'Sunup' or 'Sundown'", line, index)
+            if(not self.lat_long_is_set):
+                self._error(tokens[index] + " requires LAT_LONG to be set",
+                            line, index)
+            index += 1
+
+        # Parse <function>(<id>[,<level>])
+        function = self._expect(line, tokens, index, "function")
+        if(function not in self.FUNCTIONS):
+            self._error("invalid function '" + function + "'", line, index)
+        if(self._expect(line, tokens, index + 1, "'('") != "("):
+            self._error("'(' expected", line, index + 1)
+        target = self._expect(line, tokens, index + 2, "device or group id")
+        match = self.TARGET_RE.match(target)
+        if(match == None):
+            self._error("invalid device or group id '" + target + "'",
+                        line, index + 2)
+        group = (match.group(1) == "G")
+        target = int(match.group(2))
+        if(group and (self.groups != None) and
+           (self.groups.get(target) == None)):
+            self._error("group '" + str(target) + "' does not exist",
+                        line, index + 2)
+        index += 3
+        dim_level = -1
+        if(function == "dim"):
+            if(self._expect(line, tokens, index, "','") != ","):
+                self._error("dim requires a level, e.g. dim(1,128)",
+                            line, index)
+            dim_level = self._number(line, tokens, index + 1, "dim level",
+                                     TelldusLibrary.DIM_LEVEL_MIN,
+                                     TelldusLibrary.DIM_LEVEL_MAX)
+            index += 2
+        if(self._expect(line, tokens, index, "')'") != ")"):
+            self._error("')' expected", line, index)
+        if(index + 1 < count):
+            self._error("unexpected '" + tokens[index + 1] + "'", line,
+                        index + 1)
+        return EventRecord(hour, minute, weekday_mask, restriction, function,
+                           group, target, dim_level)
+
+def create_event(record, control_library, groups):
+    ''' Return a TimeEvent from an EventRecord '''
+    (hour, minute, weekday_mask, restriction, function, group, target, 
+     dim_level) = record
+    if(group):
+        target = groups.get(target)
+        if(target == None):
+            raise Exception("group '" + str(record.target) +
+                            "' does not exist.")
+    if(function == "on"):
+        function = FunctionOn(target, control_library)
+    elif(function == "off"):
+        function = FunctionOff(target, control_library)
     else:
-        raise Exception("invalid function " + function_name + 
-        "\n   " +line) 
-    
-    return TimeEvent(hour, minute, weekday, restriction, function)
+        function = FunctionDim(target, dim_level, control_library)
+    return TimeEvent(hour, minute, weekday_mask, restriction, function)
+
+def parse_LAT_LONG(line):
+    record = ConfigParser().parse_line(line)
+    if(not isinstance(record, LatLongRecord)):
+        raise Exception("not a LAT_LONG line\n   " + line)
+    return [record.lat, record.long]
+
+def parse_EVENT(line, control_library, groups, lat_long_is_set = True):
+    record = ConfigParser(groups, lat_long_is_set).parse_line(line)
+    if(not isinstance(record, EventRecord)):
+        raise Exception("not an EVENT line\n   " + line)
+    return create_event(record, control_library, groups)
 
 def parse_GROUP(line):
-    name = ""
-    groupid = 0    
-    devices = []
-
-    #Parse name
-    name_split = line.split('"')
-    if(len(name_split) != 3):
-        raise Exception('group name missing. Must be within "".\n   '
-        + line)    
-    name = name_split[1]
- 
-    #Parse group id
-    id_split = name_split[0].split()
-    if(len(id_split) != 2):
-        raise Exception('group id is missing missing.\n   '
-        + line)
-    if(id_split[1].startswith('G')):
-        groupid = int(id_split[1][1:])
-    else:
-        groupid = int(id_split[1])
-
-    #Parse device id:s
-    device_split = name_split[2].split()
-    if(len(device_split) == 0):
-        raise Exception('at least one device id must be given.\n   '
-        + line)    
-    for device in device_split:
-        devices.append(int(device))
-    
-    return Group(groupid, name, devices)
-    
+    record = ConfigParser().parse_line(line)
+    if(not isinstance(record, GroupRecord)):
+        raise Exception("not a GROUP line\n   " + line)
+    return Group(record.id, record.name, record.devices)
+
 def load_config_file(filename, control_library, events, groups):
     line_nbr = 0
     lat_long = None
+    parser = ConfigParser(groups)
     try:
         fo = open(filename,"r")
     except Exception:
         raise Exception("Unable to open: " + filename + "\nUse -? for options")
     try:
         for line_nbr, line in enumerate(fo):
-            word_list = line.split()
-            if (len(word_list) > 0):
-                first_word = word_list[0]
-                if (first_word.startswith("#")):
-                    pass
-                elif (first_word == "LAT_LONG"):
-                    lat_long = parse_LAT_LONG(line)
-                elif (first_word == "EVENT"):
-                    event = parse_EVENT(line, control_library, groups, 
-                                        lat_long != None)
-                    events.append(event)
-                elif (first_word == "GROUP"):
-                    group = parse_GROUP(line)
-                    if(not groups.add(group)):
-                        raise Exception("group '" + group.id + 
-                        "' defined twice.\n   " + line)
-                else:
-                    raise Exception("unknown command '" + first_word + 
-                    "'.\n   " + line)
+            record = parser.parse_line(line)
+            if(isinstance(record, EventRecord)):
+                events.append(create_event(record, control_library, groups))
+            elif(isinstance(record, GroupRecord)):
+                groups.add(Group(record.id, record.name, record.devices))
+            elif(isinstance(record, LatLongRecord)):
+                lat_long = [record.lat, record.long]
         fo.close()
         return lat_long
+    except ConfigSyntaxError as e:
+        raise Exception("Syntax error in '" + filename + "'\n" +
+        "  Line " + str(line_nbr + 1) + ", column " + str(e.column) + ": " +
+        e.detail)
     except Exception as e:
         raise Exception("Syntax error in '" + filename + "'\n" +
         "  Line " + str(line_nbr + 1) + ": " +e.args[0])
 
+# Increase when the cache content or the parser behaviour (e.g. what is a
+# valid line) is changed, a cache from an older parser must not be used
+CONFIG_CACHE_VERSION = 3 # 2: ConfigParser (dim level and argument checks)
+                         # 3: One (key, content) object
+
+def config_cache_key(filename):
+    ''' Return the key identifying the configuration file content, the 
+        cache format and the MAS version that parsed the file. The cache is
+        only valid for an equal key. '''
+    stat = os.stat(filename)
+    fo = open(filename, "rb")
+    digest = hashlib.sha1(fo.read()).hexdigest()
+    fo.close()
+    return (CONFIG_CACHE_VERSION, __version__, sys.version_info[0], 
+            sys.version_info[1], stat.st_mtime, stat.st_size, digest)
+
+def replace_file(source, target):
+    ''' Rename source to target, replacing target if it exists '''
+    if(os.path.exists(target)):
+        os.remove(target) # Required by rename on Windows
+    os.rename(source, target)
+
+def save_config_cache(cache_file, key, lat_long, events, groups):
+    ''' Write the parsed configuration to cache_file. Events are stored as
+        tuples and refer to their group by ID. '''
+    group_list = [(group.id, group.name, list(group.devices)) 
+                  for group in groups]
+    event_list = []
+    for event in events:
+        function = event.function
+        group_id = -1
+        device = -1
+        if(function.group != None):
+            group_id = function.group.id
+        else:
+            device = function.devices[0]
+        event_list.append((event.hour, event.minute, event.weekday_mask, 
+                           event.restriction, function.NAME, group_id, 
+                           device, getattr(function, 'dim_level', -1)))
+    temp_file = cache_file + ".tmp"
+    fo = open(temp_file, "wb")
+    fo.write(marshal.dumps((key, (lat_long, group_list, event_list))))
+    fo.close()
+    replace_file(temp_file, cache_file)
+
+def load_config_cache(cache_file, key, control_library, events, groups):
+    ''' Read the configuration from cache_file into events and groups.
+        Returns (True, lat_long) or (False, None) if the cache is missing 
+        or not valid for key. '''
+    try:
+        fo = open(cache_file, "rb")
+    except IOError:
+        return (False, None)
+    try:
+        # marshal.load on a file object is much slower than loads on Python 3
+        cached = marshal.loads(fo.read())
+        if((not isinstance(cached, tuple)) or (len(cached) != 2) or
+           (cached[0] != key)):
+            return (False, None)
+        lat_long, group_list, event_list = cached[1]
+    except (EOFError, ValueError, TypeError):
+        logging.warning("Configuration cache '" + cache_file + "' is corrupt")
+        return (False, None)
+    finally:
+        fo.close()
+    functions = {FunctionOn.NAME : FunctionOn, FunctionOff.NAME : FunctionOff}
+    for id, name, devices in group_list:
+        groups.add(Group(id, name, devices))
+    for (hour, minute, weekday_mask, restriction, name, group_id, device, 
+         dim_level) in event_list:
+        if(group_id >= 0):
+            device = groups.get(group_id)
+        if(name == FunctionDim.NAME):
+            function = FunctionDim(device, dim_level, control_library)
+        else:
+            function = functions[name](device, control_library)
+        events.append(TimeEvent(hour, minute, weekday_mask, restriction, 
+                                function))
+    return (True, lat_long)
+
+def load_config(filename, control_library, events, groups, cache_file = None):
+    ''' Load the configuration file, from cache_file if the cache is valid. 
+        Otherwise the configuration file is parsed and the cache written. '''
+    if(cache_file == None):
+        return load_config_file(filename, control_library, events, groups)
+    try:
+        key = config_cache_key(filename)
+    except (IOError, OSError):
+        key = None # Reported by load_config_file
+    if(key != None):
+        found, lat_long = load_config_cache(cache_file, key, control_library, 
+                                            events, groups)
+        if(found):
+            logging.debug("Configuration loaded from " + cache_file)
+            return lat_long
+    lat_long = load_config_file(filename, control_library, events, groups)
+    if(key != None):
+        try:
+            save_config_cache(cache_file, key, lat_long, events, groups)
+        except (IOError, OSError) as e:
+            logging.warning("Unable to write configuration cache: " + str(e))
+    return lat_long
+
 ###############################################################################
 # GROUP
 ###############################################################################        
@@ -413,112 +1149,562 @@ class Group:
         self.devices = devices
 
 class Groups:
+    ''' The groups keyed by group ID, in the order they were added, and an 
+        index from device ID to the groups containing the device. '''
     def __init__(self):
-        self.groups = []
+        self.groups = collections.OrderedDict()
+        self.device_groups = {} # Device ID -> List of groups
     def add(self, group):
-        for g in self.groups:
-            if (g.id == group.id):
-                return False
-        self.groups.append(group)
+        if (group.id in self.groups):
+            return False
+        self.groups[group.id] = group
+        for device in set(group.devices):
+            self.device_groups.setdefault(device, []).append(group)
         return True
     def get(self, id):
-        for group in self.groups:
-            if (group.id == id):
-                return group
-        return None
+        return self.groups.get(id)
+    def with_device(self, device):
+        ''' Return the groups containing the device '''
+        return list(self.device_groups.get(device, []))
+    def __iter__(self):
+        return iter(list(self.groups.values()))
+    def __len__(self):
+        return len(self.groups)
+    def changes(self, old):
+        ''' Return the IDs of the groups added, removed and changed 
+            compared to the Groups old '''
+        result = {'added' : [], 'removed' : [], 'changed' : []}
+        for group in self:
+            old_group = old.get(group.id)
+            if(old_group == None):
+                result['added'].append(group.id)
+            elif((old_group.name != group.name) or 
+                 (old_group.devices != group.devices)):
+                result['changed'].append(group.id)
+        for group in old:
+            if(self.get(group.id) == None):
+                result['removed'].append(group.id)
+        return result
         
 ###############################################################################
 # FUNCTIONS
 ###############################################################################        
+_device_tuples = {} # Interned device tuples shared by the functions
+
+def device_tuple(devices):
+    ''' Return the shared tuple equal to the device IDs in devices '''
+    devices = tuple(devices)
+    return _device_tuples.setdefault(devices, devices)
+
 class FunctionBase(object):
-    devices = 0
-    control_library = None
+    NAME = None
+    __slots__ = ("devices",         # Tuple of device IDs, see device_tuple
+                 "group",           # Group if the function controls a group
+                 "control_library")
     def __init__(self, device_or_group, control_library):
         if(isinstance(device_or_group,Group)):
-            self.devices = device_or_group.devices
+            self.devices = device_tuple(device_or_group.devices)
+            self.group = device_or_group
         else:
-            self.devices = [device_or_group]
+            self.devices = device_tuple((device_or_group,))
+            self.group = None
         self.control_library = control_library
+    def execute(self):
+        self.execute_on(self.devices)
+    def key(self):
+        ''' Tuple identifying what the function does and the group it is
+            reported as '''
+        group = None
+        if(self.group != None):
+            group = (self.group.id, self.group.name)
+        return (self.NAME, self.devices, group)
         
 class FunctionOn(FunctionBase):        
-    def execute(self):
-        self.control_library.turn_on(self.devices)
+    NAME = "on"
+    __slots__ = ()
+    def execute_on(self, devices, history_command = None):
+        self.control_library.turn_on(devices, history_command)
 
 class FunctionOff(FunctionBase):        
-    def execute(self):
-        self.control_library.turn_off(self.devices)        
+    NAME = "off"
+    __slots__ = ()
+    def execute_on(self, devices, history_command = None):
+        self.control_library.turn_off(devices, history_command)        
 
 class FunctionDim(FunctionBase):
-    dim_level = 0
+    NAME = "dim"
+    __slots__ = ("dim_level",)
     def __init__(self, device_or_group, dim_level, control_library):
         self.dim_level = dim_level
         super(FunctionDim, self).__init__(device_or_group, control_library)
-    def execute(self):
-        self.control_library.dim(self.devices, self.dim_level)        
+    def execute_on(self, devices, history_command = None):
+        self.control_library.dim(devices, self.dim_level, history_command)        
+    def key(self):
+        return super(FunctionDim, self).key() + (self.dim_level,)
         
 ###############################################################################
 # TIMER HANDLING
 ###############################################################################
+class EventExecutor:
+    ''' Executes fired events in a pool of worker threads so that the timer
+        thread never blocks on the hardware. The commands of an event are 
+        split per device and all commands to the same device are handled by
+        the same worker, i.e. they are executed in the order they fired. '''
+    DEFAULT_WORKERS = 4
+    QUEUE_SIZE = 1000 # Max number of pending commands per worker
+
+    def __init__(self, workers = DEFAULT_WORKERS, history = None):
+        self.history = history # History where executed commands are added
+        self.queues = []
+        self.threads = []
+        for i in range(workers):
+            work_queue = queue.Queue(self.QUEUE_SIZE)
+            thread = threading.Thread(target = self._work, 
+                                      args = (work_queue,))
+            thread.daemon = True
+            thread.start()
+            self.queues.append(work_queue)
+            self.threads.append(thread)
+
+    def submit(self, event):
+        function = event.function
+        history_command = None
+        if(self.history != None):
+            # One record for all devices of the event
+            group = None
+            if(function.group != None):
+                group = function.group.id
+            history_command = HistoryCommand(self.history, "timer", 
+                function.devices, function.NAME, 
+                getattr(function, "dim_level", None), group)
+        for device in function.devices:
+            work_queue = self.queues[device % len(self.queues)]
+            try:
+                work_queue.put_nowait((function, [device], history_command))
+            except queue.Full:
+                logging.error("Event queue full, command to device " + 
+                              str(device) + " dropped")
+                if(history_command != None):
+                    history_command.done(device, "event queue full")
+
+    def _work(self, work_queue):
+        while True:
+            item = work_queue.get()
+            if(item == None):
+                break
+            function, devices, history_command = item
+            try:
+                function.execute_on(devices, history_command)
+            except Exception as e:
+                logging.error("Failed to execute event on device " + 
+                              str(devices[0]) + ": " + str(e))
+                if(history_command != None):
+                    history_command.done(devices[0], str(e))
+
+    def stop(self):
+        for work_queue in self.queues:
+            work_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+class EventTable:
+    ''' The events as parallel arrays (columns) so that the events firing
+        at each minute are found by vectorized operations over the table.
+        Uses NumPy when available and the array module otherwise. Row n of
+        the table is event n of the event list. '''
+    NEVER = -1 # Minute of day of events not firing at a fixed time
+    MINUTES_PER_DAY = 24 * 60
+
+    def __init__(self, events):
+        self.events = events
+        self.hour = self._column([event.hour for event in events])
+        self.minute = self._column([event.minute for event in events])
+        self.weekday_mask = self._column([event.weekday_mask
+                                          for event in events])
+        self.restriction = self._column([event.restriction
+                                         for event in events])
+        # Minute of day of the fixed time events
+        self.fixed = self._column([
+            (event.hour * 60 + event.minute)
+            if((0 <= event.hour <= 23) and (event.minute <= 59))
+            else self.NEVER for event in events])
+        # Rows of the sunrise and sunset events
+        self.sun_rows = self._column([row for row, event in enumerate(events)
+                                      if(event.hour < 0)])
+
+    def __len__(self):
+        return len(self.events)
+
+    def _column(self, values):
+        if(numpy is not None):
+            return numpy.array(values, dtype=numpy.int32)
+        return array.array('i', values)
+
+    def _rows_on(self, rows, weekday):
+        ''' Return the rows in rows (a column) firing on weekday as list '''
+        if(numpy is not None):
+            return rows[((self.weekday_mask[rows] >> weekday) & 1) == 1
+                        ].tolist()
+        return [row for row in rows
+                if((self.weekday_mask[row] >> weekday) & 1)]
+
+    def _values(self, column, rows):
+        ''' Return the values of column in rows (a list) as list '''
+        if(numpy is not None):
+            return column[rows].tolist()
+        return [column[row] for row in rows]
+
+    def fixed_index(self):
+        ''' Return a dictionary from minute of week (0 - 10079, 0 is Monday
+            00:00) to the rows of the fixed time events firing then '''
+        index = {}
+        if(numpy is not None):
+            fixed_rows = numpy.nonzero(self.fixed != self.NEVER)[0]
+        else:
+            fixed_rows = [row for row, minute in enumerate(self.fixed)
+                          if(minute != self.NEVER)]
+        for weekday in range(7):
+            first = weekday * self.MINUTES_PER_DAY
+            rows = self._rows_on(fixed_rows, weekday)
+            for row, minute in zip(rows, self._values(self.fixed, rows)):
+                index.setdefault(first + minute, []).append(row)
+        return index
+
+    def sun_index(self, weekday, sunrise, sunset):
+        ''' Return a dictionary from minute of day to the rows of the
+            sunrise and sunset events firing then on a day.
+               weekday         -- Day of week of the day, 0 is Monday
+               sunrise, sunset -- datetime.time of the day or None '''
+        index = {}
+        if((sunrise == None) or (sunset == None)):
+            return index
+        rise = sunrise.hour * 60 + sunrise.minute
+        fall = sunset.hour * 60 + sunset.minute
+        rows = self._rows_on(self.sun_rows, weekday)
+        if(numpy is not None):
+            selected = numpy.array(rows, dtype=numpy.int32)
+            minutes = (numpy.where(self.hour[selected] ==
+                                   TimeEvent.TIME_SUNRISE, rise, fall) +
+                       self.minute[selected]) % self.MINUTES_PER_DAY
+            minutes = minutes.tolist()
+        else:
+            minutes = [((rise if(self.hour[row] == TimeEvent.TIME_SUNRISE)
+                         else fall) + self.minute[row]) % self.MINUTES_PER_DAY
+                       for row in rows]
+        for row, minute in zip(rows, minutes):
+            index.setdefault(minute, []).append(row)
+        return index
+
+class EventScheduler:
+    ''' Finds the events firing at a minute by dictionary lookups. The
+        fixed time events are indexed by minute of week when the events
+        are scheduled (i.e. on configuration reload). The sunrise and
+        sunset events are indexed by minute of day once per day, when the
+        sun times of the day are known.
+
+        Events missed because the timer thread was delayed (slow execution,
+        host suspend etc.) are replayed if they are not older than the
+        catch-up window. Older events are skipped, they are counted without
+        evaluating every minute and logged in one warning. '''
+    LATE = timedelta(minutes = 1) # Events older than this are replayed late
+    DEFAULT_CATCH_UP_MINUTES = 10
+    MINUTE = timedelta(minutes = 1)
+    WEEK_MINUTES = 7 * EventTable.MINUTES_PER_DAY
+
+    def __init__(self, catch_up_minutes = DEFAULT_CATCH_UP_MINUTES):
+        self.catch_up = max(timedelta(minutes = catch_up_minutes), self.LATE)
+        self.sun = None
+        self.table = EventTable([])
+        self.fixed = {} # Minute of week -> rows of fixed time events
+        self.fixed_minutes = [] # Sorted keys of fixed
+        self.fixed_counts = [0] # Number of rows before each key, and total
+        # date -> (index, sorted keys), days before last are removed
+        self.days = {}
+        self.last = None # Events up to this datetime are evaluated
+        self.replayed_count = 0 # Number of events replayed late
+        self.replayed_delay_max = timedelta(0)
+        self.replayed_delay_total = timedelta(0)
+        self.skipped_count = 0 # Number of events older than catch-up window
+
+    def schedule(self, event_list, sun, after):
+        ''' Replace the scheduled events.
+            event_list -- List of TimeEvent in configuration order
+            sun        -- sunstate.Sun object or None if LAT_LONG not set
+            after      -- Only fire times after this datetime are scheduled '''
+        self.sun = sun
+        self.table = EventTable(event_list)
+        self.fixed = self.table.fixed_index()
+        self.fixed_minutes = sorted(self.fixed)
+        self.fixed_counts = [0]
+        for minute in self.fixed_minutes:
+            self.fixed_counts.append(self.fixed_counts[-1] + 
+                                     len(self.fixed[minute]))
+        self.days.clear()
+        self.last = after
+
+    def sun_times(self, day):
+        ''' Return (sunrise, sunset) as datetime.time objects for day '''
+        if(self.sun == None):
+            return (None, None)
+        return self.sun.suntimes(day)[0:2]
+
+    def sun_index(self, day):
+        ''' Return (index, sorted minutes) of the sun events on day. Built
+            once per day, kept until the day is passed. '''
+        result = self.days.get(day)
+        if(result == None):
+            sunrise_time, sunset_time = self.sun_times(day)
+            index = self.table.sun_index(day.weekday(), sunrise_time,
+                                         sunset_time)
+            result = (index, sorted(index))
+            if(self.last != None):
+                for cached in [cached for cached in self.days 
+                               if(cached < self.last.date())]:
+                    del self.days[cached]
+            self.days[day] = result
+        return result
+
+    def rows_at(self, fire_time):
+        ''' Return the rows of the events firing at fire_time (a whole
+            minute), in configuration order. Restrictions not considered. '''
+        minute = fire_time.hour * 60 + fire_time.minute
+        rows = self.fixed.get(fire_time.weekday() *
+                              EventTable.MINUTES_PER_DAY + minute)
+        sun_rows = self.sun_index(fire_time.date())[0].get(minute)
+        if(sun_rows == None):
+            return rows or []
+        elif(rows == None):
+            return sun_rows
+        return sorted(rows + sun_rows)
+
+    def next_time(self):
+        ''' Return the datetime of the earliest scheduled event or None.
+            Restrictions are not considered. '''
+        if(self.last == None):
+            return None
+        start = self.last.replace(second = 0, microsecond = 0)
+        result = None
+        if(len(self.fixed_minutes) > 0):
+            minute = (start.weekday() * EventTable.MINUTES_PER_DAY +
+                      start.hour * 60 + start.minute)
+            position = bisect.bisect_right(self.fixed_minutes, minute)
+            if(position < len(self.fixed_minutes)):
+                delta = self.fixed_minutes[position] - minute
+            else:
+                delta = self.fixed_minutes[0] + self.WEEK_MINUTES - minute
+            result = start + timedelta(minutes = delta)
+        if(len(self.table.sun_rows) == 0):
+            return result
+        minute = start.hour * 60 + start.minute
+        for days in range(TimeEvent.MAX_DAYS_AHEAD):
+            day = start.date() + timedelta(days = days)
+            if((result != None) and (day > result.date())):
+                break
+            minutes = self.sun_index(day)[1]
+            position = bisect.bisect_right(minutes, minute)
+            if(position < len(minutes)):
+                sun_time = datetime(day.year, day.month, day.day) + \
+                           timedelta(minutes = minutes[position])
+                if((result == None) or (sun_time < result)):
+                    result = sun_time
+                break
+            minute = EventTable.NEVER
+        return result
+
+    def pop_due(self, now):
+        ''' Return the events (in configuration order for events with the
+            same fire time) that fired after the previous evaluation and
+            not after now. '''
+        fired = []
+        if(self.last == None):
+            self.last = now
+        fire_time = self.last.replace(second = 0, microsecond = 0) + \
+                    self.MINUTE
+        if(fire_time <= now - self.catch_up):
+            skip_last = (now - self.catch_up).replace(second = 0, 
+                                                      microsecond = 0)
+            skipped = self.count_between(fire_time, skip_last)
+            if(skipped > 0):
+                self.skipped_count += skipped
+                logging.warning(str(skipped) + " events scheduled from " + 
+                                str(fire_time) + " to " + str(skip_last) + 
+                                " skipped (too late)")
+            fire_time = skip_last + self.MINUTE
+        while(fire_time <= now):
+            delay = now - fire_time
+            for row in self.rows_at(fire_time):
+                event = self.table.events[row]
+                if(event.restriction != TimeEvent.RESTRICTION_NONE):
+                    sunrise_time, sunset_time = self.sun_times(
+                        fire_time.date())
+                    if(not event.restriction_match(fire_time.time(),
+                                                   sunrise_time,
+                                                   sunset_time)):
+                        continue
+                fired.append(event)
+                if(delay >= self.LATE):
+                    self._replayed(fire_time, delay)
+            fire_time += self.MINUTE
+        self.last = max(self.last, now)
+        return fired
+
+    def count_between(self, first, last):
+        ''' Return the number of times events fire from first to last (whole
+            minutes). Restrictions are not considered. '''
+        count = 0
+        day = first.date()
+        while(day <= last.date()):
+            start = 0
+            if(day == first.date()):
+                start = first.hour * 60 + first.minute
+            end = EventTable.MINUTES_PER_DAY - 1
+            if(day == last.date()):
+                end = last.hour * 60 + last.minute
+            week_minute = day.weekday() * EventTable.MINUTES_PER_DAY
+            count += (self.fixed_counts[bisect.bisect_right(
+                          self.fixed_minutes, week_minute + end)] -
+                      self.fixed_counts[bisect.bisect_left(
+                          self.fixed_minutes, week_minute + start)])
+            if(len(self.table.sun_rows) > 0):
+                # Not cached, the days before now are not needed again
+                index = self.table.sun_index(day.weekday(), 
+                                             *self.sun_times(day))
+                count += sum(len(rows) for minute, rows in index.items()
+                             if(start <= minute <= end))
+            day += timedelta(days = 1)
+        return count
+
+    def _replayed(self, fire_time, delay):
+        self.replayed_count += 1
+        self.replayed_delay_total += delay
+        self.replayed_delay_max = max(self.replayed_delay_max, delay)
+        logging.warning("Event scheduled at " + str(fire_time) +
+                        " replayed " + str(int(delay.total_seconds())) +
+                        " seconds late")
+
 class TimerThread(threading.Thread):
-    
-    def __init__(self, event_list, sun):
+    MAX_SLEEP_SECONDS = 60 # Limit sleep to detect changes of system time
+
+    def __init__(self, event_list, sun, 
+                 workers = EventExecutor.DEFAULT_WORKERS,
+                 catch_up_minutes = EventScheduler.DEFAULT_CATCH_UP_MINUTES,
+                 hub = None, history = None):
         threading.Thread.__init__(self)
         self.run_event = threading.Event() # Used to order thread stop run
+        self.wake_event = threading.Event() # Used to wake thread from sleep
         self.semaphore = threading.Semaphore() # Used to block thread from run
         self.event_list = event_list
         self.sun = sun
-        self.last_date = None
+        self.changed = True # Schedule must be rebuilt
+        self.scheduler = EventScheduler(catch_up_minutes)
+        self.last_time = None # Last evaluated point in time
+        self.executor = EventExecutor(workers, history)
+        self.hub = hub # EventHub where fired events are published or None
     
     def change_data(self, event_list, sun):
+        ''' Replace the events and sun. Events equal to a current event 
+            keep their current TimeEvent object, the event table is rebuilt.
+            Returns a dictionary with the number of events added, removed 
+            and unchanged. '''
         self.semaphore.acquire()
+        if((sun != None) and (self.sun != None) and 
+           (sun.lat == self.sun.lat) and (sun.long == self.sun.long)):
+            sun = self.sun # Keep the cached sun times
+        event_list, added, removed = diff_events(self.event_list, event_list)
+        if(not self.changed):
+            self.scheduler.schedule(event_list, sun, self.last_time)
         self.event_list = event_list
         self.sun = sun
-        self.last_date = None # Force recalculation of sunset and sunrise
         self.semaphore.release()
+        self.wake_event.set()
+        return {'added'     : added,
+                'removed'   : removed,
+                'unchanged' : len(event_list) - added}
         
     def run(self):
-        sunrise_time = None
-        sunset_time = None
         while not self.run_event.is_set():
             self.semaphore.acquire()
             
-            dt = datetime.now()
-            # Only recalculate sunset and sunrise once a day
-            if ((self.last_date != dt.date()) and (self.sun != None)):
-                sunrise_time = self.sun.sunrise()
-                sunset_time = self.sun.sunset()
-                self.last_date = dt.date()
+            now = datetime.now()
+            if(self.changed):
+                # Events missed since last evaluation will be caught up
+                after = self.last_time
+                if(after == None):
+                    # Events in the current minute shall be fired at start
+                    after = (now.replace(second = 0, microsecond = 0) - 
+                             timedelta(microseconds = 1))
+                self.scheduler.schedule(self.event_list, self.sun, after)
+                self.changed = False
                 
-            for event in self.event_list:
-                if(event.time_match(dt, sunrise_time, sunset_time)):
-                    event.execute()
+            for event in self.scheduler.pop_due(now):
+                self.executor.submit(event)
+                if(self.hub != None):
+                    self.hub.publish('fired', {
+                        'function' : event.function.NAME,
+                        'devices'  : event.function.devices})
+            self.last_time = now
+            next_time = self.scheduler.next_time()
                     
             self.semaphore.release()
-            self.run_event.wait(60 - dt.second + 2)
+            
+            timeout = self.MAX_SLEEP_SECONDS
+            if(next_time != None):
+                seconds = (next_time - datetime.now()).total_seconds()
+                timeout = min(max(seconds, 0), self.MAX_SLEEP_SECONDS)
+            self.wake_event.wait(timeout)
+            self.wake_event.clear()
 
     def stop(self):
         self.run_event.set()
+        self.wake_event.set()
         self.join()
+        self.executor.stop()
+
+def diff_events(old_list, new_list):
+    ''' Match the events in new_list with equal events in old_list. Returns
+        (event_list, added, removed) where event_list is new_list with the 
+        matched events replaced by the events in old_list. '''
+    unmatched = {}
+    for event in old_list:
+        unmatched.setdefault(event.key(), collections.deque()).append(event)
+    event_list = []
+    added = 0
+    for event in new_list:
+        equal = unmatched.get(event.key())
+        if(equal):
+            event_list.append(equal.popleft())
+        else:
+            event_list.append(event)
+            added += 1
+    return (event_list, added, len(old_list) - (len(event_list) - added))
 
-class TimeEvent:
+class TimeEvent(object):
+    ''' A configured EVENT. Uses __slots__ and a weekday bit mask since 
+        generated configurations may have very many events. '''
     TIME_SUNRISE = -1
     TIME_SUNSET  = -2
-    hour    = 0 # Might be TIME_SUNRISE or TIME_SUNSET
-    minute  = 0 # Total offset in minutes if TIME_SUNSET or TIME_SUNRISE
-    weekday = [True, True, True, True, True, True, True]    
+    MAX_DAYS_AHEAD = 8
+    ALL_DAYS = 0x7F # Bit 0 (Monday) to 6 (Sunday)
     RESTRICTION_NONE    = 0
     RESTRICTION_SUNDOWN = 1
     RESTRICTION_SUNUP   = 2    
-    restriction = 0
-    function = None
+    __slots__ = ("hour",         # Might be TIME_SUNRISE or TIME_SUNSET
+                 "minute",       # Offset in minutes if TIME_SUNSET/SUNRISE
+                 "weekday_mask", # Bit n set if the event fires on weekday n
+                 "restriction",
+                 "function")
     
-    def __init__(self, hour, minute, weekday, restriction, function):
+    def __init__(self, hour, minute, weekday_mask, restriction, function):
         self.hour = hour
         self.minute = minute
-        if(weekday != None):
-            self.weekday = weekday
+        self.weekday_mask = weekday_mask
         self.restriction = restriction
         self.function = function
+
+    @property
+    def weekday(self):
+        ''' List of 7 booleans, True if the event fires on the weekday '''
+        return [((self.weekday_mask >> day) & 1) == 1 for day in range(7)]
             
     def time_match_with_offset(self, dt, hour, minute):
         dt_trig = (datetime(dt.year,dt.month,dt.day,hour,minute) + 
@@ -540,22 +1726,556 @@ class TimeEvent:
         
         # Check day of week
         if(match):
-            match = self.weekday[dt.weekday()]
+            match = ((self.weekday_mask >> dt.weekday()) & 1) == 1
             
         # Check restriction
-        if(match and (self.restriction == self.RESTRICTION_SUNUP)):
-            match = ((dt.time() > sunrise_time) and (dt.time() < sunset_time)) 
-        elif(match and (self.restriction == self.RESTRICTION_SUNDOWN)):
-            match = ((dt.time() < sunrise_time) or (dt.time() > sunset_time))    
+        if(match):
+            match = self.restriction_match(dt.time(), sunrise_time, 
+                                           sunset_time)
             
         return match
-        
+
+    def restriction_match(self, t, sunrise_time, sunset_time):
+        ''' True if the time of day t fulfills the restriction '''
+        if(self.restriction == self.RESTRICTION_SUNUP):
+            return ((t > sunrise_time) and (t < sunset_time)) 
+        elif(self.restriction == self.RESTRICTION_SUNDOWN):
+            return ((t < sunrise_time) or (t > sunset_time))    
+        return True
+
+    def key(self):
+        ''' Tuple identifying the event, equal for equal configurations
+            (including the ID and name of the group) '''
+        return ((self.hour, self.minute, self.weekday_mask, 
+                 self.restriction) + self.function.key())
+
     def execute(self):
         self.function.execute()
 
+###############################################################################
+# CONFIGURATION
+###############################################################################
+class Configuration:
+    ''' The running configuration. A new configuration is parsed (validated)
+        by the caller and then swapped in by apply, i.e. the timer thread
+        runs on the old configuration until the new one is complete. '''
+    def __init__(self, config_file, control, groups, timer_thread, hub = None,
+                 cache_file = None):
+        self.file = config_file
+        self.cache_file = cache_file # Cache of the parsed configuration
+        self.control = control
+        self.groups = groups
+        self.timer_thread = timer_thread
+        self.hub = hub # EventHub where configuration changes are published
+        self.version = 0 # Increased when the configuration is replaced
+        self.lock = threading.Lock() # Serializes apply
+        # Held while the file is written and applied, or reloaded, so the 
+        # file is not applied again by reload_if_changed
+        self.file_lock = threading.Lock()
+        self.stamp = self.file_stamp() # File stamp of applied configuration
+
+    def file_stamp(self):
+        ''' Return (mtime, size) of the configuration file or None '''
+        try:
+            stat = os.stat(self.file)
+            return (stat.st_mtime, stat.st_size)
+        except OSError:
+            return None
+
+    def load(self, file_name = None):
+        ''' Parse a configuration file (default the configuration file).
+            Returns (events, groups, lat_long), raises Exception if the
+            file is not valid. '''
+        events = []
+        groups = Groups()
+        if(file_name == None):
+            lat_long = load_config(self.file, self.control, events, groups,
+                                   self.cache_file)
+        else:
+            lat_long = load_config_file(file_name, self.control, events, 
+                                        groups)
+        return (events, groups, lat_long)
+
+    def apply(self, events, groups, lat_long, stamp = None):
+        ''' Replace the running configuration, returns the changes.
+               stamp -- File stamp of the applied file (default current) '''
+        sun = None
+        if(lat_long != None):
+            sun = sunstate.Sun(lat_long[0], lat_long[1], sunstate.LocalTimezone())
+        with self.lock:
+            changes = {'events' : self.timer_thread.change_data(events, sun),
+                       'groups' : groups.changes(self.groups)}
+            self.groups = groups
+            self.version += 1
+            self.stamp = stamp or self.file_stamp()
+        logging.info("Configuration updated: " + json.dumps(changes))
+        if(self.hub != None):
+            self.hub.publish('config', {'groups_version' : self.version})
+        return changes
+
+    def reload_if_changed(self):
+        ''' Load and apply the configuration file if it is changed since it
+            was applied. Returns the changes or None. '''
+        with self.file_lock:
+            stamp = self.file_stamp()
+            if((stamp == None) or (stamp == self.stamp)):
+                return None
+            try:
+                events, groups, lat_long = self.load()
+            except Exception as e:
+                # Keep the running configuration until the file is corrected
+                self.stamp = stamp
+                logging.error("Configuration not reloaded: " + 
+                              str(e.args[0]))
+                return None
+            return self.apply(events, groups, lat_long, stamp)
+
+class Inotify:
+    ''' Watches a directory with the Linux inotify API through ctypes.
+        Raises OSError (or AttributeError) if inotify is not available. '''
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO    = 0x080
+    IN_CREATE      = 0x100
+    IN_DELETE      = 0x200
+    EVENT_HEADER   = struct.Struct("iIII") # wd, mask, cookie, len
+
+    def __init__(self, directory):
+        libc = CDLL(util.find_library("c"), use_errno = True)
+        self.fd = libc.inotify_init()
+        if(self.fd < 0):
+            raise OSError(get_errno(), "inotify_init failed")
+        mask = (self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE |
+                self.IN_DELETE)
+        if(libc.inotify_add_watch(self.fd, directory.encode(), mask) < 0):
+            os.close(self.fd)
+            raise OSError(get_errno(), "inotify_add_watch failed")
+
+    def wait(self, timeout):
+        ''' Wait for changes, returns the names of the changed files '''
+        readable = select.select([self.fd], [], [], timeout)[0]
+        if(len(readable) == 0):
+            return []
+        data = os.read(self.fd, 4096)
+        names = []
+        offset = 0
+        while(offset < len(data)):
+            wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data,
+                                                                     offset)
+            offset += self.EVENT_HEADER.size
+            names.append(data[offset:offset + length].rstrip(b"\0").decode())
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+class ConfigWatcher(threading.Thread):
+    ''' Reloads the configuration when the configuration file is changed.
+        Uses inotify on Linux and polls the file stamp elsewhere. The
+        file is parsed in this thread, not in the timer thread. '''
+    POLL_SECONDS = 2
+    SETTLE_SECONDS = 0.5 # Wait for more changes (e.g. editor saving)
+
+    def __init__(self, config, use_inotify = True):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.config = config
+        self.run_event = threading.Event() # Used to order thread stop run
+        self.inotify = None
+        if(use_inotify):
+            try:
+                directory = os.path.dirname(os.path.abspath(config.file))
+                self.inotify = Inotify(directory)
+            except (OSError, AttributeError, TypeError):
+                pass # Not Linux, fall back to polling
+        logging.info("Watching " + config.file +
+                     (" with inotify" if self.inotify else " by polling"))
+
+    def run(self):
+        name = os.path.basename(self.config.file)
+        while not self.run_event.is_set():
+            if(self.inotify != None):
+                if(name not in self.inotify.wait(self.POLL_SECONDS)):
+                    continue
+                while(len(self.inotify.wait(self.SETTLE_SECONDS)) > 0):
+                    pass
+            else:
+                self.run_event.wait(self.POLL_SECONDS)
+            self.config.reload_if_changed()
+        if(self.inotify != None):
+            self.inotify.close()
+
+    def stop(self):
+        self.run_event.set()
+        self.join()
+
+###############################################################################
+# LOG
+###############################################################################
+def rotated_log_file(log_file, number):
+    ''' Return the name of rotated log number (1 is the newest) '''
+    return log_file + "." + str(number) + ".gz"
+
+class LogWriter(logging.Handler):
+    ''' Logging handler writing the log file in a background thread, so
+        logging never waits for the file system. The log file is rotated
+        when it is larger than max_bytes or older than rotate_seconds (0
+        disables either) and the rotated logs are compressed with gzip.
+        If the queue is full the entry is dropped and counted. '''
+    QUEUE_SIZE = 10000
+    DEFAULT_MAX_KBYTES = 1024
+    DEFAULT_BACKUP_COUNT = 5
+
+    def __init__(self, file_name, max_bytes = DEFAULT_MAX_KBYTES * 1024,
+                 rotate_seconds = 0, backup_count = DEFAULT_BACKUP_COUNT):
+        logging.Handler.__init__(self)
+        self.file = file_name
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backup_count = backup_count # Number of rotated logs kept
+        self.queue = queue.Queue(self.QUEUE_SIZE) # Formatted entries
+        self.dropped = 0 # Entries dropped since last write, handler lock
+        self.fo = None
+        self.opened = None # time.time() when the log file was rotated
+        self.thread = threading.Thread(target = self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        try:
+            text = self.format(record) + "\n"
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            self.queue.put_nowait(text)
+        except queue.Full:
+            self.acquire() # Reentrant, already held when called by handle
+            try:
+                self.dropped += 1
+            finally:
+                self.release()
+
+    def flush(self):
+        ''' Wait until the queued entries are written '''
+        if(self.thread.is_alive()):
+            self.queue.join()
+
+    def close(self):
+        if(self.thread.is_alive()):
+            self.queue.put(None)
+            self.thread.join()
+        logging.Handler.close(self)
+
+    def _run(self):
+        running = True
+        while running:
+            entries = [self.queue.get()]
+            # Write all queued entries at once
+            try:
+                while True:
+                    entries.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            running = (None not in entries)
+            try:
+                self._write([text for text in entries if text != None])
+            except Exception as e:
+                sys.stderr.write("Unable to write " + self.file + ": " +
+                                 str(e) + "\n")
+            for text in entries:
+                self.queue.task_done()
+        if(self.fo != None):
+            self.fo.close()
+
+    def _write(self, entries):
+        self.acquire()
+        try:
+            dropped = self.dropped
+            self.dropped = 0
+        finally:
+            self.release()
+        if(dropped > 0):
+            entries.insert(0, self.format(logging.makeLogRecord({
+                'levelno' : logging.WARNING, 'levelname' : 'WARNING',
+                'msg' : str(dropped) + " log entries dropped"})) + "\n")
+        if(self.fo == None):
+            self.fo = open(self.file, "a")
+            self.opened = time.time()
+        self.fo.write("".join(entries))
+        self.fo.flush()
+        # The size of the file since the log may be deleted by the WebAPI
+        if(((self.max_bytes > 0) and 
+            (os.fstat(self.fo.fileno()).st_size >= self.max_bytes)) or
+           ((self.rotate_seconds > 0) and 
+            (time.time() - self.opened >= self.rotate_seconds))):
+            self._rotate()
+
+    def _rotate(self):
+        self.fo.close()
+        self.fo = None
+        if(self.backup_count < 1):
+            os.remove(self.file)
+            return
+        for number in range(self.backup_count - 1, 0, -1):
+            name = rotated_log_file(self.file, number)
+            if(os.path.exists(name)):
+                replace_file(name, rotated_log_file(self.file, number + 1))
+        # Compress after the log file is replaced to not block readers
+        replace_file(self.file, self.file + ".1")
+        self.fo = open(self.file, "a")
+        self.opened = time.time()
+        with open(self.file + ".1", "rb") as source:
+            target = gzip.open(rotated_log_file(self.file, 1), "wb")
+            shutil.copyfileobj(source, target)
+            target.close()
+        os.remove(self.file + ".1")
+
+class LogReader:
+    ''' Reads the log file backwards from the end in fixed-size blocks, so
+        reading a page of the log costs in proportion to the entries
+        returned and not to the size of the file. The rotated logs written
+        by LogWriter are read (decompressed) when the page continues past
+        the start of the log file. An entry is a line in the format set up
+        by main and the continuation lines following it (e.g. of a
+        multi-line syntax error). A position (cursor) is (log, offset)
+        where log is 0 for the log file and n for rotated log n, and offset
+        is the byte offset of an entry in the log. '''
+    BLOCK_SIZE = 8192
+    ENTRY_RE = re.compile(
+        br"\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d+ - ([A-Z]+) - ")
+    LEVELS = {"DEBUG" : logging.DEBUG, "INFO" : logging.INFO,
+              "WARNING" : logging.WARNING, "ERROR" : logging.ERROR,
+              "CRITICAL" : logging.CRITICAL}
+
+    def __init__(self, file_name):
+        self.file = file_name
+
+    @staticmethod
+    def position(text):
+        ''' Return the position of "log:offset" or "offset" (log 0).
+            Raises ValueError. '''
+        parts = [int(part) for part in text.split(":")]
+        if((len(parts) > 2) or (min(parts) < 0)):
+            raise ValueError("invalid position " + text)
+        return tuple([0] * (2 - len(parts)) + parts)
+
+    def rotated(self):
+        ''' Return the names of the rotated logs, newest first '''
+        names = []
+        while(os.path.exists(rotated_log_file(self.file, len(names) + 1))):
+            names.append(rotated_log_file(self.file, len(names) + 1))
+        return names
+
+    def _open(self, log):
+        if(log == 0):
+            return open(self.file, "rb")
+        # A rotated log is small, see LogWriter
+        fo = gzip.open(rotated_log_file(self.file, log), "rb")
+        try:
+            return io.BytesIO(fo.read())
+        finally:
+            fo.close()
+
+    def _lines(self, fo, start, end):
+        ''' Yield (position, line) of the lines from position start to
+            end in fo, last line first '''
+        position = end
+        head = b"" # Start of the line continuing in the previous block
+        while(position > start):
+            size = min(self.BLOCK_SIZE, position - start)
+            position -= size
+            fo.seek(position)
+            block = fo.read(size) + head
+            lines = block.split(b"\n")
+            head = lines.pop(0)
+            offset = position + len(block) + 1
+            for line in reversed(lines):
+                offset -= len(line) + 1
+                yield (offset, line)
+        yield (start, head)
+
+    def _entries(self, fo, start, end, level):
+        ''' Yield (position, text) of the entries of level or higher from
+            position start to end in fo, last entry first '''
+        lines = []
+        for position, line in self._lines(fo, start, end):
+            if(line == b""):
+                continue
+            lines.append(line)
+            match = self.ENTRY_RE.match(line)
+            if((match == None) and (position > start)):
+                continue # Continuation line, the entry starts above
+            lines.reverse()
+            if((match == None) or
+               (self.LEVELS.get(match.group(1).decode(), 0) >= level)):
+                yield (position,
+                       b"\n".join(lines).decode("utf-8", "replace") + "\n")
+            lines = []
+
+    def page(self, limit, before = None, after = None, 
+             level = logging.NOTSET):
+        ''' Return (entries, first, size) where entries are the texts of
+            up to limit entries, newest first, first is the position of the
+            oldest entry returned (use as before to get older entries) and
+            size is the size of the log file (use as after to get entries
+            written later).
+               before -- Only entries before this position (default end)
+               after  -- Only entries in the log file at or after this 
+                         offset (default all entries in all logs)
+               level  -- Only entries of this level or higher '''
+        log, end = before or (0, None)
+        first = (log, end or 0)
+        size = None
+        entries = []
+        while(len(entries) < limit):
+            try:
+                fo = self._open(log)
+            except (IOError, OSError):
+                if(log == 0):
+                    raise
+                break # No more rotated logs
+            try:
+                fo.seek(0, os.SEEK_END)
+                log_size = fo.tell()
+                if(log == 0):
+                    size = log_size
+                start = 0
+                if((after != None) and (after <= log_size)):
+                    start = after # Else the log was rotated or deleted
+                if(end == None):
+                    end = log_size
+                end = max(start, min(end, log_size))
+                first = (log, end)
+                for offset, text in self._entries(fo, start, end, level):
+                    first = (log, offset)
+                    entries.append(text)
+                    if(len(entries) >= limit):
+                        break
+            finally:
+                fo.close()
+            if(after != None):
+                break
+            log += 1
+            end = None
+        if(size == None):
+            size = os.path.getsize(self.file)
+        return (entries, first, size)
+
 ###############################################################################
 # WEB API
 ###############################################################################
+StaticFile = collections.namedtuple("StaticFile", 
+    "content_type etag variants") # variants: encoding or None -> content
+
+class StaticFiles:
+    ''' The files in a directory loaded in memory, with gzip (and brotli
+        if the brotli module is installed) compressed variants and a strong
+        ETag from the content, so that requests are served by dictionary
+        lookup without accessing the file system.
+
+        Every file is also available under a fingerprinted name with a
+        hash of the content, e.g. jquery-1.11.1.min.0123456789ab.js, which
+        never changes content. The references in HTML (src and href) and
+        CSS (url()) files to files in the directory are rewritten to the
+        fingerprinted names. '''
+    COMPRESSED_TYPES = ["text/", "application/javascript", 
+                        "application/json", "image/svg+xml"]
+    TYPES = {".md" : "text/markdown", ".map" : "application/json"}
+    REFERENCE_RE = {
+        ".html" : re.compile(br'''((?:src|href)\s*=\s*["'])([^"'#?]+)(["'])'''),
+        ".css"  : re.compile(br'''(url\(\s*["']?)([^"'()#?]+?)(["']?\s*\))''')}
+    FINGERPRINT_LENGTH = 12
+
+    def __init__(self, root):
+        self.files = {} # Path relative root with "/" separators -> StaticFile
+        self.fingerprinted = {} # Path -> fingerprinted path
+        self.referring = set() # Paths of files referring fingerprinted names
+        contents = {}
+        for directory, names, files in os.walk(root):
+            for name in files:
+                file_name = os.path.join(directory, name)
+                with open(file_name, "rb") as fo:
+                    contents[os.path.relpath(file_name, root).replace(
+                                 os.sep, "/")] = fo.read()
+        # The fingerprints of the referred files must be known when the 
+        # references are rewritten, HTML files refer to CSS files
+        ranks = {".css" : 1, ".html" : 2}
+        for path in sorted(contents, key = lambda path: 
+                           (ranks.get(os.path.splitext(path)[1], 0), path)):
+            content = self._rewrite(path, contents[path])
+            if(content != contents[path]):
+                self.referring.add(path)
+            self.add(path, content)
+
+    def _rewrite(self, path, content):
+        ''' Return content with the references to fingerprinted names '''
+        reference_re = self.REFERENCE_RE.get(os.path.splitext(path)[1])
+        if(reference_re == None):
+            return content
+        directory = posixpath.dirname(path)
+        def replace(match):
+            reference = match.group(2).decode("utf-8", "replace")
+            if((":" in reference) or reference.startswith("//")):
+                return match.group(0) # Not a file in the directory
+            target = reference
+            if(not reference.startswith("/")):
+                target = posixpath.join(directory, reference)
+            target = posixpath.normpath(target).lstrip("/")
+            fingerprinted = self.fingerprinted.get(target)
+            if(fingerprinted == None):
+                return match.group(0)
+            reference = posixpath.join(posixpath.dirname(reference),
+                                       posixpath.basename(fingerprinted))
+            return (match.group(1) + reference.encode("utf-8") + 
+                    match.group(3))
+        return reference_re.sub(replace, content)
+
+    def add(self, path, content):
+        content_type = (self.TYPES.get(os.path.splitext(path)[1]) or
+                        mimetypes.guess_type(path)[0] or 
+                        "application/octet-stream")
+        variants = {None : content}
+        if([prefix for prefix in self.COMPRESSED_TYPES 
+            if content_type.startswith(prefix)]):
+            buffer = io.BytesIO()
+            fo = gzip.GzipFile(fileobj = buffer, mode = "wb", mtime = 0)
+            fo.write(content)
+            fo.close()
+            variants["gzip"] = buffer.getvalue()
+            if(brotli != None):
+                variants["br"] = brotli.compress(content)
+        for encoding, compressed in list(variants.items()):
+            if(len(compressed) > len(content) * 0.9):
+                del variants[encoding] # Not worth decompressing
+        variants[None] = content
+        if(content_type.startswith("text/")):
+            content_type += "; charset=UTF-8"
+        static_file = StaticFile(content_type,
+                                 hashlib.sha1(content).hexdigest()[:20],
+                                 variants)
+        base, extension = posixpath.splitext(path)
+        fingerprinted = (base + "." + 
+                         static_file.etag[:self.FINGERPRINT_LENGTH] + extension)
+        self.files[path] = static_file
+        self.files[fingerprinted] = static_file
+        self.fingerprinted[path] = fingerprinted
+
+    def get(self, path):
+        return self.files.get(path)
+
+    def is_referring(self, path):
+        ''' True if the file at path (not fingerprinted) refers to
+            fingerprinted names, i.e. must not be used after an upgrade '''
+        return path in self.referring
+
+    def is_fingerprinted(self, path):
+        ''' True if path is a fingerprinted name, i.e. the content at path
+            never changes '''
+        static_file = self.files.get(path)
+        return ((static_file != None) and
+                (self.fingerprinted.get(path) == None))
+
 class WebAPI:
     
     def _select_server(self):
@@ -567,8 +2287,19 @@ class WebAPI:
         except ImportError:
             return "wsgiref"
     
-    def __init__(self, host, port, server, control, groups, config_file, 
-                 log_file, timer_thread):
+    KEEPALIVE_SECONDS = 30 # Interval of keep-alive comments on /events
+    # Every /events client occupies one server thread. Further clients get
+    # 503 and poll instead, leaving SERVER_THREADS for the other requests.
+    MAX_EVENT_STREAMS = 10
+    SERVER_THREADS = 10
+    STATIC_MAX_AGE = 24 * 3600 # Seconds browsers use files without checking
+    HTML_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  "html")
+    LOG_LIMIT = 1000 # Default number of log entries returned by /log
+    LOG_LIMIT_MAX = 10000
+
+    def __init__(self, host, port, server, control, config, log_file, 
+                 hub = None, history = None):
         self.host = host
         self.port = port
         if(server == ""):
@@ -576,10 +2307,17 @@ class WebAPI:
         logging.info("Server: " + server)
         self.backend_server = server
         self.control = control
-        self.groups = groups
-        self.config_file = config_file
+        self.config = config
+        self.config_file = config.file
         self.log_file = log_file
-        self.timer_thread = timer_thread
+        self.timer_thread = config.timer_thread
+        self.hub = hub
+        self.history = history # History of executed commands or None
+        self.static = None # StaticFiles of html/, loaded by start
+        self.static_lock = threading.Lock()
+        self.json_cache = {} # Name -> (generation, JSON text)
+        # Make ETags from this process differ from previous processes
+        self.etag_prefix = "%x" % int(time.time() * 1000)
         self.app = bottle.Bottle()
         self._route()
 
@@ -606,6 +2344,8 @@ class WebAPI:
                        callback=self._dim_device)
         self.app.route('/device/<id:int>/learn', method="GET", 
                        callback=self._learn_device)
+        self.app.route('/device/<id:int>/groups', method="GET", 
+                       callback=self._get_device_groups)
         self.app.route('/groups', method="GET", 
                        callback=self._get_groups)
         self.app.route('/group/<id:int>', method="GET", 
@@ -616,10 +2356,18 @@ class WebAPI:
                        callback=self._turn_off_group)
         self.app.route('/group/<id:int>/dim/<level:int>', method="GET", 
                        callback=self._dim_group)
+        self.app.route('/batch', method="POST", 
+                       callback=self._batch)
         self.app.route('/configuration', method="GET", 
                        callback=self._get_config)
         self.app.route('/configuration', method="POST", 
                        callback=self._set_config)
+        self.app.route('/status', method="GET", 
+                       callback=self._get_status)
+        self.app.route('/events', method="GET", 
+                       callback=self._events)
+        self.app.route('/history', method="GET", 
+                       callback=self._get_history)
         self.app.route('/log', method="GET", 
                        callback=self._get_log)
         self.app.route('/log', method="DELETE", 
@@ -630,54 +2378,151 @@ class WebAPI:
                        callback=self._file) 
                        
     def start(self):
+        self._static_files()
+        options = {}
+        if((self.hub != None) and (self.backend_server == "cherrypy")):
+            options['numthreads'] = (self.SERVER_THREADS + 
+                                     self.MAX_EVENT_STREAMS)
         self.app.run(server=self.backend_server, host=self.host, 
-                     port=self.port, debug=True)
+                     port=self.port, debug=True, **options)
 
     def _return_success(self):
         bottle.response.content_type = 'application/json'
         return {'result' : 'success' }
-        
+
+    def _check_etag(self, version):
+        ''' Set the ETag of the response from version. Respond with 
+            304 Not Modified if the client already has this version. '''
+        etag = '"' + self.etag_prefix + "-" + version + '"'
+        bottle.response.set_header('ETag', etag)
+        self._check_not_modified({'ETag' : etag})
+
+    def _check_not_modified(self, headers):
+        ''' Respond with 304 Not Modified and headers if the client already
+            has the ETag in headers '''
+        if_none_match = bottle.request.headers.get('If-None-Match')
+        if(if_none_match != None):
+            client_etags = [tag.strip() for tag in if_none_match.split(",")]
+            client_etags = [tag[2:] if tag.startswith("W/") else tag
+                            for tag in client_etags]
+            if((headers['ETag'] in client_etags) or ("*" in client_etags)):
+                raise bottle.HTTPResponse(status = 304, headers = headers)
+
+    def _static_files(self):
+        with self.static_lock:
+            if(self.static == None):
+                self.static = StaticFiles(self.HTML_DIRECTORY)
+            return self.static
+
+    def _accepted_encodings(self):
+        ''' Return the encodings accepted by the client of the request '''
+        encodings = []
+        for item in bottle.request.headers.get('Accept-Encoding', 
+                                               '').split(","):
+            parts = [part.strip() for part in item.split(";")]
+            quality = 1.0
+            for part in parts[1:]:
+                if(part.startswith("q=")):
+                    try:
+                        quality = float(part[2:])
+                    except ValueError:
+                        quality = 0.0
+            if(quality > 0):
+                encodings.append(parts[0])
+        return encodings
+
+    def _static(self, path, cache_control):
+        static_file = self._static_files().get(path)
+        if(static_file == None):
+            bottle.abort(404, "File does not exist.")
+        encoding = None
+        accepted = self._accepted_encodings()
+        for candidate in ["br", "gzip"]:
+            if((candidate in static_file.variants) and 
+               (candidate in accepted)):
+                encoding = candidate
+                break
+        # Strong ETags must differ between the encodings
+        etag = static_file.etag
+        if(encoding != None):
+            etag += "-" + encoding
+        headers = {'ETag' : '"' + etag + '"', 
+                   'Cache-Control' : cache_control, 
+                   'Vary' : 'Accept-Encoding'}
+        self._check_not_modified(headers)
+        for name, value in headers.items():
+            bottle.response.set_header(name, value)
+        bottle.response.content_type = static_file.content_type
+        if(encoding != None):
+            bottle.response.set_header('Content-Encoding', encoding)
+        return static_file.variants[encoding]
+
     def _index(self):
-        return bottle.static_file("index.html", 
-                                  root=os.path.dirname(__file__) + "/html/")
+        return self._file("index.html")
 
     def _file(self, path):
-        return bottle.static_file(path, 
-                                  root=os.path.dirname(__file__) + "/html/")
+        static = self._static_files()
+        if(static.is_fingerprinted(path)):
+            return self._static(path, "public, max-age=31536000, immutable")
+        elif(static.is_referring(path) or path.endswith(".html")):
+            # Always revalidated, an old page could refer to fingerprinted
+            # names which no longer exist
+            return self._static(path, "no-cache")
+        return self._static(path, "public, max-age=" + 
+                            str(self.STATIC_MAX_AGE))
         
-    def _get_device(self, id):
-        if id in self.control.get_device_IDs():        
-            device = {
-                'id'              : id,
-                'name'            : self.control.get_name(id),
-                'supports_on_off' : self.control.supports_on_off(id),
-                'supports_dim'    : self.control.supports_dim(id),
-                'last_cmd_was_on' : self.control.last_cmd_was_on(id)
-            }
-            if(self.control.supports_dim(id)):
-                device.update({
-                    'dim_level_min'   : self.control.DIM_LEVEL_MIN,
-                    'dim_level_max'   : self.control.DIM_LEVEL_MAX,
-                    'dim_level_last'  : self.control.last_dim_level(id)
-                })
-            bottle.response.content_type = 'application/json'
-            return device
-        else:
+    def _device_to_dict(self, device):
+        result = {
+            'id'              : device.id,
+            'name'            : device.name,
+            'supports_on_off' : device.supports_on_off,
+            'supports_dim'    : device.supports_dim,
+            'last_cmd_was_on' : device.last_cmd_was_on
+        }
+        if(device.supports_dim):
+            result.update({
+                'dim_level_min'   : self.control.DIM_LEVEL_MIN,
+                'dim_level_max'   : self.control.DIM_LEVEL_MAX,
+                'dim_level_last'  : device.last_dim_level
+            })
+        return result
+
+    def _device_config_to_dict(self, device):
+        return {
+            'id'              : device.id,
+            'name'            : device.name,
+            'protocol'        : device.protocol,
+            'model'           : device.model,
+            'parameters'      : device.parameters
+        }
+
+    def _snapshot_device(self, id):
+        device = self.control.snapshot().index.get(id)
+        if(device == None):
             bottle.abort(400, "Device with ID '" + str(id) + "' not found")
+        bottle.response.content_type = 'application/json'
+        return device
+
+    def _snapshot_json(self, name, to_dict):
+        ''' Return all devices in the snapshot as JSON. The JSON text is 
+            cached until the snapshot generation changes. '''
+        snapshot = self.control.snapshot()
+        self._check_etag("d" + str(snapshot.generation))
+        cached = self.json_cache.get(name)
+        if((cached == None) or (cached[0] != snapshot.generation)):
+            cached = (snapshot.generation, 
+                      json.dumps([to_dict(device) 
+                                  for device in snapshot.devices]))
+            self.json_cache[name] = cached
+        bottle.response.content_type = 'application/json'
+        bottle.response.set_header('X-Snapshot-Generation', str(cached[0]))
+        return cached[1]
+
+    def _get_device(self, id):
+        return self._device_to_dict(self._snapshot_device(id))
 
     def _get_device_config(self, id):
-        if id in self.control.get_device_IDs():        
-            config = {
-                'id'              : id,
-                'name'            : self.control.get_name(id),
-                'protocol'        : self.control.get_protocol(id),
-                'model'           : self.control.get_model(id),
-                'parameters'      : self.control.get_parameters(id)
-            }
-            bottle.response.content_type = 'application/json'
-            return config
-        else:
-            bottle.abort(400, "Device with ID '" + str(id) + "' not found")
+        return self._device_config_to_dict(self._snapshot_device(id))
 
     def _check_device_config_request(self, id, device):
         if( device == None):
@@ -729,60 +2574,98 @@ class WebAPI:
         self.control.delete_device(id)        
         
     def _get_devices(self):
-        result = []
-        for id in self.control.get_device_IDs():
-            result.append(self._get_device(id))
-        return json.dumps(result)
+        return self._snapshot_json('devices', self._device_to_dict)
         
     def _get_devices_config(self):
-        result = []
-        for id in self.control.get_device_IDs():
-            result.append(self._get_device_config(id))
-        return json.dumps(result)
+        return self._snapshot_json('devices_config', 
+                                   self._device_config_to_dict)
 
-    def _turn_on_device(self, id):
-        if id not in self.control.get_device_IDs():    
-            bottle.abort(400, "Device with ID '" + str(id) + "' not found") 
-        elif (self.control.supports_on_off(id) == False):
-            bottle.abort(400, "Device ID '" + str(id) + "' don't support on")        
+    def _check_dim_level(self, level):
+        if((not isinstance(level, int)) or isinstance(level, bool) or 
+           (level < self.control.DIM_LEVEL_MIN) or 
+           (level > self.control.DIM_LEVEL_MAX)):
+            return "Dim level '" + str(level) + "' invalid"
+        return ""
+
+    def _check_device_action(self, id, action, level = None):
+        ''' Return an error message if the action (on, off, dim or learn) 
+            cannot be sent to the device, otherwise an empty string '''
+        if not self.control.has_device(id):
+            return "Device with ID '" + str(id) + "' not found"
+        if(action in ["on", "off"]):
+            supported = self.control.supports_on_off(id)
+        elif(action == "dim"):
+            supported = self.control.supports_dim(id)
+        elif(action == "learn"):
+            supported = self.control.supports_learn(id)
         else:
-            self.control.turn_on([id])
-            return self._return_success()
+            return "Action '" + str(action) + "' invalid"
+        if(not supported):
+            return "Device ID '" + str(id) + "' don't support " + action
+        if(action == "dim"):
+            return self._check_dim_level(level)
+        return ""
+
+    def _check_group_action(self, id, action, level = None):
+        ''' Return an error message if the action (on, off or dim) cannot 
+            be sent to the group, otherwise an empty string '''
+        if(self.config.groups.get(id) == None):
+            return "Group with ID '" + str(id) + "' not found"
+        if(action == "dim"):
+            return self._check_dim_level(level)
+        if(action not in ["on", "off"]):
+            return "Action '" + str(action) + "' invalid for groups"
+        return ""
+
+    def _execute(self, action, devices, level = None, group = None):
+        history_command = None
+        if(self.history != None):
+            history_command = HistoryCommand(self.history, "web", devices, 
+                                             action, level, group)
+        try:
+            if(action == "on"):
+                self.control.turn_on(devices, history_command)
+            elif(action == "off"):
+                self.control.turn_off(devices, history_command)
+            elif(action == "dim"):
+                self.control.dim(devices, level, history_command)
+            elif(action == "learn"):
+                self.control.learn(devices, history_command)
+        except Exception as e:
+            if(history_command != None):
+                history_command.fail(str(e))
+            raise
+
+    def _device_action(self, id, action, level = None):
+        error = self._check_device_action(id, action, level)
+        if(error != ""):
+            bottle.abort(400, error)
+        self._execute(action, [id], level)
+        return self._return_success()
+
+    def _turn_on_device(self, id):
+        return self._device_action(id, "on")
 
     def _turn_off_device(self, id):
-        if id not in self.control.get_device_IDs():    
-            bottle.abort(400, "Device with ID '" + str(id) + "' not found") 
-        elif (self.control.supports_on_off(id) == False):
-            bottle.abort(400, "Device ID '" + str(id) + "' don't support off")        
-        else:
-            self.control.turn_off([id])
-            return self._return_success()
+        return self._device_action(id, "off")
             
     def _dim_device(self, id, level):
-        if id not in self.control.get_device_IDs():    
-            bottle.abort(400, "Device with ID '" + str(id) + "' not found") 
-        elif (self.control.supports_dim(id) == False):
-            bottle.abort(400, "Device ID '" + str(id) + "' don't support dim")
-        elif ((level < self.control.DIM_LEVEL_MIN) or 
-              (level > self.control.DIM_LEVEL_MAX)):
-            bottle.abort(400, "Dim level '" + str(level) + "' invalid")            
-        else:
-            self.control.dim([id],level)
-            return self._return_success()
+        return self._device_action(id, "dim", level)
 
     def _learn_device(self, id):
-        if id not in self.control.get_device_IDs():    
-            bottle.abort(400, "Device with ID '" + str(id) + "' not found") 
-        elif (self.control.supports_learn(id) == False):
-            bottle.abort(400, "Device ID '" + str(id) + "' don't support learn")        
-        else:
-            self.control.learn([id])
-            return self._return_success()   
+        return self._device_action(id, "learn")
+
+    def _get_device_groups(self, id):
+        if(not self.control.has_device(id)):
+            bottle.abort(400, "Device with ID '" + str(id) + "' not found")
+        bottle.response.content_type = 'application/json'
+        return json.dumps([{'id' : group.id, 'name' : group.name} 
+                           for group in self.config.groups.with_device(id)])
 
     def _get_group(self, id):
         supports_on_off = False
         supports_dim = False
-        group = self.groups.get(id)
+        group = self.config.groups.get(id)
         if(group == None):
             bottle.abort(400, "Group with ID '" + str(id) + "' not found")
         else:
@@ -811,40 +2694,95 @@ class WebAPI:
             return group_ret
                 
     def _get_groups(self):
+        # Supported methods of the groups depends on the devices
+        self._check_etag("g" + str(self.config.version) + "-" + 
+                         str(self.control.snapshot().generation))
         result = []
-        for group in self.groups.groups:
+        for group in self.config.groups:
             result.append(self._get_group(group.id))
         return json.dumps(result)            
             
+    def _group_action(self, id, action, level = None):
+        error = self._check_group_action(id, action, level)
+        if(error != ""):
+            bottle.abort(400, error)
+        self._execute(action, self.config.groups.get(id).devices, level, id)
+        return self._return_success()
+
     def _turn_on_group(self, id):
-        group = self.groups.get(id)
-        if(group == None):
-            bottle.abort(400, "Group with ID '" + str(id) + "' not found") 
-        else:
-            self.control.turn_on(group.devices)
-            return self._return_success()
+        return self._group_action(id, "on")
 
     def _turn_off_group(self, id):
-        group = self.groups.get(id)
-        if(group == None):
-            bottle.abort(400, "Group with ID '" + str(id) + "' not found") 
-        else:
-            self.control.turn_off(group.devices)
-            return self._return_success()            
+        return self._group_action(id, "off")
             
     def _dim_group(self, id, level):
-        group = self.groups.get(id)
-        if(group == None):
-            bottle.abort(400, "Group with ID '" + str(id) + "' not found") 
-        elif ((level < self.control.DIM_LEVEL_MIN) or 
-              (level > self.control.DIM_LEVEL_MAX)):
-            bottle.abort(400, "Dim level '" + str(level) + "' invalid")
-        else:
-            self.control.dim(group.devices,level)
-            return self._return_success()
+        return self._group_action(id, "dim", level)
+
+    def _check_operation(self, operation):
+        if(not isinstance(operation, dict)):
+            return "Operation must be a JSON object"
+        action = operation.get("action")
+        level = operation.get("level")
+        if(("device" in operation) == ("group" in operation)):
+            return "Operation must have either 'device' or 'group'"
+        elif("device" in operation):
+            return self._check_device_action(operation["device"], action, 
+                                             level)
+        return self._check_group_action(operation["group"], action, level)
+
+    def _batch(self):
+        ''' Execute a JSON list of operations, e.g. 
+              [{"device" : 1, "action" : "on"},
+               {"group" : 2, "action" : "dim", "level" : 128}]
+            All operations are validated before the valid ones are executed
+            in the given order. Adjacent operations with the same action are
+            sent as one command, unless they are to different groups. The 
+            result of every operation is returned with its device or group.
+            Device and group IDs must be JSON integers. '''
+        operations = bottle.request.json
+        if(not isinstance(operations, list)):
+            bottle.abort(400, "Request must be a JSON list of operations")
+        for operation in operations:
+            for name in ["device", "group"]:
+                if(isinstance(operation, dict) and (name in operation) and
+                   ((not isinstance(operation[name], int)) or 
+                    isinstance(operation[name], bool))):
+                    bottle.abort(400, name + " ID must be an integer")
+        results = []
+        commands = [] # [action, devices, level, group ID or None]
+        for operation in operations:
+            error = self._check_operation(operation)
+            if(error != ""):
+                results.append({'result' : 'error', 'message' : error})
+                continue
+            group = operation.get("group")
+            if("device" in operation):
+                devices = [operation["device"]]
+                results.append({'result' : 'success', 
+                                'device' : operation["device"]})
+            else:
+                devices = self.config.groups.get(group).devices
+                results.append({'result' : 'success', 'group' : group})
+            action = operation["action"]
+            level = operation.get("level")
+            if((len(commands) > 0) and (commands[-1][0] == action) and 
+               (commands[-1][2] == level) and (commands[-1][3] == group)):
+                commands[-1][1].extend(devices)
+            else:
+                commands.append([action, list(devices), level, group])
+        for action, devices, level, group in commands:
+            self._execute(action, devices, level, group)
+        bottle.response.content_type = 'application/json'
+        return {'results' : results}
             
     def _get_config(self):
         bottle.response.content_type = 'text/plain'
+        try:
+            stat = os.stat(self.config_file)
+            self._check_etag("c" + str(int(stat.st_mtime * 1000)) + "-" + 
+                             str(stat.st_size))
+        except OSError:
+            pass # Reported below
         try:
             fo = open(self.config_file,"r")
             result = fo.read()
@@ -860,7 +2798,7 @@ class WebAPI:
         # Save configuration to temporary file
         temp_file = self.config_file + ".tmp"
         try:
-            fo = open(temp_file,mode="w")
+            fo = open(temp_file,mode="wb")
             fo.write(bottle.request.body.read())
             fo.close()
         except Exception as e:
@@ -868,12 +2806,8 @@ class WebAPI:
             return "Unable to save temporary config file. \n\n" + e.args[0]
 
         # Try to parse the temporary file (validate syntax etc.)
-        events = []
-        groups = Groups()
-        lat_long = None
         try:
-            lat_long = load_config_file(temp_file, self.control, 
-                                        events, groups)
+            events, groups, lat_long = self.config.load(temp_file)
         except Exception as e:
             bottle.response.status = 500
             return e.args[0]
@@ -885,42 +2819,141 @@ class WebAPI:
             bottle.response.status = 500
             return "Unable to backup configuration. \n\n" + e.args[0]
 
-        # Copy temporary file to original file
+        # Copy temporary file to original file and swap in the new 
+        # configuration, the ConfigWatcher skips the written file
+        with self.config.file_lock:
+            try:
+                shutil.copyfile(temp_file, self.config_file)
+            except Exception as e:
+                bottle.response.status = 500
+                return "Unable create configuration file. \n\n" + e.args[0]
+            result = self._return_success()
+            result['changes'] = self.config.apply(events, groups, lat_long,
+                                                  self.config.file_stamp())
+        return result
+ 
+    def _get_status(self):
+        scheduler = self.timer_thread.scheduler
+        bottle.response.content_type = 'application/json'
+        return {
+            'version'     : __version__,
+            'transmitter' : self.control.transmitter.metrics(),
+            'scheduler'   : {
+                'replayed'           : scheduler.replayed_count,
+                'replayed_delay_max' : 
+                    int(scheduler.replayed_delay_max.total_seconds()),
+                'replayed_delay_total' : 
+                    int(scheduler.replayed_delay_total.total_seconds()),
+                'skipped'            : scheduler.skipped_count
+            }
+        }
+
+    def _events(self):
+        ''' Stream of Server-Sent Events with the messages published in the
+            event hub. Requires a multi-threaded server (e.g. cherrypy) 
+            since every client occupies one thread. '''
+        if(self.hub == None):
+            bottle.abort(404, "Event stream not enabled")
+        if(self.backend_server == "wsgiref"):
+            bottle.abort(501, "Event stream requires a multi-threaded server")
+        subscriber = self.hub.subscribe(self.MAX_EVENT_STREAMS)
+        if(subscriber == None):
+            bottle.abort(503, "Too many event streams")
+        bottle.response.content_type = 'text/event-stream'
+        bottle.response.set_header('Cache-Control', 'no-cache')
+        return self._event_stream(subscriber)
+
+    def _event_stream(self, subscriber):
         try:
-            shutil.copyfile(temp_file, self.config_file)
-        except Exception as e:
-            bottle.response.status = 500
-            return "Unable create configuration file. \n\n" + e.args[0]          
-        
-        # Create a new sun object
-        if(lat_long != None):
-            sun = sunstate.Sun(lat_long[0], lat_long[1], sunstate.LocalTimezone())
-        
-        # Update the timer thread with new events and sun
-        self.timer_thread.change_data(events, sun)
-        
-        # Update the groups
-        self.groups = groups
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    kind, data = subscriber.get(
+                                    timeout = self.KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield "event: " + kind + "\ndata: " + json.dumps(data) + "\n\n"
+        finally:
+            # Executed when the client disconnects
+            self.hub.unsubscribe(subscriber)
+
+    def _get_history(self):
+        ''' The latest executed commands, newest first. Query parameters
+            (all optional): since (seconds since the epoch), source ('timer'
+            or 'web'), device, group, command, result ('success' or
+            'error', coalesced commands are not errors) and limit. '''
+        if(self.history == None):
+            bottle.abort(404, "History not enabled")
+        query = bottle.request.query
+        try:
+            numbers = {}
+            for name, convert in [('since', float), ('device', int), 
+                                  ('group', int), ('limit', int)]:
+                if(name in query):
+                    numbers[name] = convert(query.get(name))
+        except ValueError:
+            bottle.abort(400, "since, device, group and limit must be numbers")
+        source = query.get('source')
+        if((source != None) and (source not in History.SOURCES)):
+            bottle.abort(400, "source must be 'timer' or 'web'")
+        failed = None
+        if('result' in query):
+            if(query.get('result') not in ["success", "error"]):
+                bottle.abort(400, "result must be 'success' or 'error'")
+            failed = (query.get('result') == "error")
+        records = self.history.query(numbers.get('since'), source, 
+                                     numbers.get('device'), 
+                                     numbers.get('group'), 
+                                     query.get('command'), failed,
+                                     numbers.get('limit'))
+        bottle.response.content_type = 'application/json'
+        return json.dumps([record._asdict() for record in records])
 
-        return self._return_success() 
- 
     def _get_log(self):
+        ''' The log entries, newest first, including the rotated logs.
+            Query parameters:
+               limit  -- Max number of entries (default LOG_LIMIT)
+               before -- Entries older than the X-Log-Before header of a
+                         previous response
+               after  -- Entries newer than the X-Log-After header of a
+                         previous response
+               level  -- Only entries of this level or higher, e.g. WARNING
+            Only the returned entries are read from the log files. '''
+        query = bottle.request.query
+        try:
+            limit = min(int(query.get('limit', self.LOG_LIMIT)), 
+                        self.LOG_LIMIT_MAX)
+            before = None
+            if('before' in query):
+                before = LogReader.position(query.get('before'))
+            after = None
+            if('after' in query):
+                after = int(query.get('after'))
+        except ValueError:
+            bottle.abort(400, "limit, before and after must be positions")
+        if(limit <= 0):
+            bottle.abort(400, "limit must be positive")
+        level = query.get('level', 'DEBUG').upper()
+        if(level not in LogReader.LEVELS):
+            bottle.abort(400, "Invalid level '" + level + "'")
         bottle.response.content_type = 'text/plain'
         try:
-            fo = open(self.log_file,"r")
-            result = fo.readlines()
-            fo.close()
-            # Earliest log entry first
-            result.reverse()
-            return ''.join(result)
+            entries, first, size = LogReader(self.log_file).page(
+                limit, before, after, LogReader.LEVELS[level])
         except Exception as ex:
             bottle.response.status = 500
             return "Unable to open: " + self.log_file + "\n\nReason:\n" + str(ex)
+        bottle.response.set_header('X-Log-Before', "%d:%d" % first)
+        bottle.response.set_header('X-Log-After', str(size))
+        return "".join(entries)
  
     def _delete_log(self):
         try:
             with open(self.log_file, 'w'):
                 pass
+            for name in LogReader(self.log_file).rotated():
+                os.remove(name)
             return self._return_success() 
         except Exception as ex:
             bottle.response.content_type = 'text/plain'
@@ -938,6 +2971,18 @@ def usage():
     print("  -p port   : port for WebAPI (default 8080)")
     print("  -d        : debug mode (more info written to log)")
     print("  -s        : server (default: prio 1 'cherrypy', prio 2 'wsgiref')")
+    print("  -e number : number of worker threads executing events (default " +
+          str(EventExecutor.DEFAULT_WORKERS) + ")")
+    print("  -m minutes: max age of missed events to catch up (default " + 
+          str(EventScheduler.DEFAULT_CATCH_UP_MINUTES) + ")")
+    print("  -r        : reload configuration file when changed on disk")
+    print("  -k file   : cache of the parsed configuration for faster start" +
+          " (default disabled)")
+    print("  -o kbytes : rotate the log file when larger (default " +
+          str(LogWriter.DEFAULT_MAX_KBYTES) + ", 0 disables)")
+    print("  -t hours  : rotate the log file at this interval (default disabled)")
+    print("  -b number : number of rotated (compressed) log files kept " +
+          "(default " + str(LogWriter.DEFAULT_BACKUP_COUNT) + ")")
     print("  -?        : this help")
             
 def main():
@@ -948,14 +2993,21 @@ def main():
     sun = None
     path = os.path.dirname(__file__) + "/"
     config_file = path + "mas.config"
+    cache_file = None
     log_file = path + "mas.log"
     ip_address = ""
     server = ""
     port = 8080
+    workers = EventExecutor.DEFAULT_WORKERS
+    catch_up_minutes = EventScheduler.DEFAULT_CATCH_UP_MINUTES
+    watch_config = False
+    log_max_kbytes = LogWriter.DEFAULT_MAX_KBYTES
+    log_rotate_hours = 0
+    log_backup_count = LogWriter.DEFAULT_BACKUP_COUNT
     logging_level = logging.INFO    
     
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "?c:l:w:p:ds:")
+        opts, args = getopt.getopt(sys.argv[1:], "?c:l:w:p:ds:e:m:rk:o:t:b:")
     except getopt.GetoptError as e:
         print(str(e)+"\n")
         usage()
@@ -974,19 +3026,43 @@ def main():
             logging_level = logging.DEBUG 
         elif o == "-s":
             server = a.strip()
+        elif o == "-e":
+            workers = int(a.strip())
+            if(workers < 1):
+                usage()
+                exit(2)
+        elif o == "-m":
+            catch_up_minutes = int(a.strip())
+        elif o == "-r":
+            watch_config = True
+        elif o == "-k":
+            cache_file = a.strip()
+        elif o == "-o":
+            log_max_kbytes = int(a.strip())
+        elif o == "-t":
+            log_rotate_hours = float(a.strip())
+        elif o == "-b":
+            log_backup_count = int(a.strip())
         else:
             usage()
             exit(2)
 
-    logging.basicConfig(filename=log_file,level=logging_level,
-        format="%(asctime)s - %(levelname)s - %(message)s")
+    # Written in a background thread, flushed by logging.shutdown at exit
+    log_writer = LogWriter(log_file, log_max_kbytes * 1024, 
+                           int(log_rotate_hours * 3600), log_backup_count)
+    log_writer.setFormatter(logging.Formatter(
+        "%(asctime)s - %(levelname)s - %(message)s"))
+    logging.getLogger().addHandler(log_writer)
+    logging.getLogger().setLevel(logging_level)
     logging.info('Mini Automation Sever ' + __version__ + ' Initiated')
     logging.info('config file: ' + config_file)
     logging.info('log file:    ' + log_file)
     
             
+    hub = EventHub()
+    history = History()
     try:
-        control_library = TelldusLibrary();
+        control_library = TelldusLibrary(hub = hub);
 
     except:
         errmsg = "Telldus core library is missing. Please install before use."
@@ -995,8 +3071,8 @@ def main():
         exit(3)
 
     try:
-        lat_long = load_config_file(config_file, control_library, 
-        events, groups)
+        lat_long = load_config(config_file, control_library, events, groups,
+                               cache_file)
     except Exception as e:
         logging.error(e.args[0])
         sys.stderr.write(e.args[0]+"\n")
@@ -1005,8 +3081,15 @@ def main():
     if(lat_long != None):
         sun = sunstate.Sun(lat_long[0], lat_long[1], sunstate.LocalTimezone())
         
-    timer_thread = TimerThread(events, sun)
+    timer_thread = TimerThread(events, sun, workers, catch_up_minutes, hub, 
+                               history)
     timer_thread.start()
+    config = Configuration(config_file, control_library, groups, 
+                           timer_thread, hub, cache_file)
+    config_watcher = None
+    if(watch_config):
+        config_watcher = ConfigWatcher(config)
+        config_watcher.start()
     
     print("Running Mini Automation Server "+__version__)
     
@@ -1014,8 +3097,8 @@ def main():
     if(ip_address != ""):
         logging.info("WebAPI started on IP: "+ip_address+" Port: "+str(port))
         try:
-            webApi = WebAPI(ip_address, port, server, control_library, groups,
-                            config_file, log_file, timer_thread)
+            webApi = WebAPI(ip_address, port, server, control_library, config,
+                            log_file, hub, history)
             webApi.start()
         except Exception as e:
             logging.error("Exception in WebAPI")
@@ -1036,7 +3119,10 @@ def main():
     print("Shutting down...")
     logging.info('Mini Automation Sever Exit')
 
+    if(config_watcher != None):
+        config_watcher.stop()
     timer_thread.stop()
+    control_library.stop()
     exit()
     
     
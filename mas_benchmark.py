@@ -0,0 +1,461 @@
+#!/usr/bin/env python
+#
+###############################################################################
+#   - Mini Automation Server (MAS) Benchmarks -
+#
+#   For performance testing only - not needed to execute the application
+#
+#   Usage: mas_benchmark.py [benchmark] ...   (default all benchmarks)
+#
+#   Author: Joel Eriksson (joel.a.eriksson@gmail.com)
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+###############################################################################
+
+from __future__ import print_function
+import sys, os, time, random, tempfile
+import mas
+
+def synthetic_config(lines, seed = 1):
+    ''' Return a configuration text with the given number of lines, one 
+        GROUP per 50 lines and EVENTs of all kinds '''
+    rand = random.Random(seed)
+    days = ["Mon", "Tue", "Wen", "Thu", "Fri", "Sat", "Sun"]
+    text = ["LAT_LONG 59.17 18.3\n"]
+    groups = 0
+    while(len(text) < lines):
+        if(len(text) % 50 == 1):
+            groups += 1
+            text.append('GROUP G' + str(groups) + ' "Group ' + str(groups) + 
+                        '" ' + " ".join(str(rand.randint(1, 100)) 
+                                        for i in range(rand.randint(1, 5))) + 
+                        "\n")
+            continue
+        words = ["EVENT"]
+        kind = rand.randint(0, 3)
+        if(kind == 0):
+            words.append("Sunrise")
+        elif(kind == 1):
+            words.append("Sunset" + rand.choice(["+", "-"]) + 
+                         str(rand.randint(0, 30) / 10.0))
+        else:
+            words.append("%02d:%02d" % (rand.randint(0, 23), 
+                                        rand.randint(0, 59)))
+        if(rand.randint(0, 1)):
+            words.append("/".join(rand.sample(days, rand.randint(1, 7))))
+        if(rand.randint(0, 3) == 0):
+            words.append(rand.choice(["Sunup", "Sundown"]))
+        target = str(rand.randint(1, 100))
+        if(rand.randint(0, 2) == 0):
+            target = "G" + str(rand.randint(1, groups))
+        function = rand.choice(["on", "off", "dim"])
+        if(function == "dim"):
+            words.append("dim(" + target + "," + str(rand.randint(0, 255)) + 
+                         ")")
+        else:
+            words.append(function + "(" + target + ")")
+        text.append(" ".join(words) + "\n")
+    return "".join(text)
+
+def measure(function, repeat = 3):
+    ''' Return the best time in seconds of repeat calls of function '''
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if((best == None) or (elapsed < best)):
+            best = elapsed
+    return best
+
+def report(name, seconds, baseline = None):
+    text = "  %-28s %10.3f ms" % (name, seconds * 1000)
+    if(baseline != None):
+        text += "   (%.2fx)" % (baseline / seconds)
+    print(text)
+
+###############################################################################
+# CONFIGURATION PARSER
+###############################################################################
+# The line parser used before ConfigParser, kept as the reference for the 
+# parser benchmark.
+def legacy_parse_LAT_LONG(line):
+    words = line.split()
+    if(len(words) != 3):
+        raise Exception("LAT_LONG must have 2 arguments\n   " + 
+                        " | ".join(words))
+    
+    lat = float(words[1])
+    long = float(words[2])
+    
+    return [lat, long]
+
+def legacy_parse_EVENT_offset(s):
+    result = 0
+    offset = s.split('+')
+    if(len(offset)>1):
+        result = int(round(float(offset[1])*60,0))
+    else:
+        offset = s.split('-')
+        if(len(offset)>1):
+            result = int(round(float(offset[1])*-60,0))
+    if((result <= -(24*60)) or (result >= (24*60))):
+        raise Exception("Offset must be > -24 and < 24\n   " + s)
+    return result
+    
+def legacy_parse_EVENT(line, control_library, groups, lat_long_is_set = True):
+    hour   = 0
+    minute = 0
+    weekday =  None
+    restriction = 0
+    function = None
+    
+    words = line.split()
+    if((len(words) < 3) or (len(words) > 5)):
+        raise Exception("EVENT must have 3 - 5 arguments\n   " + 
+                        " | ".join(words))
+        
+    # Parse <time>
+    if(words[1].startswith("Sunrise")):
+        if(not lat_long_is_set):
+            raise Exception("Sunrise requires LAT_LONG to be set\n   " + line)
+        hour = mas.TimeEvent.TIME_SUNRISE
+        minute = legacy_parse_EVENT_offset(words[1])
+    elif(words[1].startswith("Sunset")):
+        if(not lat_long_is_set):
+            raise Exception("Sunset requires LAT_LONG to be set\n   " + line)
+        hour = mas.TimeEvent.TIME_SUNSET
+        minute = legacy_parse_EVENT_offset(words[1])
+    else:
+        time = words[1].split(":")
+        if(len(time) != 2):
+            raise Exception("time should be HH:MM\n   " + line)
+        hour = int(time[0])
+        if((hour < 0) or (hour > 24)):
+                raise Exception("hour must be 0 to 24\n   " + line)
+        minute = int(time[1])
+        if((minute < 0) or (minute > 60)):
+                raise Exception("minute must be 0 to 60\n   " + line)
+    
+    # Parse <dayofweek> 
+    word_index = 2
+    if((len(words)>3) and (words[2] != "Sunup") and (words[2] != "Sundown")):
+        weekday = [False, False, False, False, False, False, False]
+        weekday_text = ["Mon","Tue","Wen","Thu","Fri","Sat","Sun"]
+        days = words[2].split("/")
+        for day in days:
+            try:
+                weekday[weekday_text.index(day)]=True
+            except:
+                raise Exception("'" + day + "' is not a valid day\n   " + 
+                line)
+        word_index = 3
+        
+    # Parse <restriction>
+    if(len(words) == (word_index + 2)):
+        if(words[word_index]=="Sunup"):
+            if(not lat_long_is_set):
+                raise Exception("Sunup requires LAT_LONG to be set\n   " + line)
+            restriction = mas.TimeEvent.RESTRICTION_SUNUP
+        elif(words[word_index]=="Sundown"):
+            if(not lat_long_is_set):
+                raise Exception("Sundown requires LAT_LONG to be set\n   " + line)
+            restriction = mas.TimeEvent.RESTRICTION_SUNDOWN 
+        else:
+            raise Exception("invalid restriction. Valid values are "+ 
+            "'Sunup' or 'Sundown'\n   "    + line)
+        word_index = word_index + 1
+                    
+    # Parse <function>
+    function_name_parameter = words[word_index].split("(")
+    function_name = function_name_parameter[0]
+    function_parameters = function_name_parameter[1].strip(")").split(",")
+    if(function_parameters[0].startswith('G')):
+        # Parse <groupid>
+        groupid = int(function_parameters[0][1:])
+        group = groups.get(groupid)
+        if(group == None):
+            raise Exception("group '"+groupid+"' does not exist.\n   " 
+            + line)    
+        devices = group
+    else:
+        devices = int(function_parameters[0])
+    parameter2 = -1
+    if(len(function_parameters) == 2):
+        parameter2 = int(function_parameters[1]) 
+        
+    if(function_name == "on"):
+        function = mas.FunctionOn(devices, control_library)
+    elif(function_name == "off"):
+        function = mas.FunctionOff(devices, control_library)
+    elif(function_name == "dim"):
+        function = mas.FunctionDim(devices, parameter2, control_library)
+    else:
+        raise Exception("invalid function " + function_name + 
+        "\n   " +line) 
+    
+    return mas.TimeEvent(hour, minute, weekday, restriction, function)
+
+def legacy_parse_GROUP(line):
+    name = ""
+    groupid = 0    
+    devices = []
+
+    #Parse name
+    name_split = line.split('"')
+    if(len(name_split) != 3):
+        raise Exception('group name missing. Must be within "".\n   '
+        + line)    
+    name = name_split[1]
+ 
+    #Parse group id
+    id_split = name_split[0].split()
+    if(len(id_split) != 2):
+        raise Exception('group id is missing missing.\n   '
+        + line)
+    if(id_split[1].startswith('G')):
+        groupid = int(id_split[1][1:])
+    else:
+        groupid = int(id_split[1])
+
+    #Parse device id:s
+    device_split = name_split[2].split()
+    if(len(device_split) == 0):
+        raise Exception('at least one device id must be given.\n   '
+        + line)    
+    for device in device_split:
+        devices.append(int(device))
+    
+    return mas.Group(groupid, name, devices)
+    
+def legacy_load_config_file(filename, control_library, events, groups):
+    line_nbr = 0
+    lat_long = None
+    try:
+        fo = open(filename,"r")
+    except Exception:
+        raise Exception("Unable to open: " + filename + "\nUse -? for options")
+    try:
+        for line_nbr, line in enumerate(fo):
+            word_list = line.split()
+            if (len(word_list) > 0):
+                first_word = word_list[0]
+                if (first_word.startswith("#")):
+                    pass
+                elif (first_word == "LAT_LONG"):
+                    lat_long = legacy_parse_LAT_LONG(line)
+                elif (first_word == "EVENT"):
+                    event = legacy_parse_EVENT(line, control_library, groups, 
+                                        lat_long != None)
+                    events.append(event)
+                elif (first_word == "GROUP"):
+                    group = legacy_parse_GROUP(line)
+                    if(not groups.add(group)):
+                        raise Exception("group '" + group.id + 
+                        "' defined twice.\n   " + line)
+                else:
+                    raise Exception("unknown command '" + first_word + 
+                    "'.\n   " + line)
+        fo.close()
+        return lat_long
+    except Exception as e:
+        raise Exception("Syntax error in '" + filename + "'\n" +
+        "  Line " + str(line_nbr + 1) + ": " +e.args[0])
+
+def benchmark_parser(lines = 100000):
+    print("Configuration parser, " + str(lines) + " lines")
+    fd, config_file = tempfile.mkstemp()
+    os.write(fd, synthetic_config(lines).encode())
+    os.close(fd)
+
+    def legacy():
+        legacy_load_config_file(config_file, None, [], mas.Groups())
+    def parser():
+        mas.load_config_file(config_file, None, [], mas.Groups())
+    def records():
+        parser = mas.ConfigParser(mas.Groups())
+        fo = open(config_file, "r")
+        for line in fo:
+            record = parser.parse_line(line)
+            if(isinstance(record, mas.GroupRecord)):
+                parser.groups.add(mas.Group(record.id, record.name, 
+                                            record.devices))
+        fo.close()
+    try:
+        baseline = measure(legacy)
+        report("legacy line parser", baseline)
+        report("ConfigParser + events", measure(parser), baseline)
+        report("ConfigParser records only", measure(records), baseline)
+    finally:
+        os.remove(config_file)
+
+###############################################################################
+# EVENT MEMORY
+###############################################################################
+def deep_size(objects):
+    ''' Return the number of bytes of objects and all objects reachable 
+        from them, counting shared objects once (classes not counted) '''
+    seen = set()
+    stack = list(objects)
+    total = 0
+    while(len(stack) > 0):
+        obj = stack.pop()
+        if((id(obj) in seen) or isinstance(obj, type)):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if(isinstance(obj, dict)):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif(isinstance(obj, (list, tuple))):
+            stack.extend(obj)
+        if(hasattr(obj, "__dict__")):
+            stack.append(obj.__dict__)
+        for cls in type(obj).__mro__:
+            for name in cls.__dict__.get("__slots__", ()):
+                stack.append(getattr(obj, name, None))
+    return total
+
+# The data layout of the events before __slots__ and the weekday mask, kept 
+# as the reference for the memory benchmark.
+class LegacyTimeEvent:
+    weekday = [True, True, True, True, True, True, True]
+    def __init__(self, hour, minute, weekday, restriction, function):
+        self.hour = hour
+        self.minute = minute
+        if(weekday != None):
+            self.weekday = weekday
+        self.restriction = restriction
+        self.function = function
+
+class LegacyFunction(object):
+    def __init__(self, devices, dim_level = None):
+        self.devices = devices
+        self.control_library = None
+        if(dim_level != None):
+            self.dim_level = dim_level
+
+def legacy_event(record, groups):
+    weekday = None
+    if(record.weekday_mask != mas.TimeEvent.ALL_DAYS):
+        weekday = [((record.weekday_mask >> day) & 1) == 1 
+                   for day in range(7)]
+    devices = [record.target]
+    if(record.group):
+        devices = groups.get(record.target).devices
+    dim_level = None
+    if(record.function == "dim"):
+        dim_level = record.dim_level
+    return LegacyTimeEvent(record.hour, record.minute, weekday, 
+                           record.restriction, 
+                           LegacyFunction(devices, dim_level))
+
+def benchmark_memory(lines = 100000):
+    print("Event memory, " + str(lines) + " lines")
+    groups = mas.Groups()
+    parser = mas.ConfigParser(groups)
+    records = []
+    for line in synthetic_config(lines).splitlines():
+        record = parser.parse_line(line)
+        if(isinstance(record, mas.GroupRecord)):
+            groups.add(mas.Group(record.id, record.name, record.devices))
+        elif(isinstance(record, mas.EventRecord)):
+            records.append(record)
+    legacy = [legacy_event(record, groups) for record in records]
+    events = [mas.create_event(record, None, groups) for record in records]
+    baseline = deep_size(legacy) - deep_size([groups])
+    current = deep_size(events) - deep_size([groups])
+    print("  %-28s %8d bytes/event" % ("before (dict, lists)", 
+                                      baseline // len(records)))
+    print("  %-28s %8d bytes/event   (%.2fx)" % ("__slots__, mask, tuples", 
+                                      current // len(records), 
+                                      float(baseline) / current))
+
+###############################################################################
+# EVENT MATCHING
+###############################################################################
+def benchmark_matching(lines = 100000, minutes = 60):
+    import datetime, sunstate
+    events = []
+    groups = mas.Groups()
+    parser = mas.ConfigParser(groups)
+    for line in synthetic_config(lines).splitlines():
+        record = parser.parse_line(line)
+        if(isinstance(record, mas.GroupRecord)):
+            groups.add(mas.Group(record.id, record.name, record.devices))
+        elif(isinstance(record, mas.EventRecord)):
+            events.append(mas.create_event(record, None, groups))
+    print("Event matching, " + str(len(events)) + " events, " + 
+          str(minutes) + " minutes")
+    sun = sunstate.Sun(59.17, 18.3, sunstate.LocalTimezone())
+    start = datetime.datetime(2014, 3, 3, 12, 0)
+    ticks = [start + datetime.timedelta(minutes = minute) 
+             for minute in range(1, minutes + 1)]
+    sunrise, sunset = sun.suntimes(start.date())[0:2]
+
+    def per_object():
+        # The loop of the timer thread before the EventScheduler
+        fired = 0
+        for tick in ticks:
+            for event in events:
+                if(event.time_match(tick, sunrise, sunset)):
+                    fired += 1
+        return fired
+    def scheduler():
+        scheduler = mas.EventScheduler()
+        scheduler.schedule(events, sun, start)
+        scheduler.sun_index(start.date()) # Once per day
+        return scheduler
+    def table():
+        # Time one pass over the ticks, pop_due consumes the events so 
+        # every repetition needs a new scheduler
+        best = None
+        for i in range(3):
+            pending = scheduler()
+            begin = time.time()
+            fired = sum(len(pending.pop_due(tick)) for tick in ticks)
+            elapsed = time.time() - begin
+            if(fired != expected):
+                raise Exception(str(fired) + " events fired, expected " +
+                                str(expected))
+            if((best == None) or (elapsed < best)):
+                best = elapsed
+        return best
+
+    numpy = mas.numpy
+    begin = time.time()
+    expected = per_object()
+    baseline = (time.time() - begin) / minutes
+    report("per-object time_match", baseline)
+    try:
+        for name, module in [("NumPy", numpy), ("array", None)]:
+            if((name == "NumPy") and (numpy == None)):
+                continue
+            mas.numpy = module
+            report("minute index (" + name + ")", table() / minutes, 
+                   baseline)
+            report("  index and day (on reload)", measure(scheduler))
+    finally:
+        mas.numpy = numpy
+    print("  " + str(expected) + " events fired")
+    print("  (time per evaluated minute unless noted)")
+
+BENCHMARKS = [("parser", benchmark_parser), ("memory", benchmark_memory),
+              ("matching", benchmark_matching)]
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or [name for name, benchmark in BENCHMARKS]
+    for name, benchmark in BENCHMARKS:
+        if(name in names):
+            benchmark()
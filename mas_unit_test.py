@@ -21,7 +21,8 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 ###############################################################################
 
-import unittest
+import unittest, wsgiref.util, tempfile, os, json, time, logging, gzip, io, re
+import threading
 import mas, sunstate, datetime
 
 class TestParsing(unittest.TestCase):
@@ -116,7 +117,7 @@ class TestParsing(unittest.TestCase):
         mas.TimeEvent.RESTRICTION_NONE)
         self.assertTrue(isinstance(event.function,
         mas.FunctionOn))
-        self.assertTrue(event.function.devices == [43])
+        self.assertTrue(event.function.devices == (43,))
         
     def test_parse_EVENT_off(self):
         event = mas.parse_EVENT("EVENT 01:23 Sunup off(1)", 
@@ -127,14 +128,14 @@ class TestParsing(unittest.TestCase):
         mas.TimeEvent.RESTRICTION_SUNUP)
         self.assertTrue(isinstance(event.function,
         mas.FunctionOff))
-        self.assertTrue(event.function.devices == [1])
+        self.assertTrue(event.function.devices == (1,))
     
     def test_parse_EVENT_dim(self):
         event = mas.parse_EVENT("EVENT 01:23 Sundown dim(5,50)",  
         self.telldus_library, self.groups)
         self.assertTrue(isinstance(event.function,
         mas.FunctionDim))
-        self.assertTrue(event.function.devices == [5])
+        self.assertTrue(event.function.devices == (5,))
         self.assertTrue(event.function.dim_level == 50)
 
     def test_parse_EVENT_sunrise(self):
@@ -148,7 +149,7 @@ class TestParsing(unittest.TestCase):
         mas.TimeEvent.RESTRICTION_NONE)
         self.assertTrue(isinstance(event.function,
         mas.FunctionOff))
-        self.assertTrue(event.function.devices == [4])
+        self.assertTrue(event.function.devices == (4,))
 
     def test_parse_EVENT_sunset(self):
         event = mas.parse_EVENT("EVENT Sunset on(7)",  
@@ -161,7 +162,7 @@ class TestParsing(unittest.TestCase):
         mas.TimeEvent.RESTRICTION_NONE)
         self.assertTrue(isinstance(event.function,
         mas.FunctionOn))
-        self.assertTrue(event.function.devices == [7])
+        self.assertTrue(event.function.devices == (7,))
 
     def test_parse_EVENT_sunrise_offset_1(self):
         event = mas.parse_EVENT("EVENT Sunrise+1 off(4)",  
@@ -198,7 +199,7 @@ class TestParsing(unittest.TestCase):
         groups.add(mas.parse_GROUP('GROUP 3 "My name" 2 4 6'))
         event = mas.parse_EVENT("EVENT 01:23 Sundown on(G3)",  
         self.telldus_library, groups)
-        self.assertTrue(event.function.devices == [2,4,6])
+        self.assertTrue(event.function.devices == (2,4,6))
 
     def test_parse_EVENT_group_pass2(self):
         groups = mas.Groups()
@@ -207,8 +208,77 @@ class TestParsing(unittest.TestCase):
         groups.add(mas.parse_GROUP('GROUP 3 "g3" 1 7'))
         event = mas.parse_EVENT("EVENT 01:23 Sundown on(G2)",  
         self.telldus_library, groups)
-        self.assertTrue(event.function.devices == [3])
+        self.assertTrue(event.function.devices == (3,))
         
+    def test_groups_index(self):
+        groups = mas.Groups()
+        self.assertTrue(groups.add(mas.parse_GROUP('GROUP 2 "g2" 1 3 3')))
+        self.assertTrue(groups.add(mas.parse_GROUP('GROUP 1 "g1" 3 4')))
+        self.assertFalse(groups.add(mas.parse_GROUP('GROUP 2 "dup" 5')))
+        self.assertEqual([group.id for group in groups], [2, 1])
+        self.assertEqual(groups.get(1).name, "g1")
+        self.assertTrue(groups.get(3) == None)
+        self.assertEqual([group.id for group in groups.with_device(3)], [2, 1])
+        self.assertEqual([group.id for group in groups.with_device(1)], [2])
+        self.assertEqual(groups.with_device(5), [])
+
+    def test_config_parser_records(self):
+        parser = mas.ConfigParser(mas.Groups())
+        self.assertEqual(parser.parse_line("  # comment"), None)
+        self.assertEqual(parser.parse_line(" \n"), None)
+        self.assertEqual(parser.parse_line("LAT_LONG 59.17 -18.3"), 
+                         mas.LatLongRecord(59.17, -18.3))
+        self.assertEqual(parser.parse_line('GROUP G2 "a (b)" 1 3'),
+                         mas.GroupRecord(2, "a (b)", [1, 3]))
+        parser.groups.add(mas.Group(2, "a (b)", [1, 3]))
+        # Matched by EVENT_RE
+        self.assertEqual(parser.parse_line("EVENT 23:00 Sundown dim(5, 128)"),
+                         mas.EventRecord(23, 0, mas.TimeEvent.ALL_DAYS, 
+                                         mas.TimeEvent.RESTRICTION_SUNDOWN, 
+                                         "dim", False, 5, 128))
+        # Parsed token by token
+        self.assertEqual(parser.parse_line("EVENT Sunset-.5 Sat/Sun on ( G2 )"),
+                         mas.EventRecord(mas.TimeEvent.TIME_SUNSET, -30, 
+                                         0x60, # Sat/Sun
+                                         mas.TimeEvent.RESTRICTION_NONE, 
+                                         "on", True, 2, -1))
+
+    def test_config_parser_errors(self):
+        parser = mas.ConfigParser(mas.Groups(), True)
+        errors = [("EVENT 10:61 on(1)", 10, "minute"), 
+                  ("EVENT 10:00 Mon/Fro on(1)", 17, "'Fro'"),
+                  ("EVENT 10:00 Mon Sunny on(1)", 17, "restriction"),
+                  ("EVENT 10:00 on(G3)", 16, "group '3'"),
+                  ("EVENT 10:00 dim(1)", 18, "level"),
+                  ("EVENT 10:00 dim(1,256)", 19, "dim level"),
+                  ("EVENT 10:00 off(1,5)", 18, "')'"),
+                  ("EVENT 10:00 on(1) x", 19, "unexpected"),
+                  ("EVENT 10:00", 12, "function"),
+                  ("EVENT\tSunset+24 on(1)", 13, "offset"),
+                  ('GROUP 1 "A 2', 9, "name"),
+                  ("GROUP 1 \"A\" 2 x", 15, "device id"),
+                  ("LAT_LONG 59.1 x", 15, "longitude"),
+                  ("EVNT 10:00 on(1)", 1, "unknown")]
+        for line, column, text in errors:
+            try:
+                parser.parse_line(line)
+                self.fail(line)
+            except mas.ConfigSyntaxError as e:
+                self.assertEqual((line, e.column), (line, column))
+                self.assertTrue(text in e.message, e.message)
+        parser = mas.ConfigParser(mas.Groups(), False)
+        with self.assertRaises(mas.ConfigSyntaxError):
+            parser.parse_line("EVENT 10:00 Sunup on(1)")
+
+    def test_parse_EVENT_compact(self):
+        event1 = mas.parse_EVENT("EVENT 10:00 Mon/Wen on(3)", None, None)
+        event2 = mas.parse_EVENT("EVENT 11:00 dim(3,10)", None, None)
+        self.assertEqual(event1.weekday_mask, 0x05)
+        self.assertEqual(event2.weekday_mask, mas.TimeEvent.ALL_DAYS)
+        self.assertTrue(event1.function.devices is event2.function.devices)
+        self.assertFalse(hasattr(event1, '__dict__'))
+        self.assertFalse(hasattr(event2.function, '__dict__'))
+
     def test_parse_EVENT_group_does_not_exist(self):
         groups = mas.Groups()
         with self.assertRaises(Exception):
@@ -229,6 +299,66 @@ class TestParsing(unittest.TestCase):
             mas.parse_EVENT("EVENT Sunset on(1)",  
                     self.telldus_library, groups, False)
 
+class TestConfigCache(unittest.TestCase):
+    CONFIG = (b'LAT_LONG 59.2 18.3\nGROUP 1 "g1" 1 2\n'
+              b'EVENT 10:00 Mon/Fri on(G1)\nEVENT Sunset-1.5 Sundown off(3)\n'
+              b'EVENT 12:00 dim(G1,128)\n')
+
+    def setUp(self):
+        fd, self.config_file = tempfile.mkstemp()
+        os.write(fd, self.CONFIG)
+        os.close(fd)
+        self.cache_file = self.config_file + ".cache"
+
+    def tearDown(self):
+        for name in [self.config_file, self.cache_file]:
+            if os.path.exists(name):
+                os.remove(name)
+
+    def _load(self):
+        events = []
+        groups = mas.Groups()
+        lat_long = mas.load_config(self.config_file, None, events, groups, 
+                                   self.cache_file)
+        return (lat_long, [event.key() for event in events], 
+                [(g.id, g.name, g.devices) for g in groups], events)
+
+    def test_cache(self):
+        parsed = self._load()
+        self.assertTrue(os.path.exists(self.cache_file))
+        cached = self._load()
+        self.assertEqual(cached[0:3], parsed[0:3])
+        # Events on the same group share the device list of the group
+        self.assertTrue(cached[3][0].function.devices is 
+                        cached[3][2].function.devices)
+
+    def test_cache_stale(self):
+        self._load()
+        fo = open(self.config_file, "ab")
+        fo.write(b'EVENT 13:00 on(4)\n')
+        fo.close()
+        key = mas.config_cache_key(self.config_file)
+        self.assertEqual(mas.load_config_cache(self.cache_file, key, None, 
+                                               [], mas.Groups()), (False, None))
+        self.assertEqual(len(self._load()[1]), 4)
+        # A cache written by another version of the parser is not used
+        version = mas.__version__
+        try:
+            mas.__version__ = version + "-other"
+            key = mas.config_cache_key(self.config_file)
+            self.assertEqual(mas.load_config_cache(self.cache_file, key, None,
+                                 [], mas.Groups()), (False, None))
+        finally:
+            mas.__version__ = version
+
+    def test_cache_corrupt(self):
+        self._load()
+        fo = open(self.cache_file, "r+b")
+        fo.seek(-10, os.SEEK_END)
+        fo.truncate()
+        fo.close()
+        self.assertEqual(len(self._load()[1]), 3)
+
 class TestEvent(unittest.TestCase):
     telldus_library = None
     groups = None
@@ -410,6 +540,1002 @@ class TestEvent(unittest.TestCase):
         self.assertTrue(event.time_match(t, datetime.time(13,1),
                                             datetime.time(18,0)))                                             
                         
+class FixedSun:
+    # Sun replacement with the same sunrise and sunset every day
+    def __init__(self, sunrise, sunset):
+        self.sunrise_time = sunrise
+        self.sunset_time = sunset
+    def sunrise(self, when=None):
+        return self.sunrise_time
+    def sunset(self, when=None):
+        return self.sunset_time
+    def suntimes(self, when=None):
+        return (self.sunrise_time, self.sunset_time, datetime.time(14))
+
+class TestScheduler(unittest.TestCase):
+    groups = mas.Groups()
+    sun = FixedSun(datetime.time(10), datetime.time(18))
+
+    def _event(self, line):
+        return mas.parse_EVENT(line, None, self.groups, True)
+
+    def _sun_times(self, day):
+        return (self.sun.sunrise(day), self.sun.sunset(day))
+
+    def _next_time(self, line, now):
+        scheduler = mas.EventScheduler()
+        scheduler.schedule([self._event(line)], self.sun, now)
+        return scheduler.next_time()
+
+    def test_next_time(self):
+        self.assertEqual(self._next_time("EVENT 13:00 on(1)", 
+                                         datetime.datetime(2014,3,3,12,0)),
+                         datetime.datetime(2014,3,3,13,0))
+        self.assertEqual(self._next_time("EVENT 13:00 on(1)", 
+                                         datetime.datetime(2014,3,3,13,0)),
+                         datetime.datetime(2014,3,4,13,0))
+
+    def test_next_time_weekday(self):
+        # 2014-03-03 is a Monday
+        self.assertEqual(self._next_time("EVENT 10:00 Tue/Sat on(1)", 
+                                         datetime.datetime(2014,3,4,11,0)),
+                         datetime.datetime(2014,3,8,10,0))
+
+    def test_next_time_sunset_offset_over_day(self):
+        self.assertEqual(self._next_time("EVENT Sunset+7 on(1)", 
+                                         datetime.datetime(2014,3,3,12,0)),
+                         datetime.datetime(2014,3,4,1,0))
+
+    def test_next_time_never(self):
+        self.assertEqual(self._next_time("EVENT 24:00 on(1)", 
+                                         datetime.datetime(2014,3,3,12,0)),
+                         None)
+
+    def test_pop_due(self):
+        events = [self._event("EVENT 13:00 on(1)"),
+                  self._event("EVENT Sunrise on(2)"),
+                  self._event("EVENT 10:00 off(3)"),
+                  self._event("EVENT 10:00 Sundown off(4)")]
+        scheduler = mas.EventScheduler()
+        scheduler.schedule(events, self.sun, datetime.datetime(2014,3,3,9,0))
+        self.assertEqual(scheduler.next_time(), 
+                         datetime.datetime(2014,3,3,10,0))
+        self.assertEqual(scheduler.pop_due(datetime.datetime(2014,3,3,9,59)),
+                         [])
+        self.assertEqual(scheduler.pop_due(datetime.datetime(2014,3,3,10,0)),
+                         [events[1], events[2]])
+        self.assertEqual(scheduler.next_time(), 
+                         datetime.datetime(2014,3,3,13,0))
+        self.assertEqual(scheduler.pop_due(datetime.datetime(2014,3,3,13,0)),
+                         [events[0]])
+        self.assertEqual(scheduler.next_time(), 
+                         datetime.datetime(2014,3,4,10,0))
+
+    def test_pop_due_catch_up(self):
+        events = [self._event("EVENT 13:00 on(1)"),
+                  self._event("EVENT 13:05 on(2)"),
+                  self._event("EVENT 13:30 on(3)")]
+        scheduler = mas.EventScheduler(10)
+        scheduler.schedule(events, self.sun, datetime.datetime(2014,3,3,9,0))
+        self.assertEqual(scheduler.pop_due(datetime.datetime(2014,3,3,13,12)),
+                         [events[1]])
+        self.assertEqual(scheduler.skipped_count, 1)
+        self.assertEqual(scheduler.replayed_count, 1)
+        self.assertEqual(scheduler.replayed_delay_max, 
+                         datetime.timedelta(minutes = 7))
+        self.assertEqual(scheduler.next_time(), 
+                         datetime.datetime(2014,3,3,13,30))
+        self.assertEqual(scheduler.pop_due(datetime.datetime(2014,3,3,13,30)),
+                         [events[2]])
+        self.assertEqual(scheduler.replayed_count, 1)
+
+    def test_pop_due_long_gap(self):
+        events = [self._event("EVENT 13:00 on(1)"),
+                  self._event("EVENT Sunrise on(2)"),
+                  self._event("EVENT 12:00 Sat off(3)")]
+        scheduler = mas.EventScheduler(10)
+        scheduler.schedule(events, self.sun, datetime.datetime(2014,3,3,9,0))
+        warnings = []
+        handler = logging.Handler(logging.WARNING)
+        handler.emit = warnings.append
+        logging.getLogger().addHandler(handler)
+        try:
+            # Resumed after three days, only the last event is replayed
+            self.assertEqual(
+                scheduler.pop_due(datetime.datetime(2014,3,6,13,5)),
+                [events[0]])
+        finally:
+            logging.getLogger().removeHandler(handler)
+        self.assertEqual(scheduler.skipped_count, 7)
+        self.assertEqual(scheduler.replayed_count, 1)
+        self.assertEqual(len(warnings), 2) # Skipped and replayed
+        self.assertEqual(scheduler.next_time(), 
+                         datetime.datetime(2014,3,7,10,0))
+
+    def test_pop_due_no_catch_up(self):
+        events = [self._event("EVENT 13:00 on(1)")]
+        scheduler = mas.EventScheduler(0)
+        scheduler.schedule(events, self.sun, datetime.datetime(2014,3,3,9,0))
+        self.assertEqual(scheduler.pop_due(datetime.datetime(2014,3,3,13,1)),
+                         [])
+        self.assertEqual(scheduler.next_time(), 
+                         datetime.datetime(2014,3,4,13,0))
+
+    def test_reschedule(self):
+        events = [self._event("EVENT 10:00 off(3)"),
+                  self._event("EVENT Sunrise on(2)"),
+                  self._event("EVENT 13:00 on(1)")]
+        scheduler = mas.EventScheduler()
+        scheduler.schedule(events, self.sun, datetime.datetime(2014,3,3,9,0))
+        scheduler.pop_due(datetime.datetime(2014,3,3,10,0))
+        new_events = [self._event("EVENT 13:00 on(1)"),
+                      self._event("EVENT 10:00 off(3)"),
+                      self._event("EVENT 10:00 off(3)"),
+                      self._event("EVENT 12:00 dim(4,50)")]
+        event_list, added, removed = mas.diff_events(events, new_events)
+        self.assertEqual(event_list[0:2], [events[2], events[0]])
+        self.assertTrue(event_list[2] is new_events[2])
+        self.assertEqual((added, removed), (2, 1))
+        scheduler.schedule(event_list, self.sun, 
+                           datetime.datetime(2014,3,3,10,0))
+        self.assertEqual(scheduler.pop_due(datetime.datetime(2014,3,3,12,0)),
+                         [event_list[3]])
+        self.assertEqual(scheduler.pop_due(datetime.datetime(2014,3,3,13,0)),
+                         [event_list[0]])
+        self.assertEqual(scheduler.pop_due(datetime.datetime(2014,3,4,10,0)),
+                         [event_list[1], event_list[2]])
+
+    def test_reschedule_group_changed(self):
+        groups = mas.Groups()
+        groups.add(mas.parse_GROUP('GROUP 1 "g1" 1 2'))
+        events = [mas.parse_EVENT("EVENT 10:00 on(G1)", None, groups, True)]
+        groups = mas.Groups() # Renumbered with the same devices
+        groups.add(mas.parse_GROUP('GROUP 2 "g1" 1 2'))
+        new_events = [mas.parse_EVENT("EVENT 10:00 on(G2)", None, groups, 
+                                      True)]
+        event_list, added, removed = mas.diff_events(events, new_events)
+        self.assertEqual((added, removed), (1, 1))
+        self.assertEqual(event_list[0].function.group.id, 2)
+        event_list, added, removed = mas.diff_events(event_list, 
+            [mas.parse_EVENT("EVENT 10:00 on(G2)", None, groups, True)])
+        self.assertEqual((added, removed), (0, 0))
+
+    def _reference_index(self, events, day, fixed):
+        # Fire minutes calculated per event, indexed as by EventTable
+        index = {}
+        sunrise, sunset = self._sun_times(day)
+        for row, event in enumerate(events):
+            if((fixed != (event.hour >= 0)) or
+               (not (event.weekday_mask >> day.weekday()) & 1)):
+                continue
+            if(event.hour == mas.TimeEvent.TIME_SUNRISE):
+                minute = sunrise.hour * 60 + sunrise.minute + event.minute
+            elif(event.hour == mas.TimeEvent.TIME_SUNSET):
+                minute = sunset.hour * 60 + sunset.minute + event.minute
+            elif((event.hour > 23) or (event.minute > 59)):
+                continue # Never fires
+            else:
+                minute = event.hour * 60 + event.minute
+            minute %= mas.EventTable.MINUTES_PER_DAY
+            if(fixed):
+                minute += day.weekday() * mas.EventTable.MINUTES_PER_DAY
+            index.setdefault(minute, []).append(row)
+        return index
+
+    def test_event_table(self):
+        events = [self._event(line) for line in [
+                  "EVENT 13:00 on(1)", "EVENT 24:00 on(1)",
+                  "EVENT Sunrise-0.5 Tue/Sun on(2)", "EVENT Sunset+7 off(3)",
+                  "EVENT 10:00 Sundown off(4)", "EVENT 09:00 Sundown off(4)",
+                  "EVENT 18:30 Sunup off(4)", "EVENT 12:00 Sat/Sun off(4)",
+                  "EVENT 13:00 Mon dim(5,10)"]]
+        days = [datetime.date(2014,3,3) + datetime.timedelta(days = days)
+                for days in range(7)]
+        fixed = {}
+        for day in days:
+            fixed.update(self._reference_index(events, day, True))
+        implementations = [mas.numpy]
+        if(mas.numpy != None):
+            implementations.append(None) # Test the array module as well
+        try:
+            for numpy in implementations:
+                mas.numpy = numpy
+                table = mas.EventTable(events)
+                self.assertEqual(table.fixed_index(), fixed)
+                self.assertEqual(fixed[13 * 60], [0, 8])
+                for day in days:
+                    self.assertEqual(
+                        table.sun_index(day.weekday(), *self._sun_times(day)),
+                        self._reference_index(events, day, False))
+        finally:
+            mas.numpy = implementations[0]
+
+    def test_scheduler_index(self):
+        events = [self._event(line) for line in [
+                  "EVENT 13:00 on(1)", "EVENT Sunrise Tue on(2)",
+                  "EVENT 10:00 Sundown off(4)", "EVENT 09:00 Sundown off(4)",
+                  "EVENT 13:00 Mon dim(5,10)", "EVENT 08:00 Sun off(6)"]]
+        scheduler = mas.EventScheduler()
+        scheduler.schedule(events, self.sun, datetime.datetime(2014,3,3,8,0))
+        self.assertEqual(scheduler.next_time(), 
+                         datetime.datetime(2014,3,3,9,0))
+        # Sunrise is 10:00, i.e. 09:00 is before and 10:00 is not
+        self.assertEqual(scheduler.pop_due(datetime.datetime(2014,3,3,9,0)),
+                         [events[3]])
+        # Restrictions are checked when the event fires
+        self.assertEqual(scheduler.next_time(), 
+                         datetime.datetime(2014,3,3,10,0))
+        self.assertEqual(scheduler.pop_due(datetime.datetime(2014,3,3,10,0)),
+                         [])
+        scheduler.pop_due(datetime.datetime(2014,3,3,12,55))
+        self.assertEqual(scheduler.pop_due(datetime.datetime(2014,3,3,13,5)),
+                         [events[0], events[4]])
+        self.assertEqual(scheduler.next_time(), 
+                         datetime.datetime(2014,3,4,9,0))
+        scheduler.pop_due(datetime.datetime(2014,3,4,9,55))
+        self.assertEqual(scheduler.pop_due(datetime.datetime(2014,3,4,10,0)),
+                         [events[1]])
+        # The week wraps from Sunday to Monday
+        scheduler.schedule(events, self.sun, datetime.datetime(2014,3,9,13,0))
+        self.assertEqual(scheduler.next_time(), 
+                         datetime.datetime(2014,3,10,9,0))
+
+    def test_sun_index_cached(self):
+        events = [self._event("EVENT Sunrise Sun on(" + str(i) + ")")
+                  for i in range(2000)]
+        scheduler = mas.EventScheduler()
+        scheduler.schedule(events, self.sun, datetime.datetime(2014,3,3,8,0))
+        built = []
+        sun_index = scheduler.table.sun_index
+        def counting_sun_index(weekday, sunrise, sunset):
+            built.append(weekday)
+            return sun_index(weekday, sunrise, sunset)
+        scheduler.table.sun_index = counting_sun_index
+        for i in range(10):
+            self.assertEqual(scheduler.next_time(), 
+                             datetime.datetime(2014,3,9,10,0))
+        # Every day up to the event built once
+        self.assertEqual(built, [0, 1, 2, 3, 4, 5, 6])
+        scheduler.pop_due(datetime.datetime(2014,3,4,8,0))
+        scheduler.sun_index(datetime.date(2014,3,10))
+        self.assertEqual(sorted(scheduler.days)[0], datetime.date(2014,3,4))
+
+class RecordingLibrary:
+    # Control library replacement recording the commands sent
+    def __init__(self):
+        self.commands = []
+    def _record(self, command, devices, history_command):
+        self.commands.extend([(command, device) for device in devices])
+        for device in devices:
+            if(history_command != None):
+                history_command.done(device)
+    def turn_on(self, devices, history_command = None):
+        self._record("on", devices, history_command)
+    def turn_off(self, devices, history_command = None):
+        self._record("off", devices, history_command)
+    def dim(self, devices, dim_level, history_command = None):
+        self._record(dim_level, devices, history_command)
+
+class TestEventExecutor(unittest.TestCase):
+    def test_device_order(self):
+        library = RecordingLibrary()
+        groups = mas.Groups()
+        groups.add(mas.parse_GROUP('GROUP 1 "g1" 1 2 3 4 5'))
+        history = mas.History()
+        executor = mas.EventExecutor(3, history)
+        for line in ["EVENT 10:00 on(G1)", "EVENT 10:00 off(2)",
+                     "EVENT 10:00 dim(G1,50)", "EVENT 10:00 off(G1)"]:
+            executor.submit(mas.parse_EVENT(line, library, groups))
+        executor.stop()
+        self.assertEqual(len(library.commands), 16)
+        # One record per event
+        self.assertEqual(len(history.query(source = "timer", group = 1)), 3)
+        self.assertEqual([(record.devices, record.level) for record in 
+                          history.query(device = 3, command = "dim")], 
+                         [([1, 2, 3, 4, 5], 50)])
+        for device in [1, 3, 4, 5]:
+            self.assertEqual([c[0] for c in library.commands if c[1] == device],
+                             ["on", 50, "off"])
+        self.assertEqual([c[0] for c in library.commands if c[1] == 2],
+                         ["on", "off", 50, "off"])
+
+class FakeTelldusCore:
+    # telldus-core replacement counting the number of calls
+    def __init__(self, methods):
+        self.methods = methods # Device ID -> supported methods
+        self.names = {}
+        self.protocols = {}
+        self.models = {}
+        self.calls = 0
+        self.sent = []
+        self.failing = set() # Device IDs which sending fails to
+    def tdGetNumberOfDevices(self):
+        self.calls += 1
+        return len(self.methods)
+    def tdGetDeviceId(self, index):
+        self.calls += 1
+        return sorted(self.methods)[index]
+    def tdMethods(self, device_id, methods):
+        self.calls += 1
+        return self.methods.get(device_id, 0) & methods
+    def tdGetName(self, device_id):
+        self.calls += 1
+        return self.names.get(device_id, "Device " + str(device_id))
+    def tdSetName(self, device_id, name):
+        self.calls += 1
+        self.names[device_id] = name.decode('utf-8')
+        return 1
+    def tdGetProtocol(self, device_id):
+        self.calls += 1
+        return self.protocols.get(device_id, "arctech")
+    def tdGetModel(self, device_id):
+        self.calls += 1
+        return self.models.get(device_id, "selflearning-switch")
+    def tdSetProtocol(self, device_id, protocol):
+        self.calls += 1
+        self.protocols[device_id] = protocol.decode('utf-8')
+        return 1
+    def tdSetModel(self, device_id, model):
+        self.calls += 1
+        self.models[device_id] = model.decode('utf-8')
+        return 1
+    def tdGetDeviceParameter(self, device_id, parameter, default):
+        self.calls += 1
+        return default
+    def tdAddDevice(self):
+        self.calls += 1
+        device_id = max(self.methods) + 1
+        self.methods[device_id] = 0
+        return device_id
+    def tdRemoveDevice(self, device_id):
+        self.calls += 1
+        del self.methods[device_id]
+        return 1
+    def _send(self, command, device_id):
+        if(device_id in self.failing):
+            return -1
+        self.sent.append((command, device_id))
+        return 0
+    def tdTurnOn(self, device_id):
+        return self._send("on", device_id)
+    def tdTurnOff(self, device_id):
+        return self._send("off", device_id)
+    def tdDim(self, device_id, level):
+        return self._send(level, device_id)
+    def tdLearn(self, device_id):
+        return self._send("learn", device_id)
+    def tdGetErrorString(self, error):
+        return b"TellStick not found"
+    def tdLastSentCommand(self, device_id, methods):
+        self.calls += 1
+        return 0
+    def tdLastSentValue(self, device_id):
+        self.calls += 1
+        return "0"
+
+ON_OFF = mas.TelldusLibrary.TURNON | mas.TelldusLibrary.TURNOFF
+
+class TestTelldusLibrary(unittest.TestCase):
+    def test_capabilities_cached(self):
+        core = FakeTelldusCore({1 : ON_OFF, 2 : ON_OFF | mas.TelldusLibrary.DIM})
+        library = mas.TelldusLibrary(core)
+        self.assertEqual(library.devices, {}) # Read when first needed
+        for i in range(3):
+            if(i == 1):
+                self.assertTrue(core.calls > 0)
+                core.calls = 0
+            self.assertTrue(library.supports_on_off(1))
+            self.assertFalse(library.supports_dim(1))
+            self.assertTrue(library.supports_dim(2))
+            self.assertFalse(library.supports_learn(2))
+            self.assertEqual(library.get_name(2), "Device 2")
+            library.turn_on([1, 2])
+            library.transmitter.flush()
+            library.dim([2], 100)
+            library.transmitter.flush()
+        self.assertEqual(core.calls, 0)
+        self.assertEqual(core.sent[0:3], [("on", 1), ("on", 2), (100, 2)])
+
+    def test_cache_invalidation(self):
+        core = FakeTelldusCore({1 : ON_OFF})
+        library = mas.TelldusLibrary(core)
+        library.set_name(1, "Porch")
+        self.assertEqual(library.get_name(1), "Porch")
+        device_id = library.new_device()
+        self.assertFalse(library.supports_on_off(device_id))
+        core.methods[device_id] = ON_OFF
+        library.set_model(device_id, "selflearning-switch")
+        self.assertTrue(library.supports_on_off(device_id))
+        library.set_protocol(device_id, "risingsun")
+        self.assertEqual(library.get_protocol(device_id), "risingsun")
+        library.set_model(device_id, "codeswitch")
+        self.assertEqual(library.get_model(device_id), "codeswitch")
+        library.delete_device(device_id)
+        self.assertFalse(library.supports_on_off(device_id))
+
+    def test_device_index(self):
+        core = FakeTelldusCore({1 : ON_OFF, 4 : ON_OFF})
+        library = mas.TelldusLibrary(core)
+        core.calls = 0
+        self.assertTrue(library.has_device(4))
+        self.assertEqual(library.get_device_IDs(), [1, 4])
+        self.assertEqual(core.calls, 0)
+        self.assertFalse(library.has_device(2)) # Checked in telldus-core
+        self.assertTrue(core.calls > 0)
+        device_id = library.new_device()
+        self.assertTrue(library.has_device(device_id))
+        library.delete_device(1)
+        self.assertFalse(library.has_device(1))
+        self.assertEqual(library.get_device_IDs(), [4, device_id])
+
+    def test_changed_outside(self):
+        core = FakeTelldusCore({1 : ON_OFF, 4 : ON_OFF})
+        library = mas.TelldusLibrary(core)
+        snapshot = library.snapshot()
+        core.methods[5] = ON_OFF # Added by tdtool
+        del core.methods[1]
+        core.names[4] = "Porch"
+        self.assertTrue(library.snapshot() is snapshot)
+        self.assertTrue(library.has_device(5))
+        snapshot.time -= library.SNAPSHOT_MAX_AGE
+        snapshot = library.snapshot()
+        self.assertEqual([(device.id, device.name) 
+                          for device in snapshot.devices],
+                         [(4, "Porch"), (5, "Device 5")])
+        self.assertFalse(library.has_device(1))
+
+    def test_snapshot(self):
+        core = FakeTelldusCore({1 : ON_OFF, 2 : ON_OFF | mas.TelldusLibrary.DIM})
+        library = mas.TelldusLibrary(core)
+        snapshot = library.snapshot()
+        self.assertEqual([device.id for device in snapshot.devices], [1, 2])
+        self.assertTrue(snapshot.index[2].supports_dim)
+        self.assertFalse(snapshot.index[1].supports_dim)
+        core.calls = 0
+        self.assertTrue(library.snapshot() is snapshot)
+        self.assertEqual(core.calls, 0)
+        # Command without state change keeps the generation
+        library.turn_on([1])
+        library.transmitter.flush()
+        self.assertFalse(library.snapshot() is snapshot)
+        self.assertEqual(library.snapshot().generation, snapshot.generation)
+        library.set_name(1, "Porch")
+        self.assertEqual(library.snapshot().generation, 
+                         snapshot.generation + 1)
+        self.assertEqual(library.snapshot().index[1].name, "Porch")
+
+class TestHistory(unittest.TestCase):
+    def test_ring_buffer(self):
+        history = mas.History(4)
+        for i in range(6):
+            history.add("timer" if i % 2 else "web", [i, 10], "on", None, 
+                        None, 0.001, "success" if i < 5 else "failed")
+        self.assertEqual(len(history.records), 4)
+        self.assertEqual([record.devices[0] for record in history.query()], 
+                         [5, 4, 3, 2])
+        self.assertEqual(history.query()[0].duration_ms, 1.0)
+        self.assertEqual([record.devices[0] for record in 
+                          history.query(source = "web")], [4, 2])
+        self.assertEqual([record.devices[0] for record in 
+                          history.query(failed = True)], [5])
+        self.assertEqual(len(history.query(device = 10, limit = 3)), 3)
+        self.assertEqual(history.query(device = 1), [])
+        self.assertEqual(history.query(since = time.time() + 1), [])
+
+class TestEventHub(unittest.TestCase):
+    def test_publish(self):
+        hub = mas.EventHub()
+        subscriber1 = hub.subscribe()
+        subscriber2 = hub.subscribe()
+        library = mas.TelldusLibrary(FakeTelldusCore({1 : ON_OFF}), hub)
+        library.turn_on([1])
+        library.transmitter.flush()
+        hub.unsubscribe(subscriber2)
+        library.turn_off([1])
+        library.transmitter.flush()
+        self.assertEqual(subscriber1.get_nowait(), 
+                         ('device', {'id' : 1, 'command' : 'on'}))
+        self.assertEqual(subscriber1.get_nowait(), 
+                         ('device', {'id' : 1, 'command' : 'off'}))
+        self.assertEqual(subscriber2.qsize(), 1)
+
+    def test_full_subscriber(self):
+        hub = mas.EventHub()
+        subscriber = hub.subscribe()
+        for i in range(mas.EventHub.QUEUE_SIZE + 1):
+            hub.publish('test', {'i' : i})
+        self.assertEqual(subscriber.qsize(), mas.EventHub.QUEUE_SIZE)
+
+class TestTransmitQueue(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.sending = threading.Event() # Set when a command is being sent
+        self.lock = threading.Lock()
+        self.lock.acquire() # Blocks the first command until released
+
+    def _send(self, device, command, value):
+        self.sending.set()
+        with self.lock:
+            self.sent.append((device, command, value))
+
+    def test_coalesce(self):
+        history = mas.History()
+        transmitter = mas.TransmitQueue(self._send)
+        transmitter.put(9, "on")
+        self.assertTrue(self.sending.wait(5))
+        for level in [10, 20, 30]:
+            transmitter.put(1, "dim", level, 
+                            mas.HistoryCommand(history, "web", [1], "dim", 
+                                               level))
+        transmitter.put(2, "on")
+        transmitter.put(1, "learn")
+        transmitter.put(1, "off")
+        transmitter.put(2, "off")
+        self.assertEqual(transmitter.depth(), 4)
+        self.lock.release()
+        transmitter.stop()
+        self.assertEqual(self.sent, [(9, "on", None), (1, "dim", 30), 
+                                     (2, "off", None), (1, "learn", None),
+                                     (1, "off", None)])
+        metrics = transmitter.metrics()
+        self.assertEqual(metrics['sent'], 5)
+        self.assertEqual(metrics['coalesced'], 3)
+        self.assertEqual(metrics['depth'], 0)
+        self.assertEqual([(record.level, record.result) 
+                          for record in history.query()],
+                         [(30, "success"), (20, "coalesced"), 
+                          (10, "coalesced")])
+        self.assertEqual(history.query(failed = True), [])
+
+def wsgi_request(app, path, method = "GET", headers = {}, body = b""):
+    # Call the WSGI application, returns (status, headers, body) with
+    # lower case header names
+    environ = {}
+    wsgiref.util.setup_testing_defaults(environ)
+    environ['REQUEST_METHOD'] = method
+    environ['PATH_INFO'], environ['QUERY_STRING'] = (path + "?").split("?")[0:2]
+    environ['CONTENT_LENGTH'] = str(len(body))
+    environ['wsgi.input'] = io.BytesIO(body)
+    for name, value in headers.items():
+        name = name.upper().replace('-', '_')
+        if(name != 'CONTENT_TYPE'):
+            name = 'HTTP_' + name
+        environ[name] = value
+    response = []
+    def start_response(status, response_headers, exc_info = None):
+        response.append((int(status.split()[0]), 
+                         dict((name.lower(), value) 
+                              for name, value in response_headers)))
+    result = b"".join(app(environ, start_response))
+    return response[0][0], response[0][1], result
+
+class TestLogWriter(unittest.TestCase):
+    def setUp(self):
+        fd, self.log_file = tempfile.mkstemp()
+        os.close(fd)
+        self.writer = mas.LogWriter(self.log_file, 300, 0, 2)
+        self.writer.setFormatter(logging.Formatter(
+            "%(asctime)s - %(levelname)s - %(message)s"))
+        self.logger = logging.getLogger("TestLogWriter")
+        self.logger.propagate = False
+        self.logger.addHandler(self.writer)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.writer)
+        self.writer.close()
+        for name in [self.log_file] + mas.LogReader(self.log_file).rotated():
+            os.remove(name)
+
+    def test_rotate(self):
+        rename = os.rename
+        def windows_rename(source, target):
+            if(os.path.exists(target)):
+                raise OSError("Cannot create a file when it already exists")
+            rename(source, target)
+        os.rename = windows_rename
+        try:
+            for i in range(30):
+                self.logger.warning("Message %d", i)
+                self.writer.flush() # Rotated after every batch of entries
+        finally:
+            os.rename = rename
+        reader = mas.LogReader(self.log_file)
+        self.assertEqual(reader.rotated(), 
+                         [mas.rotated_log_file(self.log_file, 1),
+                          mas.rotated_log_file(self.log_file, 2)])
+        self.assertTrue(os.path.getsize(self.log_file) < 300)
+        # The oldest entries are in the removed third rotated log
+        entries, first, size = reader.page(100)
+        numbers = [int(entry.split()[-1]) for entry in entries]
+        self.assertEqual(numbers, list(range(29, 29 - len(numbers), -1)))
+        self.assertTrue(len(numbers) < 30)
+        self.assertEqual(first[0], 2)
+        # Page across the rotated logs
+        entries, first, size = reader.page(3, (1, 0))
+        self.assertEqual(first[0], 2)
+        entries, first, size = reader.page(3, (2, 0))
+        self.assertEqual((entries, first), ([], (2, 0)))
+
+    def test_dropped(self):
+        queue_size = mas.LogWriter.QUEUE_SIZE
+        mas.LogWriter.QUEUE_SIZE = 1 # Most entries are dropped
+        try:
+            writer = mas.LogWriter(self.log_file + ".dropped", 0)
+        finally:
+            mas.LogWriter.QUEUE_SIZE = queue_size
+        logger = logging.getLogger("TestLogWriter.dropped")
+        logger.propagate = False
+        logger.addHandler(writer)
+        def log():
+            for i in range(500):
+                logger.warning("Message")
+        threads = [threading.Thread(target = log) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        writer.flush()
+        logger.warning("Message") # Writes the last dropped count
+        logger.removeHandler(writer)
+        writer.close()
+        fo = open(self.log_file + ".dropped")
+        lines = fo.read().splitlines()
+        fo.close()
+        os.remove(self.log_file + ".dropped")
+        dropped = [int(line.split()[0]) for line in lines 
+                   if(line.endswith("log entries dropped"))]
+        self.assertEqual(len(lines) - len(dropped) + sum(dropped) + 
+                         writer.dropped, 2001)
+
+class TestWebAPI(unittest.TestCase):
+    def setUp(self):
+        self.core = FakeTelldusCore({1 : ON_OFF, 
+                                     2 : ON_OFF | mas.TelldusLibrary.DIM})
+        self.control = mas.TelldusLibrary(self.core)
+        self.groups = mas.Groups()
+        self.groups.add(mas.parse_GROUP('GROUP 1 "g1" 1 2'))
+        fd, self.config_file = tempfile.mkstemp()
+        os.write(fd, b'GROUP 1 "g1" 1 2\nEVENT 10:00 on(G1)\n')
+        os.close(fd)
+        self.timer_thread = mas.TimerThread([], None, 1)
+        self.config = mas.Configuration(self.config_file, self.control, 
+                                        self.groups, self.timer_thread)
+        self.api = mas.WebAPI("localhost", 8080, "wsgiref", self.control, 
+                              self.config, self.config_file + ".log")
+
+    def tearDown(self):
+        self.timer_thread.executor.stop()
+        for name in [self.config_file, self.config_file + ".bk", 
+                     self.config_file + ".tmp", self.config_file + ".log"]:
+            if os.path.exists(name):
+                os.remove(name)
+
+    def test_get_devices(self):
+        status, headers, body = wsgi_request(self.api.app, "/devices")
+        self.assertEqual(status, 200)
+        devices = json.loads(body.decode('utf-8'))
+        self.assertEqual([device['id'] for device in devices], [1, 2])
+        self.assertTrue(devices[1]['supports_dim'])
+
+    def test_device_groups(self):
+        status, headers, body = wsgi_request(self.api.app, "/device/2/groups")
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(body.decode('utf-8')), 
+                         [{'id' : 1, 'name' : 'g1'}])
+        status, headers, body = wsgi_request(self.api.app, "/device/7/groups")
+        self.assertEqual(status, 400)
+
+    def test_conditional_get(self):
+        for path in ["/devices", "/groups", "/configuration"]:
+            status, headers, body = wsgi_request(self.api.app, path)
+            self.assertEqual(status, 200)
+            etag = headers['etag']
+            status, headers, body = wsgi_request(self.api.app, path, 
+                                        headers = {'If-None-Match' : etag})
+            self.assertEqual(status, 304)
+            self.assertEqual(body, b"")
+        status, headers, body = wsgi_request(self.api.app, "/devices")
+        etag = headers['etag']
+        self.control.set_name(1, "Porch")
+        status, headers, body = wsgi_request(self.api.app, "/devices", 
+                                        headers = {'If-None-Match' : etag})
+        self.assertEqual(status, 200)
+        self.assertNotEqual(headers['etag'], etag)
+
+    def test_batch(self):
+        operations = [{'device' : 1, 'action' : 'on'},
+                      {'device' : 2, 'action' : 'on'},
+                      {'device' : 3, 'action' : 'on'},
+                      {'device' : 1, 'action' : 'dim', 'level' : 10},
+                      {'group' : 1, 'action' : 'dim', 'level' : 300},
+                      {'group' : 1, 'action' : 'off'},
+                      {'device' : 2, 'action' : 'dim', 'level' : 10},
+                      {'device' : 2, 'group' : 1, 'action' : 'on'}]
+        status, headers, body = wsgi_request(self.api.app, "/batch", "POST",
+            {'Content-Type' : 'application/json'}, 
+            json.dumps(operations).encode('utf-8'))
+        self.assertEqual(status, 200)
+        results = [r['result'] for r in 
+                   json.loads(body.decode('utf-8'))['results']]
+        self.assertEqual(results, ['success', 'success', 'error', 'error', 
+                                   'error', 'success', 'success', 'error'])
+        self.control.transmitter.flush()
+        # Queued commands may be replaced by later ones to the same device
+        last_sent = dict((device, command) for command, device in self.core.sent)
+        self.assertEqual(last_sent, {1 : 'off', 2 : 10})
+
+    def test_batch_groups(self):
+        history = mas.History()
+        api = mas.WebAPI("localhost", 8080, "wsgiref", self.control, 
+                         self.config, "", None, history)
+        operations = [{'group' : 1, 'action' : 'on'},
+                      {'device' : 1, 'action' : 'on'},
+                      {'device' : 2, 'action' : 'on'}]
+        status, headers, body = wsgi_request(api.app, "/batch", "POST",
+            {'Content-Type' : 'application/json'}, 
+            json.dumps(operations).encode('utf-8'))
+        self.assertEqual(json.loads(body.decode('utf-8'))['results'][0],
+                         {'result' : 'success', 'group' : 1})
+        self.control.transmitter.flush()
+        self.assertEqual([(record.group, record.devices) 
+                          for record in history.query()],
+                         [(None, [1, 2]), (1, [1, 2])])
+
+    def test_batch_invalid_id(self):
+        for id in ['true', 'false', '"1"', '[1]', '1.0', 'null']:
+            status, headers, body = wsgi_request(self.api.app, "/batch", 
+                "POST", {'Content-Type' : 'application/json'}, 
+                ('[{"device" : 1, "action" : "on"}, {"device" : ' + id + 
+                 ', "action" : "on"}]').encode('utf-8'))
+            self.assertEqual(status, 400)
+            status, headers, body = wsgi_request(self.api.app, "/batch", 
+                "POST", {'Content-Type' : 'application/json'}, 
+                ('[{"group" : ' + id + ', "action" : "on"}]').encode('utf-8'))
+            self.assertEqual(status, 400)
+        self.control.transmitter.flush()
+        self.assertEqual(self.core.sent, [])
+
+    def test_batch_not_list(self):
+        status, headers, body = wsgi_request(self.api.app, "/batch", "POST",
+            {'Content-Type' : 'application/json'}, b'{"device" : 1}')
+        self.assertEqual(status, 400)
+
+    def test_set_config(self):
+        status, headers, body = wsgi_request(self.api.app, "/configuration",
+            "POST", {'Content-Type' : 'text/plain'}, 
+            b'GROUP 1 "g1" 1\nGROUP 2 "g2" 2\nEVENT 10:00 on(G1)\n')
+        self.assertEqual(status, 200)
+        changes = json.loads(body.decode('utf-8'))['changes']
+        self.assertEqual(changes['events'], 
+                         {'added' : 1, 'removed' : 0, 'unchanged' : 0})
+        self.assertEqual(changes['groups'], 
+                         {'added' : [2], 'removed' : [], 'changed' : [1]})
+        self.assertEqual(self.config.groups.get(1).devices, [1])
+        # Not reloaded again by the watcher
+        self.assertEqual(self.config.reload_if_changed(), None)
+
+    def test_set_config_watched(self):
+        watcher = mas.ConfigWatcher(self.config, False)
+        watcher.POLL_SECONDS = 0.01
+        change_data = self.timer_thread.change_data
+        def slow_change_data(events, sun):
+            time.sleep(0.1) # The watcher polls while the file is applied
+            return change_data(events, sun)
+        self.timer_thread.change_data = slow_change_data
+        watcher.start()
+        try:
+            status, headers, body = wsgi_request(self.api.app, 
+                "/configuration", "POST", {'Content-Type' : 'text/plain'}, 
+                b'GROUP 1 "g1" 2\nEVENT 11:00 on(G1)\n')
+            time.sleep(0.1)
+        finally:
+            watcher.stop()
+        self.assertEqual(status, 200)
+        self.assertEqual(self.config.version, 1)
+
+    def _write_config(self, text):
+        fo = open(self.config_file, "w")
+        fo.write(text)
+        fo.close()
+        # Make the file stamp differ within the file system time resolution
+        stamp = self.config.stamp
+        os.utime(self.config_file, (stamp[0] + 10, stamp[0] + 10))
+
+    def test_reload_if_changed(self):
+        self.assertEqual(self.config.reload_if_changed(), None)
+        self._write_config('GROUP 1 "g1" 2\nEVENT 10:00 on(G1)\n')
+        changes = self.config.reload_if_changed()
+        self.assertEqual(changes['groups']['changed'], [1])
+        self.assertEqual(self.config.version, 1)
+        # Invalid file keeps the running configuration
+        self._write_config('GROUP 1 "g1" 2\nEVENT 10:00 on(G2)\n')
+        self.assertEqual(self.config.reload_if_changed(), None)
+        self.assertEqual(self.config.groups.get(1).devices, [2])
+
+    def test_config_watcher(self):
+        watchers = [mas.ConfigWatcher(self.config, False)]
+        inotify_watcher = mas.ConfigWatcher(self.config)
+        if(inotify_watcher.inotify != None):
+            watchers.append(inotify_watcher)
+        for version, watcher in enumerate(watchers):
+            watcher.POLL_SECONDS = 0.05
+            watcher.SETTLE_SECONDS = 0.05
+            watcher.start()
+            self._write_config('GROUP 1 "g1" ' + str(version) + '\n')
+            for i in range(100):
+                if(self.config.version > version):
+                    break
+                time.sleep(0.05)
+            watcher.stop()
+            self.assertEqual(self.config.version, version + 1)
+
+    def test_status(self):
+        status, headers, body = wsgi_request(self.api.app, "/status")
+        self.assertEqual(status, 200)
+        result = json.loads(body.decode('utf-8'))
+        self.assertEqual(result['transmitter']['depth'], 0)
+        self.assertEqual(result['scheduler']['skipped'], 0)
+
+    def _get_log(self, query):
+        status, headers, body = wsgi_request(self.api.app, "/log?" + query)
+        self.assertEqual(status, 200)
+        return (body.decode('utf-8').splitlines(), 
+                headers['x-log-before'], headers['x-log-after'])
+
+    def test_get_log(self):
+        entry = "2014-03-03 10:00:%02d,000 - %s - Message %d\n"
+        fo = open(self.config_file + ".log", "w")
+        for i in range(50):
+            fo.write(entry % (i, "WARNING" if i % 10 == 0 else "INFO", i))
+        fo.write("Syntax error\n   EVENT 10:00 on(G2)\n")
+        fo.close()
+        block_size = mas.LogReader.BLOCK_SIZE
+        mas.LogReader.BLOCK_SIZE = 16 # Entries span several blocks
+        try:
+            lines, before, after = self._get_log("limit=3")
+            self.assertEqual(lines[0], (entry % (49, "INFO", 49)).rstrip())
+            self.assertEqual(lines[1:3], 
+                             ["Syntax error", "   EVENT 10:00 on(G2)"])
+            self.assertTrue(lines[4].endswith("Message 47"))
+            lines, before, after = self._get_log("limit=2&before=" + 
+                                                 str(before))
+            self.assertEqual([line[-10:] for line in lines], 
+                             ["Message 46", "Message 45"])
+            lines, before, after = self._get_log("level=warning&before=" +
+                                                 str(before))
+            self.assertEqual([line[-10:] for line in lines], 
+                ["Message 40", "Message 30", "Message 20", "Message 10",
+                 " Message 0"])
+            self.assertEqual(before, "0:0")
+            lines, before, after = self._get_log("after=" + str(after))
+            self.assertEqual(lines, [])
+            fo = open(self.config_file + ".log", "a")
+            fo.write(entry % (51, "ERROR", 51))
+            fo.close()
+            lines, before, after = self._get_log("after=" + str(after))
+            self.assertEqual(len(lines), 1)
+            self.assertTrue(lines[0].endswith("ERROR - Message 51"))
+        finally:
+            mas.LogReader.BLOCK_SIZE = block_size
+        for query in ["level=LOUD", "limit=0", "limit=-1", "limit=x"]:
+            status, headers, body = wsgi_request(self.api.app, "/log?" + query)
+            self.assertEqual(status, 400)
+
+    def test_history(self):
+        status, headers, body = wsgi_request(self.api.app, "/history")
+        self.assertEqual(status, 404)
+        history = mas.History()
+        api = mas.WebAPI("localhost", 8080, "wsgiref", self.control, 
+                         self.config, "", None, history)
+        wsgi_request(api.app, "/device/1/on")
+        wsgi_request(api.app, "/group/1/dim/10")
+        wsgi_request(api.app, "/device/3/on") # Not executed
+        self.control.transmitter.flush()
+        status, headers, body = wsgi_request(api.app, "/history?source=web")
+        self.assertEqual(status, 200)
+        records = json.loads(body.decode('utf-8'))
+        self.assertEqual([(r['command'], r['devices'], r['level'], r['group'])
+                          for r in records], 
+                         [("dim", [1, 2], 10, 1), ("on", [1], None, None)])
+        self.assertEqual(records[0]['result'], "device 1: cannot be dimmed")
+        self.assertEqual(records[1]['result'], "success")
+        self.assertTrue(records[1]['duration_ms'] >= 0)
+        # Failed when telldus-core returns an error
+        self.core.failing.add(2)
+        wsgi_request(api.app, "/group/1/on")
+        self.control.transmitter.flush()
+        status, headers, body = wsgi_request(api.app, 
+                                             "/history?result=error&limit=1")
+        records = json.loads(body.decode('utf-8'))
+        self.assertEqual([(r['command'], r['group'], r['result']) 
+                          for r in records], 
+                         [("on", 1, "device 2: TellStick not found")])
+        status, headers, body = wsgi_request(api.app, "/history?group=1")
+        self.assertEqual(len(json.loads(body.decode('utf-8'))), 2)
+        status, headers, body = wsgi_request(api.app, "/history?device=x")
+        self.assertEqual(status, 400)
+
+    def test_static_files(self):
+        status, headers, body = wsgi_request(self.api.app, "/", 
+            headers = {'Accept-Encoding' : 'gzip, deflate'})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        self.assertEqual(headers['cache-control'], 'no-cache')
+        self.assertEqual(gzip.GzipFile(fileobj = io.BytesIO(body)).read(), 
+                         self.api.static.get("index.html").variants[None])
+        status, headers, body = wsgi_request(self.api.app, "/", 
+            headers = {'Accept-Encoding' : 'gzip', 
+                       'If-None-Match' : headers['etag']})
+        self.assertEqual(status, 304)
+        self.assertEqual(headers['cache-control'], 'no-cache')
+        status, headers, body = wsgi_request(self.api.app, "/markdown.min.js",
+            headers = {'Accept-Encoding' : 'gzip;q=0, br;q=0'})
+        self.assertEqual(status, 200)
+        self.assertTrue('content-encoding' not in headers)
+        self.assertTrue(headers['cache-control'].startswith('public'))
+        self.assertTrue(headers['content-type'].endswith('javascript; ' +
+                                                         'charset=UTF-8'))
+        status, headers, body = wsgi_request(self.api.app, "/mas.png", 
+            headers = {'Accept-Encoding' : 'gzip'})
+        self.assertTrue('content-encoding' not in headers)
+        status, headers, body = wsgi_request(self.api.app, "/missing.js")
+        self.assertEqual(status, 404)
+
+    def test_fingerprinted_files(self):
+        status, headers, body = wsgi_request(self.api.app, "/")
+        match = re.search(r'src="(jquery-1\.11\.1\.min\.[0-9a-f]{12}\.js)"', 
+                          body.decode('utf-8'))
+        self.assertTrue(match != None)
+        status, headers, body = wsgi_request(self.api.app, 
+                                             "/" + match.group(1))
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['cache-control'], 
+                         "public, max-age=31536000, immutable")
+        status, headers, original = wsgi_request(self.api.app, 
+                                                 "/jquery-1.11.1.min.js")
+        self.assertEqual(original, body)
+        self.assertFalse("immutable" in headers['cache-control'])
+        # Pages referring to fingerprinted names are always revalidated
+        for path in ["/index.html", "/mas_green.min.css"]:
+            status, headers, body = wsgi_request(self.api.app, path)
+            self.assertEqual(headers['cache-control'], "no-cache")
+        # References in CSS files are relative the CSS file
+        files = mas.StaticFiles(tempfile.gettempdir() + "/no_such_dir")
+        files.add("images/a.gif", b"GIF")
+        files.add("css/b.css", files._rewrite("css/b.css", 
+            b'.a{background:url("../images/a.gif")} .b{url(data:x/y)}'))
+        self.assertEqual(files.get("css/b.css").variants[None],
+            b'.a{background:url("../images/a.' + 
+            files.get("images/a.gif").etag[:12].encode('ascii') + 
+            b'.gif")} .b{url(data:x/y)}')
+
+    def test_event_stream_limit(self):
+        hub = mas.EventHub()
+        api = mas.WebAPI("localhost", 8080, "cherrypy", self.control, 
+                         self.config, "", hub)
+        subscribers = [hub.subscribe() 
+                       for i in range(mas.WebAPI.MAX_EVENT_STREAMS)]
+        status, headers, body = wsgi_request(api.app, "/events")
+        self.assertEqual(status, 503)
+        self.assertEqual(len(hub.subscribers), mas.WebAPI.MAX_EVENT_STREAMS)
+        hub.unsubscribe(subscribers[0])
+        self.assertTrue(hub.subscribe(mas.WebAPI.MAX_EVENT_STREAMS) != None)
+        self.assertEqual(hub.subscribe(mas.WebAPI.MAX_EVENT_STREAMS), None)
+
+    def test_event_stream(self):
+        hub = mas.EventHub()
+        api = mas.WebAPI("localhost", 8080, "cherrypy", self.control, 
+                         self.config, "", hub)
+        stream = api._event_stream(hub.subscribe())
+        self.assertTrue(next(stream).startswith("retry:"))
+        hub.publish('device', {'id' : 1, 'command' : 'on'})
+        message = next(stream)
+        self.assertTrue(message.startswith("event: device\ndata: "))
+        self.assertEqual(json.loads(message.split("data: ")[1]), 
+                         {'id' : 1, 'command' : 'on'})
+        stream.close()
+        self.assertEqual(hub.subscribers, [])
+
 class TestSun(unittest.TestCase):
     # NOTE! These test cases will only pass if script is executed
     # on a computer located in Sweden or in a country with equal
@@ -461,6 +1587,52 @@ class TestSun(unittest.TestCase):
         self.assertFalse(s.sunup(datetime.datetime(
             t[0],t[1],t[2],t[5],t[6]+10)))             
         
+    def test_suntimes(self):
+        s = sunstate.Sun(59.20, 18.3, sunstate.LocalTimezone())
+        date = datetime.date(2014, 6, 15)
+        self.assertEqual(s.suntimes(date), 
+                         (s.sunrise(date), s.sunset(date), s.solarnoon(date)))
+        self.assertTrue(s.sunrise(date) < s.solarnoon(date) < s.sunset(date))
+
+    def test_suntimes_cache_eviction(self):
+        s = sunstate.Sun(59.20, 18.3, sunstate.LocalTimezone(), 2)
+        days = [datetime.date(2014, 6, d) for d in [1, 2, 3]]
+        times = [s.suntimes(day) for day in days]
+        self.assertTrue(s.suntimes(days[2]) is times[2])
+        self.assertFalse(s.suntimes(days[0]) is times[0])
+        self.assertEqual(s.suntimes(days[0]), times[0])
+
+    def test_table(self):
+        s = sunstate.Sun(59.20, 18.3, sunstate.LocalTimezone())
+        table = s.table(2014)
+        self.assertEqual(len(table), 365)
+        date = datetime.date(2014, 3, 30)
+        self.assertEqual(table[date.toordinal()], s.suntimes(date))
+
+    def test_suntimes_array(self):
+        lats  = [59.20, 55.6, 63.8, -33.9, 40.4]
+        longs = [18.3, 13.0, 20.3, 18.4, -3.7]
+        dates = [datetime.date(2014, 1, 1), datetime.date(2014, 3, 30),
+                 datetime.date(2014, 6, 15), datetime.date(2014, 10, 26),
+                 datetime.date(2015, 12, 15)]
+        days = [d.toordinal() for d in dates]
+        numpy = sunstate.numpy
+        try:
+            for module in [numpy, None]:
+                sunstate.numpy = module
+                result = sunstate.suntimes_array(lats, longs, days, 
+                                                 sunstate.LocalTimezone())
+                for i in range(len(days)):
+                    s = sunstate.Sun(lats[i], longs[i], 
+                                     sunstate.LocalTimezone())
+                    expected = s.suntimes(dates[i])
+                    for j in range(3):
+                        self.assertEqual(
+                            sunstate.timefromdecimalday(result[j][i]),
+                            expected[j])
+        finally:
+            sunstate.numpy = numpy
+
     def _test_sunrise_sunset(self, lat, long, year, month, day, 
                 expected_sunrise_hour, expected_sunrise_minute, 
                 expected_sunset_hour, expected_sunset_minute):
@@ -15,9 +15,130 @@
 from math import cos,sin,acos,asin,tan
 from math import degrees as deg, radians as rad
 from datetime import date,datetime,time, tzinfo, timedelta
-import sys
+from collections import OrderedDict
+import sys, threading
 import time as _time
 
+try:
+    import numpy
+except ImportError:
+    numpy = None # Optional, only used by suntimes_array
+
+# datetime days are numbered in the Gregorian calendar while the
+# calculations from NOAA are distibuted as OpenOffice spreadsheets
+# with days numbered from 1/1/1900. The difference are those numbers
+# taken for 18/12/2010
+NOAA_DAY_OFFSET = 734124-40529
+
+class _Functions(object):
+    '''
+    The trigonometric functions used by the NOAA equations, either
+    from the math module (scalars) or from NumPy (arrays)
+    '''
+    def __init__(self, cos, sin, acos, asin, tan, deg, rad):
+        self.cos = cos
+        self.sin = sin
+        self.acos = acos
+        self.asin = asin
+        self.tan = tan
+        self.deg = deg
+        self.rad = rad
+
+_scalar = _Functions(cos, sin, acos, asin, tan, deg, rad)
+
+def _noaa(latitude, longitude, day, time, offset, f):
+    '''
+    The NOAA equations for solar noon, sunrise and sunset (in this order
+    returned as decimal days). The arguments may be scalars or arrays
+    depending on the functions f.
+
+    latitude  -- in decimal degrees, north is positive
+    longitude -- in decimal degrees, east is positive
+    day       -- daynumber 1=1/1/1900
+    time      -- percentage past midnight, i.e. noon  is 0.5
+    offset    -- in hours, east is positive
+    '''
+    Jday     =day+2415018.5+time-offset/24 # Julian day
+    Jcent    =(Jday-2451545)/36525    # Julian century
+    
+    Manom    = 357.52911+Jcent*(35999.05029-0.0001537*Jcent)
+    Mlong    = 280.46646+Jcent*(36000.76983+Jcent*0.0003032)%360
+    Eccent   = 0.016708634-Jcent*(0.000042037+0.0001537*Jcent)
+    Mobliq   = 23+(26+((21.448-Jcent*(46.815+Jcent*(0.00059-Jcent*0.001813))))/60)/60
+    obliq    = Mobliq+0.00256*f.cos(f.rad(125.04-1934.136*Jcent))
+    vary     = f.tan(f.rad(obliq/2))*f.tan(f.rad(obliq/2))
+    Seqcent  = f.sin(f.rad(Manom))*(1.914602-Jcent*(0.004817+0.000014*Jcent))+f.sin(f.rad(2*Manom))*(0.019993-0.000101*Jcent)+f.sin(f.rad(3*Manom))*0.000289
+    Struelong= Mlong+Seqcent
+    Sapplong = Struelong-0.00569-0.00478*f.sin(f.rad(125.04-1934.136*Jcent))
+    declination = f.deg(f.asin(f.sin(f.rad(obliq))*f.sin(f.rad(Sapplong))))
+    
+    eqtime   = 4*f.deg(vary*f.sin(2*f.rad(Mlong))-2*Eccent*f.sin(f.rad(Manom))+4*Eccent*vary*f.sin(f.rad(Manom))*f.cos(2*f.rad(Mlong))-0.5*vary*vary*f.sin(4*f.rad(Mlong))-1.25*Eccent*Eccent*f.sin(2*f.rad(Manom)))
+    
+    hourangle= f.deg(f.acos(f.cos(f.rad(90.833))/(f.cos(f.rad(latitude))*f.cos(f.rad(declination)))-f.tan(f.rad(latitude))*f.tan(f.rad(declination))))
+    
+    solarnoon_t=(720-4*longitude-eqtime+offset*60)/1440
+    sunrise_t  =solarnoon_t-hourangle*4/1440
+    sunset_t   =solarnoon_t+hourangle*4/1440
+    return (solarnoon_t, sunrise_t, sunset_t)
+
+def timefromdecimalday(day):
+    '''
+    returns a datetime.time object.
+    
+    day is a decimal day between 0.0 and 1.0, e.g. noon = 0.5
+    '''
+    hours  = 24.0*day
+    h      = int(hours)
+    minutes= (hours-h)*60
+    m      = int(minutes)
+    seconds= (minutes-m)*60
+    s      = int(seconds)
+    return time(hour=h,minute=m,second=s)
+
+def _utcoffset(ordinal_day, timezone):
+    '''
+    UTC offset in hours at noon of the ordinal day
+    '''
+    dt = datetime.combine(date.fromordinal(ordinal_day),
+                          time(hour=12, tzinfo=timezone))
+    utc_offset=dt.utcoffset()
+    if utc_offset is None:
+        return 0
+    return utc_offset.seconds/3600.0+(utc_offset.days*24)
+
+def suntimes_array(lats,longs,days,timezone=None):
+    '''
+    Calculate sunrise, sunset and solar noon for many locations and days
+    at once. lats, longs and days (ordinal days, see date.toordinal) are
+    sequences of equal length. Returns a tuple (sunrise, sunset, 
+    solarnoon) of sequences with decimal days (see timefromdecimalday).
+
+    If NumPy is installed all days are calculated in one vectorized 
+    pass (NumPy arrays are returned), otherwise the scalar equations are
+    used for each day (lists are returned). If none is given for 
+    timezone a local time zone is assumed.
+    '''
+    if timezone is None : timezone = LocalTimezone()
+    offsets = {}
+    for day in set(days):
+        offsets[day] = _utcoffset(day, timezone)
+    if numpy is None:
+        result = ([], [], [])
+        for lat, long, day in zip(lats, longs, days):
+            solarnoon_t, sunrise_t, sunset_t = _noaa(lat, long, 
+                day-NOAA_DAY_OFFSET, 0.5, offsets[day], _scalar)
+            result[0].append(sunrise_t)
+            result[1].append(sunset_t)
+            result[2].append(solarnoon_t)
+        return result
+    f = _Functions(numpy.cos, numpy.sin, numpy.arccos, numpy.arcsin, 
+                   numpy.tan, numpy.degrees, numpy.radians)
+    solarnoon_t, sunrise_t, sunset_t = _noaa(
+        numpy.asarray(lats, dtype=float), numpy.asarray(longs, dtype=float),
+        numpy.asarray(days, dtype=float)-NOAA_DAY_OFFSET, 0.5, 
+        numpy.array([offsets[day] for day in days], dtype=float), f)
+    return (sunrise_t, sunset_t, solarnoon_t)
+
 class LocalTimezone(tzinfo):
     '''
     This class represent the local time zone (on the computer
@@ -53,9 +174,13 @@ class Sun:
     http://www.srrb.noaa.gov/highlights/sunrise/calcdetails.html
 
     typical use, calculating the sunrise at the present day
+
+    The results are cached per day, the least recently used days
+    are evicted when more than cache_size days are cached.
     '''
+    CACHE_SIZE = 366 # Days
     
-    def __init__(self,lat,long,timezone=None):
+    def __init__(self,lat,long,timezone=None,cache_size=CACHE_SIZE):
         '''   
         If none is given for timezone a local time zone is assumed 
         (including daylight saving if present)
@@ -64,6 +189,42 @@ class Sun:
         self.long=long
         if timezone == None : self.timezone = LocalTimezone()
         self.timezone = timezone
+        self.cache_size = cache_size
+        self.__cache = OrderedDict() # ordinal day -> suntimes
+        self.__lock = threading.Lock()
+        
+    def suntimes(self,when=None):
+        '''
+        return a tuple (sunrise, sunset, solarnoon) of datetime.time
+        objects from a single calculation. when is a datetime.date 
+        object. If no date is given current date is assumed.
+        '''
+        if when is None : when = date.today()
+        key = when.toordinal()
+        with self.__lock:
+            times = self.__cache.pop(key, None)
+            if times is None:
+                self.__preptime(when)
+                self.__calc()
+                times = (timefromdecimalday(self.sunrise_t),
+                         timefromdecimalday(self.sunset_t),
+                         timefromdecimalday(self.solarnoon_t))
+                if len(self.__cache) >= self.cache_size:
+                    self.__cache.popitem(last=False)
+            self.__cache[key] = times
+        return times
+
+    def table(self,year):
+        '''
+        return a dictionary with suntimes for every day in year
+        keyed by ordinal day (see datetime.date.toordinal)
+        '''
+        result = {}
+        day = date(year, 1, 1)
+        while day.year == year:
+            result[day.toordinal()] = self.suntimes(day)
+            day += timedelta(days=1)
+        return result
         
     def sunrise(self,when=None):
         '''
@@ -71,22 +232,13 @@ class Sun:
         when is a datetime.date object. If no date is given
         current date is assumed.
         '''
-        if when is None : when = date.today()
-        self.__preptime(when)
-        self.__calc()
-        return self.__timefromdecimalday(self.sunrise_t)
+        return self.suntimes(when)[0]
       
     def sunset(self,when=None):
-        if when is None : when = date.today()
-        self.__preptime(when)
-        self.__calc()
-        return self.__timefromdecimalday(self.sunset_t)
+        return self.suntimes(when)[1]
       
     def solarnoon(self,when=None):
-        if when is None : when = date.today()
-        self.__preptime(when)
-        self.__calc()
-        return self.__timefromdecimalday(self.solarnoon_t)
+        return self.suntimes(when)[2]
 
     def sunup(self,when=None):
         '''
@@ -96,24 +248,9 @@ class Sun:
         '''
         if when is None : when = datetime.now()
         t = when.time()        
-        t_sunrise = self.sunrise(when.date())
-        t_sunset = self.sunset(when.date())
+        t_sunrise, t_sunset, t_solarnoon = self.suntimes(when.date())
         return ((t > t_sunrise) and (t < t_sunset))
         
-    def __timefromdecimalday(self, day):
-        '''
-        returns a datetime.time object.
-        
-        day is a decimal day between 0.0 and 1.0, e.g. noon = 0.5
-        '''
-        hours  = 24.0*day
-        h      = int(hours)
-        minutes= (hours-h)*60
-        m      = int(minutes)
-        seconds= (minutes-m)*60
-        s      = int(seconds)
-        return time(hour=h,minute=m,second=s)
-
     def __preptime(self,when):
         '''
         Extract information in a suitable format from when, 
@@ -124,12 +261,7 @@ class Sun:
         t = time(hour=12, tzinfo=self.timezone)
         dt = datetime.combine(when, t)
         
-        # datetime days are numbered in the Gregorian calendar
-        # while the calculations from NOAA are distibuted as
-        # OpenOffice spreadsheets with days numbered from
-        # 1/1/1900. The difference are those numbers taken for 
-        # 18/12/2010
-        self.day = dt.toordinal()-(734124-40529)
+        self.day = dt.toordinal()-NOAA_DAY_OFFSET
         self.time= (t.hour + t.minute/60.0 + t.second/3600.0)/24.0
         
         self.offset=0
@@ -145,34 +277,8 @@ class Sun:
         The results are stored in the instance variables
         sunrise_t, sunset_t and solarnoon_t
         '''
-        offset = self.offset # in hours, east is positive
-        longitude= self.long # in decimal degrees, east is positive
-        latitude = self.lat  # in decimal degrees, north is positive
-        
-        time  = self.time # percentage past midnight, i.e. noon  is 0.5
-        day   = self.day  # daynumber 1=1/1/1900
-        
-        Jday     =day+2415018.5+time-offset/24 # Julian day
-        Jcent    =(Jday-2451545)/36525    # Julian century
-        
-        Manom    = 357.52911+Jcent*(35999.05029-0.0001537*Jcent)
-        Mlong    = 280.46646+Jcent*(36000.76983+Jcent*0.0003032)%360
-        Eccent   = 0.016708634-Jcent*(0.000042037+0.0001537*Jcent)
-        Mobliq   = 23+(26+((21.448-Jcent*(46.815+Jcent*(0.00059-Jcent*0.001813))))/60)/60
-        obliq    = Mobliq+0.00256*cos(rad(125.04-1934.136*Jcent))
-        vary     = tan(rad(obliq/2))*tan(rad(obliq/2))
-        Seqcent  = sin(rad(Manom))*(1.914602-Jcent*(0.004817+0.000014*Jcent))+sin(rad(2*Manom))*(0.019993-0.000101*Jcent)+sin(rad(3*Manom))*0.000289
-        Struelong= Mlong+Seqcent
-        Sapplong = Struelong-0.00569-0.00478*sin(rad(125.04-1934.136*Jcent))
-        declination = deg(asin(sin(rad(obliq))*sin(rad(Sapplong))))
-        
-        eqtime   = 4*deg(vary*sin(2*rad(Mlong))-2*Eccent*sin(rad(Manom))+4*Eccent*vary*sin(rad(Manom))*cos(2*rad(Mlong))-0.5*vary*vary*sin(4*rad(Mlong))-1.25*Eccent*Eccent*sin(2*rad(Manom)))
-        
-        hourangle= deg(acos(cos(rad(90.833))/(cos(rad(latitude))*cos(rad(declination)))-tan(rad(latitude))*tan(rad(declination))))
-        
-        self.solarnoon_t=(720-4*longitude-eqtime+offset*60)/1440
-        self.sunrise_t  =self.solarnoon_t-hourangle*4/1440
-        self.sunset_t   =self.solarnoon_t+hourangle*4/1440
+        self.solarnoon_t, self.sunrise_t, self.sunset_t = _noaa(self.lat, 
+            self.long, self.day, self.time, self.offset, _scalar)
 
 if __name__ == "__main__":
     if (len(sys.argv)>1):
@@ -181,4 +287,5 @@ if __name__ == "__main__":
         s = Sun(59.17,18.3, LocalTimezone()) # Default Stockholm / Sweden
         
     print("Time now: " + str(datetime.now()))
-    print("Sunrise: "+str(s.sunrise())+"  Solarnoon: "+str(s.solarnoon())+"  Sunset: " +str(s.sunset()))
\ No newline at end of file
+    sunrise, sunset, solarnoon = s.suntimes()
+    print("Sunrise: "+str(sunrise)+"  Solarnoon: "+str(solarnoon)+"  Sunset: " +str(sunset))
\ No newline at end of file